@@ -31,23 +31,25 @@ class MessageSendBreaker(object):
     def __init__(self, app, allow):
         self.app = app
         self.allow = allow
-        self._send_message_via_window = self.app.send_message_via_window
+        self._send_messages_via_window = self.app.send_messages_via_window
         self._messages_sent = 0
 
     def patch_app(self):
         """
         Replace the original send method with our broken one.
         """
-        self.app.send_message_via_window = self._broken_send
+        self.app.send_messages_via_window = self._broken_send
 
-    def _broken_send(self, *args, **kw):
+    def _broken_send(self, conv, window_id, batch_id, to_addrs, *args, **kw):
         """
-        Send up to self.allow messages, then raise an exception.
+        Send batches of messages until at least self.allow messages have
+        been sent, then raise an exception.
         """
         if self._messages_sent >= self.allow:
             raise BreakerError("oops")
-        self._messages_sent += 1
-        return self._send_message_via_window(*args, **kw)
+        self._messages_sent += len(to_addrs)
+        return self._send_messages_via_window(
+            conv, window_id, batch_id, to_addrs, *args, **kw)
 
 
 class MessageSendPauser(object):
@@ -58,7 +60,7 @@ class MessageSendPauser(object):
     def __init__(self, app, allow):
         self.app = app
         self.allow = allow
-        self._send_message_via_window = self.app.send_message_via_window
+        self._send_messages_via_window = self.app.send_messages_via_window
         self._messages_sent = 0
         self._pause_d = Deferred()
         self._resume_d = Deferred()
@@ -67,7 +69,7 @@ class MessageSendPauser(object):
         """
         Replace the original send method with our pausing one.
         """
-        self.app.send_message_via_window = self._pausing_send
+        self.app.send_messages_via_window = self._pausing_send
 
     def wait_for_pause(self):
         """
@@ -82,15 +84,17 @@ class MessageSendPauser(object):
         self._resume_d.callback(None)
 
     @inlineCallbacks
-    def _pausing_send(self, *args, **kw):
+    def _pausing_send(self, conv, window_id, batch_id, to_addrs, *args, **kw):
         """
-        Send up to self.allow messages, then pause and wait to be resumed.
+        Send batches of messages until at least self.allow messages have
+        been sent, then pause and wait to be resumed.
         """
-        if self._messages_sent == self.allow:
+        if self._messages_sent >= self.allow and not self._pause_d.called:
             self._pause_d.callback(None)
             yield self._resume_d
-        self._messages_sent += 1
-        yield self._send_message_via_window(*args, **kw)
+        self._messages_sent += len(to_addrs)
+        yield self._send_messages_via_window(
+            conv, window_id, batch_id, to_addrs, *args, **kw)
 
 
 class TestBulkMessageApplication(VumiTestCase):
@@ -304,7 +308,9 @@ class TestBulkMessageApplication(VumiTestCase):
         If we interrupt a bulk message command and reprocess it, we skip any
         messages we have already sent.
         """
-        # Replace send_message_via_window with one that we can break.
+        # Replace send_messages_via_window with one that we can break after
+        # two batches.
+        self.app.send_batch_size = 2
         send_breaker = MessageSendBreaker(self.app, 4)
         send_breaker.patch_app()
 
@@ -373,7 +379,9 @@ class TestBulkMessageApplication(VumiTestCase):
         If we interrupt a bulk message command and reprocess it, we skip any
         messages we have already sent and also deduplicate correctly.
         """
-        # Replace send_message_via_window with one that we can break.
+        # Replace send_messages_via_window with one that we can break after
+        # two batches.
+        self.app.send_batch_size = 2
         send_breaker = MessageSendBreaker(self.app, 4)
         send_breaker.patch_app()
 
@@ -436,13 +444,130 @@ class TestBulkMessageApplication(VumiTestCase):
 
         self.flushLoggedErrors(BreakerError)
 
+    @inlineCallbacks
+    def run_checkpointed_bulk_send(self, conversation):
+        """
+        Run a bulk send command and return the contact keys at which send
+        progress was checkpointed.
+        """
+        checkpoints = []
+        orig_set_send_progress = self.app.set_send_progress
+
+        def set_send_progress(conv, command_id, contact_key):
+            checkpoints.append(contact_key)
+            return orig_set_send_progress(conv, command_id, contact_key)
+        self.patch(self.app, 'set_send_progress', set_send_progress)
+
+        yield self.app_helper.dispatch_command(
+            "bulk_send",
+            user_account_key=conversation.user_account.key,
+            conversation_key=conversation.key,
+            batch_id=conversation.batch.key,
+            dedupe=False,
+            content="hello world",
+            delivery_class="sms",
+            msg_options={},
+        )
+        # Have the window manager deliver the messages.
+        self.clock.advance(self.app.monitor_interval + 1)
+        yield self.wait_for_window_monitor()
+        returnValue(checkpoints)
+
+    @inlineCallbacks
+    def test_bulk_send_batches(self):
+        """
+        Messages are added to the window in batches and progress is
+        checkpointed after each batch rather than after each message.
+        """
+        self.app.send_batch_size = 4
+        batch_sizes = []
+        orig_send = self.app.send_messages_via_window
+
+        def send_messages_via_window(conv, window_id, batch_id, to_addrs,
+                                     *args):
+            batch_sizes.append(len(to_addrs))
+            return orig_send(conv, window_id, batch_id, to_addrs, *args)
+        self.patch(
+            self.app, 'send_messages_via_window', send_messages_via_window)
+
+        group = yield self.app_helper.create_group_with_contacts(u'group', 10)
+        conversation = yield self.app_helper.create_conversation(
+            groups=[group])
+        yield self.app_helper.start_conversation(conversation)
+        checkpoints = yield self.run_checkpointed_bulk_send(conversation)
+
+        self.assertEqual(batch_sizes, [4, 4, 2])
+        contact_keys = sorted((yield group.backlinks.contact_keys()))
+        self.assertEqual(
+            checkpoints, [contact_keys[3], contact_keys[7], contact_keys[9]])
+        self.assertEqual(len(self.app_helper.get_dispatched_outbound()), 10)
+
+    @inlineCallbacks
+    def test_bulk_send_progress_interval(self):
+        """
+        If contacts are slow to arrive, progress is checkpointed once the
+        progress interval has passed, even if the batch isn't full.
+        """
+        self.app.contact_keys_page_size = 2
+        self.app.send_progress_interval = 5
+        orig_get_contact_addresses = self.app.get_contact_addresses
+
+        def get_contact_addresses(*args, **kw):
+            self.clock.advance(3)
+            return orig_get_contact_addresses(*args, **kw)
+        self.patch(self.app, 'get_contact_addresses', get_contact_addresses)
+
+        group = yield self.app_helper.create_group_with_contacts(u'group', 10)
+        conversation = yield self.app_helper.create_conversation(
+            groups=[group])
+        yield self.app_helper.start_conversation(conversation)
+        checkpoints = yield self.run_checkpointed_bulk_send(conversation)
+
+        contact_keys = sorted((yield group.backlinks.contact_keys()))
+        self.assertEqual(
+            checkpoints, [contact_keys[3], contact_keys[7], contact_keys[9]])
+        self.assertEqual(len(self.app_helper.get_dispatched_outbound()), 10)
+
+    @inlineCallbacks
+    def test_claim_send_addresses(self):
+        """
+        Each address is claimed by the first contact to use it, and claims
+        survive across calls so an interrupted send can be resumed.
+        """
+        conversation = yield self.setup_conversation()
+        cmd_id = uuid4().get_hex()
+
+        claimed = yield self.app.claim_send_addresses(conversation, cmd_id, [
+            ("key1", "+271"), ("key2", "+272"), ("key3", "+271")])
+        self.assertEqual(claimed, [("key1", "+271"), ("key2", "+272")])
+
+        # Only digests of the addresses and contact keys are stored.
+        claims = yield self.app.redis.hgetall(
+            self.app._send_addresses_key(conversation, cmd_id))
+        self.assertEqual(claims, {
+            self.app.claim_digest("+271"): self.app.claim_digest("key1"),
+            self.app.claim_digest("+272"): self.app.claim_digest("key2"),
+        })
+        self.assertTrue(all(len(digest) == 8 for digest in claims))
+
+        claimed = yield self.app.claim_send_addresses(conversation, cmd_id, [
+            ("key2", "+272"), ("key3", "+271"), ("key4", "+273")])
+        self.assertEqual(claimed, [("key2", "+272"), ("key4", "+273")])
+
+        yield self.app.clear_send_progress(conversation, cmd_id)
+        claimed = yield self.app.claim_send_addresses(conversation, cmd_id, [
+            ("key3", "+271")])
+        self.assertEqual(claimed, [("key3", "+271")])
+
     @inlineCallbacks
     def test_overlapping_bulk_send_commands(self):
         """
         If we send a second command before the first one finishes, both sets of
         messages are sent to all contacts.
         """
-        # Replace send_message_via_window with one that we can pause.
+        # Replace send_messages_via_window with one that we can pause after
+        # the first batch.
+        self.app.send_batch_size = 3
         send_pauser1 = MessageSendPauser(self.app, 3)
         send_pauser1.patch_app()
 
@@ -475,6 +600,7 @@ class TestBulkMessageApplication(VumiTestCase):
 
         # Set up a second worker to process the second command.
         app2 = yield self.get_app_worker()
+        app2.send_batch_size = 3
         send_pauser2 = MessageSendPauser(app2, 3)
         send_pauser2.patch_app()
         second_d = self.app_helper.dispatch_command(
@@ -596,12 +722,12 @@ class TestBulkMessageApplication(VumiTestCase):
         batch_id = conversation.batch.key
         window_id = self.app.get_window_id(conversation.key, batch_id)
 
-        yield self.app.send_message_via_window(
-            conversation, window_id, batch_id, "12345", {}, "message 1")
-        yield self.app.send_message_via_window(
-            conversation, window_id, batch_id, None, {}, "broken")
-        yield self.app.send_message_via_window(
-            conversation, window_id, batch_id, "12346", {}, "message 2")
+        yield self.app.send_messages_via_window(
+            conversation, window_id, batch_id, ["12345"], {}, "message 1")
+        yield self.app.send_messages_via_window(
+            conversation, window_id, batch_id, [None], {}, "broken")
+        yield self.app.send_messages_via_window(
+            conversation, window_id, batch_id, ["12346"], {}, "message 2")
 
         self.clock.advance(self.app.monitor_interval + 1)
         yield self.wait_for_window_monitor()
@@ -2,18 +2,19 @@
 # -*- coding: utf-8 -*-
 
 """Vumi application worker for the vumitools API."""
-from twisted.internet.defer import inlineCallbacks
+import hashlib
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, succeed)
 
-from vumi.components.window_manager import WindowManager
 from vumi import log
 
 from go.vumitools.app_worker import GoApplicationWorker
+from go.vumitools.contact_send import ContactSendMixin, SEND_PROGRESS_EXPIRY
+from go.vumitools.window_manager import BatchingWindowManager
 
 
-SEND_PROGRESS_EXPIRY = 3600 * 24 * 7  # One week
-
-
-class BulkMessageApplication(GoApplicationWorker):
+class BulkMessageApplication(ContactSendMixin, GoApplicationWorker):
     """
     Application that accepts 'send message' commands and does exactly that.
     """
@@ -22,13 +23,18 @@ class BulkMessageApplication(GoApplicationWorker):
     max_ack_wait = 100
     monitor_interval = 20
     monitor_window_cleanup = True
+    # Messages are added to the window and send progress is checkpointed
+    # once every `send_batch_size` messages, or more often if it has been
+    # more than `send_progress_interval` seconds since the last checkpoint.
+    send_batch_size = 200
+    send_progress_interval = 5
 
     @inlineCallbacks
     def setup_application(self):
         yield super(BulkMessageApplication, self).setup_application()
         wm_redis = self.redis.sub_manager('%s:window_manager' % (
             self.worker_name,))
-        self.window_manager = WindowManager(
+        self.window_manager = BatchingWindowManager(
             wm_redis,
             window_size=self.max_ack_window,
             flight_lifetime=self.max_ack_wait)
@@ -65,29 +71,115 @@ class BulkMessageApplication(GoApplicationWorker):
     def get_window_id(self, conversation_key, batch_id):
         return ':'.join([conversation_key, batch_id])
 
-    def _send_progress_key(self, conv, command_id):
-        return ':'.join([self.worker_name, conv.key, command_id])
+    def _send_addresses_key(self, conv, command_id):
+        return ':'.join([self.worker_name, conv.key, command_id, 'addresses'])
 
-    def get_send_progress(self, conv, command_id):
-        return self.redis.get(self._send_progress_key(conv, command_id))
+    @inlineCallbacks
+    def clear_send_progress(self, conv, command_id):
+        yield super(BulkMessageApplication, self).clear_send_progress(
+            conv, command_id)
+        yield self.redis.delete(self._send_addresses_key(conv, command_id))
 
-    def set_send_progress(self, conv, command_id, contact_key):
-        key = self._send_progress_key(conv, command_id)
-        return self.redis.setex(key, SEND_PROGRESS_EXPIRY, contact_key)
+    @staticmethod
+    def claim_digest(value):
+        """
+        Return the compact digest of an address or contact key that is
+        stored for deduplication.
+        """
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return hashlib.md5(value).digest()[:8]
 
-    def clear_send_progress(self, conv, command_id):
-        return self.redis.delete(self._send_progress_key(conv, command_id))
+    @inlineCallbacks
+    def claim_send_addresses(self, conv, command_id, contact_addrs):
+        """
+        Claim addresses for deduplication.
+
+        Each address belongs to the first contact that claims it. Claims are
+        stored in a Redis hash for the command so that they survive an
+        interrupted send, and a contact that claims an address it already
+        owns keeps it. The hash is deleted when the command finishes.
+
+        To keep the hash small, claims are stored as 64-bit digests of the
+        address and contact key rather than the values themselves. If two
+        addresses have the same digest, the second is treated as a duplicate
+        and isn't sent to. For a million addresses, the chance of that
+        happening at all is less than one in ten million.
+
+        :param list contact_addrs:
+            ``(contact_key, address)`` pairs, in contact key order.
+
+        :returns:
+            The ``(contact_key, address)`` pairs for which the contact owns
+            the address.
+        """
+        key = self._send_addresses_key(conv, command_id)
+        claims = [
+            (self.claim_digest(addr), self.claim_digest(contact_key))
+            for contact_key, addr in contact_addrs]
+        # These are all sent before any of the responses arrive, so we only
+        # wait for one round trip and the claims are made in order.
+        claimed = yield gatherResults([
+            self.redis.hsetnx(key, addr_digest, contact_digest)
+            for addr_digest, contact_digest in claims])
+        yield self.redis.expire(key, SEND_PROGRESS_EXPIRY)
+        owners = yield gatherResults([
+            succeed(contact_digest) if was_claimed else
+            self.redis.hget(key, addr_digest)
+            for (addr_digest, contact_digest), was_claimed in zip(
+                claims, claimed)])
+        returnValue([
+            contact_addr
+            for contact_addr, (_, contact_digest), owner in zip(
+                contact_addrs, claims, owners)
+            if owner == contact_digest])
 
     @inlineCallbacks
-    def send_message_via_window(self, conv, window_id, batch_id, to_addr,
-                                msg_options, content):
+    def send_messages_via_window(self, conv, window_id, batch_id, to_addrs,
+                                 msg_options, content):
         yield self.window_manager.create_window(window_id, strict=False)
-        yield self.window_manager.add(window_id, {
+        yield self.window_manager.add_many(window_id, [{
             'batch_id': batch_id,
             'to_addr': to_addr,
             'content': content,
             'msg_options': msg_options,
-            })
+            } for to_addr in to_addrs])
+
+    @inlineCallbacks
+    def send_batch(self, conv, cmd_id, window_id, batch_id, contact_addrs,
+                   msg_options, content):
+        """
+        Send a message to each of a batch of ``(contact_key, address)``
+        pairs and checkpoint the send progress at the last contact.
+        """
+        yield self.send_messages_via_window(
+            conv, window_id, batch_id, [addr for _, addr in contact_addrs],
+            msg_options, content)
+        # The messages are safely in the window, so we can now update the
+        # progress tracker.
+        yield self.set_send_progress(conv, cmd_id, contact_addrs[-1][0])
+
+    @inlineCallbacks
+    def get_contact_addresses(self, conv, cmd_id, contacts, dedupe,
+                              delivery_class, opt_outs=None):
+        """
+        Find the address to send to for each of a bunch of contacts that is
+        opted in and, if asked, hasn't already been sent the message at the
+        same address.
+
+        :returns:
+            A list of ``(contact_key, address)`` pairs, in contact order.
+        """
+        to_addrs = yield conv.get_opted_in_contact_addresses(
+            contacts, delivery_class, opt_outs)
+        contact_addrs = [
+            (contact.key, to_addr)
+            for contact, to_addr in zip(contacts, to_addrs) if to_addr]
+
+        if dedupe:
+            contact_addrs = yield self.claim_send_addresses(
+                conv, cmd_id, contact_addrs)
+        returnValue(contact_addrs)
 
     @inlineCallbacks
     def process_command_bulk_send(self, cmd_id, user_account_key,
@@ -100,53 +192,48 @@ class BulkMessageApplication(GoApplicationWorker):
 
         If this command is interrupted (by a worker restart, for example) the
         next time it is processed it will avoid sending the message to contacts
-        that it has already been sent to. Note that the contact and opt-out
-        lookups still happen (because those are required for deduplication), so
-        there may be a lengthly delay before the remaining messages are sent if
-        the previous send was interrupted after a large number of messages.
+        that it has already been sent to. Addresses used for deduplication are
+        kept in Redis, so contacts before the point of interruption don't
+        need to be loaded again.
+
+        Messages are added to the send window in batches and progress is only
+        checkpointed after each batch, so an interrupted send may repeat at
+        most one batch of messages.
         """
         conv = yield self.get_conversation(user_account_key, conversation_key)
         if conv is None:
             log.warning("Cannot find conversation '%s' for user '%s'." % (
                 conversation_key, user_account_key))
             return
-        contact_store = conv.user_api.contact_store
-        addresses_seen = set()  # To deduplicate addresses, if asked.
-
-        # NOTE: We fetch all contact keys before we start. This is suboptimal,
-        #       but we need the keys sorted and deduplicated.
-        contact_keys = yield conv.get_contact_keys()
-        contact_keys.sort()  # Sort in-place to keep memory usage down.
 
         self.add_conv_to_msg_options(conv, msg_options)
         window_id = self.get_window_id(conversation_key, batch_id)
-        interrupted_progress = yield self.get_send_progress(conv, cmd_id)
-        if interrupted_progress is not None:
-            log.warning(
-                "Resuming interrupted send for conversation '%s' at '%s'." % (
-                    conv.key, interrupted_progress))
-
-        for contact_key in contact_keys:
-            contact = yield contact_store.get_contact_by_key(contact_key)
-            to_addr = yield conv.get_opted_in_contact_address(
-                contact, delivery_class)
-            if dedupe:
-                if to_addr in addresses_seen:
-                    # We've already seen this address, so move on.
-                    continue
-                addresses_seen.add(to_addr)
-
-            if interrupted_progress and contact_key <= interrupted_progress:
-                # We are still working through the backlog of a previously
-                # interrupted bulk send command, so don't actually send the
-                # message. This check is safe because our contact keys are both
-                # sorted and unique.
-                continue
-
-            # We can now send the message and update the progress tracker.
-            yield self.send_message_via_window(
-                conv, window_id, batch_id, to_addr, msg_options, content)
-            yield self.set_send_progress(conv, cmd_id, contact_key)
+        opt_outs = conv.get_opt_out_snapshot()
+        pending = []
+        last_checkpoint = [self.window_manager.get_clocktime()]
+
+        @inlineCallbacks
+        def send_bunch(contacts):
+            contact_addrs = yield self.get_contact_addresses(
+                conv, cmd_id, contacts, dedupe, delivery_class, opt_outs)
+            pending.extend(contact_addrs)
+            while pending and (
+                    len(pending) >= self.send_batch_size or
+                    (self.window_manager.get_clocktime() -
+                     last_checkpoint[0]) >= self.send_progress_interval):
+                batch = pending[:self.send_batch_size]
+                del pending[:self.send_batch_size]
+                yield self.send_batch(
+                    conv, cmd_id, window_id, batch_id, batch, msg_options,
+                    content)
+                last_checkpoint[0] = self.window_manager.get_clocktime()
+
+        yield self.for_each_contact_bunch(conv, cmd_id, send_bunch)
+
+        if pending:
+            yield self.send_batch(
+                conv, cmd_id, window_id, batch_id, pending, msg_options,
+                content)
 
         # All finished, so clear the send progress.
         yield self.clear_send_progress(conv, cmd_id)
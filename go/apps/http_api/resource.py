@@ -1,10 +1,14 @@
 # -*- test-case-name: go.apps.http_api.tests.test_vumi_app -*-
 
+from collections import deque
 from functools import partial
 
+from zope.interface import implementer
+
 from twisted.web.server import NOT_DONE_YET
 from twisted.internet.error import ConnectionDone
 from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IPushProducer
 
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi import log
@@ -16,6 +20,63 @@ from go.apps.http_api_nostream.resource import (
 # NOTE: This module subclasses and uses things from go.apps.http_api_nostream.
 
 
+@implementer(IPushProducer)
+class StreamWriter(object):
+    """
+    Writer for a streaming response with a bounded buffer.
+
+    This registers itself as a producer for the request so the transport
+    pauses it when its write buffer is full. While paused, writes are held in
+    a buffer of at most :attr:`MAX_BUFFERED` items that is written out when
+    the transport resumes. :meth:`write` never waits on the client. It
+    returns ``False`` if the data can't be accepted because the buffer is
+    full or the connection is gone, and keeps refusing data until the buffer
+    has drained so that nothing overtakes what was refused. Once it has
+    drained, ``drained`` is called so the caller can resend what was refused.
+    """
+
+    MAX_BUFFERED = 100
+
+    def __init__(self, request, drained=None):
+        self.request = request
+        self.drained = drained
+        self.paused = False
+        self.stopped = False
+        self.overflowed = False
+        self._buffer = deque()
+        request.registerProducer(self, True)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        # Writing may pause us again, in which case we stop and wait.
+        while self._buffer and not self.paused:
+            self.request.write(self._buffer.popleft())
+        if self.overflowed and not (self._buffer or self.paused):
+            self.overflowed = False
+            if self.drained is not None:
+                self.drained()
+
+    def stopProducing(self):
+        # The connection is gone, so there's nothing to write to.
+        self.stopped = True
+        self._buffer.clear()
+
+    def write(self, data):
+        if self.stopped or self.overflowed:
+            return False
+        if not self.paused:
+            self.request.write(data)
+            return True
+        if len(self._buffer) >= self.MAX_BUFFERED:
+            self.overflowed = True
+            return False
+        self._buffer.append(data)
+        return True
+
+
 class StreamResourceMixin(object):
 
     message_class = None
@@ -48,9 +109,10 @@ class StreamResourceMixin(object):
         # stuff started anyway and then we have the ability to close the
         # connection.
         request.write('')
+        self._writer = StreamWriter(request, drained=self.resend_backlog)
         done = request.notifyFinish()
         done.addBoth(self.teardown_stream)
-        self._callback = partial(self.publish, request)
+        self._callback = partial(self.publish, self._writer)
         self.stream_ready.callback(request)
         return NOT_DONE_YET
 
@@ -58,15 +120,23 @@ class StreamResourceMixin(object):
         return self.worker.register_client(self._rk, self.message_class,
                                            self._callback)
 
+    def resend_backlog(self):
+        # Messages we couldn't buffer were queued in the backlog.
+        d = self.worker.flush_client_backlog(
+            self._rk, self.message_class, self._callback)
+        d.addErrback(log.error)
+
     def teardown_stream(self, err):
         if not (err is None or err.trap(ConnectionDone)):
             log.error(err)
         log.info('Unregistering: %s, %s' % (self._rk, err.getErrorMessage()))
-        return self.worker.unregister_client(self._rk, self._callback)
+        self.worker.unregister_client(self._rk, self._callback)
+        # Refuse anything else written now that the client is gone.
+        self._writer.stopProducing()
 
-    def publish(self, request, message):
+    def publish(self, writer, message):
         line = u'%s\n' % (message.to_json(),)
-        request.write(line.encode(self.encoding))
+        return writer.write(line.encode(self.encoding))
 
 
 class EventStream(BaseResource, StreamResourceMixin):
@@ -8,15 +8,16 @@ from twisted.web.server import NOT_DONE_YET
 
 from vumi.config import ConfigContext
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.tests.helpers import VumiTestCase
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 from vumi.tests.utils import MockHttpServer, LogCatcher
 from vumi.transports.vumi_bridge.client import StreamingClient
 from vumi.utils import http_request_full
 
 from go.apps.http_api.resource import (
-    StreamResourceMixin, StreamingConversationResource)
+    StreamResourceMixin, StreamingConversationResource, StreamWriter)
 from go.apps.tests.helpers import AppWorkerHelper
-from go.apps.http_api.vumi_app import StreamingHTTPWorker
+from go.apps.http_api.vumi_app import (
+    StreamingClientManager, StreamingHTTPWorker)
 
 
 class TestStreamingHTTPWorker(VumiTestCase):
@@ -812,3 +813,212 @@ class TestStreamingHTTPWorker(VumiTestCase):
         self.assertEqual(sent_msg['to_addr'], msg['from_addr'])
         self.assertEqual(sent_msg['content'], 'foo')
         self.assertEqual(sent_msg['in_reply_to'], msg['message_id'])
+
+
+class TestStreamingClientManager(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.manager = StreamingClientManager(self.redis)
+
+    def mkmsg(self, i):
+        return TransportUserMessage(
+            to_addr='123', from_addr='456', transport_name='sphex',
+            transport_type='sms', content='in %s' % (i,),
+            message_id=str(i))
+
+    @inlineCallbacks
+    def queue_messages(self, count, key='key'):
+        for i in range(count):
+            yield self.manager.queue_in_backlog(key, self.mkmsg(i))
+
+    @inlineCallbacks
+    def test_queue_in_backlog_trims(self):
+        self.manager.MAX_BACKLOG_SIZE = 3
+        yield self.queue_messages(5)
+        backlog = yield self.redis.lrange(
+            self.manager.backlog_key('key'), 0, -1)
+        self.assertEqual(
+            [TransportUserMessage.from_json(obj)['message_id']
+             for obj in backlog],
+            ['4', '3', '2'])
+
+    @inlineCallbacks
+    def test_flush_backlog_in_batches(self):
+        self.manager.BACKLOG_BATCH_SIZE = 3
+        yield self.queue_messages(7)
+        received = []
+        self.manager.start('key', TransportUserMessage, received.append)
+        yield self.manager.flush_backlog(
+            'key', TransportUserMessage, received.append)
+        self.assertEqual(
+            [msg['message_id'] for msg in received],
+            ['0', '1', '2', '3', '4', '5', '6'])
+        self.assertEqual(
+            (yield self.redis.llen(self.manager.backlog_key('key'))), 0)
+
+    @inlineCallbacks
+    def test_flush_backlog_client_stopped(self):
+        self.manager.BACKLOG_BATCH_SIZE = 5
+        yield self.queue_messages(7)
+        received = []
+
+        def callback(msg):
+            received.append(msg)
+            if len(received) == 2:
+                self.manager.stop('key', callback)
+
+        self.manager.start('key', TransportUserMessage, callback)
+        yield self.manager.flush_backlog(
+            'key', TransportUserMessage, callback)
+        self.assertEqual([msg['message_id'] for msg in received], ['0', '1'])
+
+        # The rest of the backlog is left for the next client, in order.
+        received = []
+        self.manager.start('key', TransportUserMessage, received.append)
+        yield self.manager.flush_backlog(
+            'key', TransportUserMessage, received.append)
+        self.assertEqual(
+            [msg['message_id'] for msg in received],
+            ['2', '3', '4', '5', '6'])
+
+    @inlineCallbacks
+    def test_publish_spills_to_backlog(self):
+        received = []
+
+        def callback(msg):
+            if len(received) == 2:
+                return False
+            received.append(msg)
+
+        self.manager.start('key', TransportUserMessage, callback)
+        for i in range(4):
+            yield self.manager.publish('key', self.mkmsg(i))
+        self.assertEqual([msg['message_id'] for msg in received], ['0', '1'])
+        backlog = yield self.redis.lrange(
+            self.manager.backlog_key('key'), 0, -1)
+        self.assertEqual(
+            [TransportUserMessage.from_json(obj)['message_id']
+             for obj in backlog],
+            ['3', '2'])
+
+    @inlineCallbacks
+    def test_flush_backlog_client_full(self):
+        self.manager.BACKLOG_BATCH_SIZE = 5
+        yield self.queue_messages(7)
+        received = []
+
+        def callback(msg):
+            if len(received) == 2:
+                return False
+            received.append(msg)
+
+        self.manager.start('key', TransportUserMessage, callback)
+        yield self.manager.flush_backlog(
+            'key', TransportUserMessage, callback)
+        self.assertEqual([msg['message_id'] for msg in received], ['0', '1'])
+
+        # The rest of the backlog is kept, in order.
+        received = []
+        self.manager.start('key', TransportUserMessage, received.append)
+        yield self.manager.flush_backlog(
+            'key', TransportUserMessage, received.append)
+        self.assertEqual(
+            [msg['message_id'] for msg in received],
+            ['2', '3', '4', '5', '6'])
+
+    @inlineCallbacks
+    def test_requeue_in_backlog_trims(self):
+        self.manager.MAX_BACKLOG_SIZE = 4
+        yield self.queue_messages(2)
+        objs = yield self.manager.pop_backlog_batch('key')
+        # More messages arrive before the popped ones are requeued.
+        for i in range(2, 5):
+            yield self.manager.queue_in_backlog('key', self.mkmsg(i))
+        yield self.manager.requeue_in_backlog('key', objs)
+        backlog = yield self.redis.lrange(
+            self.manager.backlog_key('key'), 0, -1)
+        self.assertEqual(
+            [TransportUserMessage.from_json(obj)['message_id']
+             for obj in backlog],
+            ['4', '3', '2', '1'])
+
+
+class DummyStreamRequest(object):
+    def __init__(self):
+        self.written = []
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class TestStreamWriter(VumiTestCase):
+
+    def test_write(self):
+        request = DummyStreamRequest()
+        writer = StreamWriter(request)
+        self.assertEqual(request.producer, writer)
+        self.assertTrue(writer.write('foo'))
+        self.assertEqual(request.written, ['foo'])
+
+    def test_write_while_paused(self):
+        request = DummyStreamRequest()
+        writer = StreamWriter(request)
+        writer.pauseProducing()
+        self.assertTrue(writer.write('foo'))
+        self.assertEqual(request.written, [])
+        writer.resumeProducing()
+        self.assertEqual(request.written, ['foo'])
+
+    def test_write_buffer_full(self):
+        drained = []
+        request = DummyStreamRequest()
+        writer = StreamWriter(request, drained=lambda: drained.append(True))
+        writer.MAX_BUFFERED = 2
+        writer.pauseProducing()
+        self.assertTrue(writer.write('a'))
+        self.assertTrue(writer.write('b'))
+        self.assertFalse(writer.write('c'))
+        writer.resumeProducing()
+        self.assertEqual(request.written, ['a', 'b'])
+        self.assertEqual(drained, [True])
+        self.assertTrue(writer.write('d'))
+        self.assertEqual(request.written, ['a', 'b', 'd'])
+
+    def test_write_refused_until_drained(self):
+        drained = []
+        request = DummyStreamRequest()
+        writer = StreamWriter(request, drained=lambda: drained.append(True))
+        writer.MAX_BUFFERED = 1
+        writer.pauseProducing()
+        writer.write('a')
+        self.assertFalse(writer.write('b'))
+
+        # Writing the buffered data pauses us again before we've drained.
+        def write(data):
+            request.written.append(data)
+            writer.pauseProducing()
+        request.write = write
+        writer.resumeProducing()
+        self.assertEqual(request.written, ['a'])
+        self.assertEqual(drained, [])
+        self.assertFalse(writer.write('c'))
+
+        writer.resumeProducing()
+        self.assertEqual(drained, [True])
+
+    def test_stop_producing_refuses_writes(self):
+        request = DummyStreamRequest()
+        writer = StreamWriter(request)
+        writer.pauseProducing()
+        writer.write('foo')
+        writer.stopProducing()
+        self.assertFalse(writer.write('bar'))
+        writer.resumeProducing()
+        self.assertEqual(request.written, [])
@@ -2,7 +2,7 @@
 from collections import defaultdict
 import random
 
-from twisted.internet.defer import inlineCallbacks, maybeDeferred
+from twisted.internet.defer import inlineCallbacks, gatherResults, succeed
 
 from go.apps.http_api_nostream.auth import AuthorizedResource
 from go.apps.http_api_nostream.vumi_app import NoStreamingHTTPWorker
@@ -14,8 +14,22 @@ from go.apps.http_api.resource import (
 
 
 class StreamingClientManager(object):
+    """
+    Tracks connected stream clients and queues messages for conversations
+    with no connected clients in a bounded Redis backlog.
+
+    Redis commands that don't depend on each other's results are issued
+    together without waiting for replies so that they are pipelined over the
+    Redis connection.
+
+    Client callbacks must not wait on the client. A callback returns
+    ``False`` if it can't accept a message right now (because its buffer is
+    full, for example), in which case the message is queued in the backlog
+    instead.
+    """
 
     MAX_BACKLOG_SIZE = 100
+    BACKLOG_BATCH_SIZE = 20
     CLIENT_PREFIX = 'clients'
 
     def __init__(self, redis):
@@ -28,14 +42,43 @@ class StreamingClientManager(object):
     def backlog_key(self, key):
         return self.client_key('backlog', key)
 
+    def pop_backlog_batch(self, key):
+        """
+        Pop up to :attr:`BACKLOG_BATCH_SIZE` of the oldest messages from the
+        backlog, oldest first.
+        """
+        backlog_key = self.backlog_key(key)
+        d = gatherResults([
+            self.redis.rpop(backlog_key)
+            for _ in range(self.BACKLOG_BATCH_SIZE)])
+        return d.addCallback(lambda objs: [o for o in objs if o is not None])
+
+    def requeue_in_backlog(self, key, objs):
+        """
+        Put popped messages back at the oldest end of the backlog.
+
+        New messages may have been queued while these were popped, so the
+        backlog is trimmed again afterwards. As in :meth:`queue_in_backlog`,
+        the oldest messages are the ones dropped.
+        """
+        backlog_key = self.backlog_key(key)
+        return gatherResults([
+            self.redis.rpush(backlog_key, obj) for obj in reversed(objs)] + [
+            self.redis.ltrim(backlog_key, 0, self.MAX_BACKLOG_SIZE - 1)])
+
     @inlineCallbacks
     def flush_backlog(self, key, message_class, callback):
-        backlog_key = self.backlog_key(key)
         while True:
-            obj = yield self.redis.rpop(backlog_key)
-            if obj is None:
+            objs = yield self.pop_backlog_batch(key)
+            for i, obj in enumerate(objs):
+                if (callback not in self.clients.get(key, ()) or
+                        callback(message_class.from_json(obj)) is False):
+                    # The client went away or can't keep up, so keep the
+                    # rest for later.
+                    yield self.requeue_in_backlog(key, objs[i:])
+                    return
+            if len(objs) < self.BACKLOG_BATCH_SIZE:
                 break
-            yield maybeDeferred(callback, message_class.from_json(obj))
 
     def start(self, key, message_class, callback):
         self.clients[key].append(callback)
@@ -47,15 +90,16 @@ class StreamingClientManager(object):
         callbacks = self.clients[key]
         if callbacks:
             callback = random.choice(callbacks)
-            return maybeDeferred(callback, msg)
-        else:
-            return self.queue_in_backlog(key, msg)
+            if callback(msg) is not False:
+                return succeed(None)
+        return self.queue_in_backlog(key, msg)
 
-    @inlineCallbacks
     def queue_in_backlog(self, key, msg):
         backlog_key = self.backlog_key(key)
-        yield self.redis.lpush(backlog_key, msg.to_json())
-        yield self.redis.ltrim(backlog_key, 0, self.MAX_BACKLOG_SIZE - 1)
+        return gatherResults([
+            self.redis.lpush(backlog_key, msg.to_json()),
+            self.redis.ltrim(backlog_key, 0, self.MAX_BACKLOG_SIZE - 1),
+        ])
 
 
 class StreamingHTTPWorker(NoStreamingHTTPWorker):
@@ -85,6 +129,9 @@ class StreamingHTTPWorker(NoStreamingHTTPWorker):
 
     def register_client(self, key, message_class, callback):
         self.client_manager.start(key, message_class, callback)
+        return self.flush_client_backlog(key, message_class, callback)
+
+    def flush_client_backlog(self, key, message_class, callback):
         return self.client_manager.flush_backlog(key, message_class, callback)
 
     def unregister_client(self, conversation_key, callback):
@@ -4,19 +4,22 @@ import logging
 from urlparse import urlparse, urlunparse
 
 from twisted.internet.defer import inlineCallbacks, DeferredQueue, returnValue
+from twisted.internet.task import Clock
 from twisted.internet.error import DNSLookupError, ConnectionRefusedError
 from twisted.web.error import SchemeNotSupported
 from twisted.web.client import ResponseFailed
 from twisted.web import http
 from twisted.web.server import NOT_DONE_YET
 
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.utils import http_request_full, HttpTimeoutError
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi.tests.utils import MockHttpServer, LogCatcher
 from vumi.tests.helpers import VumiTestCase
 
 from go.apps.http_api_nostream.vumi_app import (
-    ConcurrencyLimitManager, NoStreamingHTTPWorker, HttpRetryApiError)
+    ConcurrencyLimitManager, NoStreamingHTTPWorker, HttpRetryApiError,
+    PushClient)
 from go.apps.http_api_nostream.resource import ConversationResource
 from go.apps.tests.helpers import AppWorkerHelper
 
@@ -147,6 +150,73 @@ class TestConcurrencyLimitManager(VumiTestCase):
         self.assertEqual(limiter._concurrency_limiters, {})
 
 
+class TestPushClient(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.requests = DeferredQueue()
+        self.mock_server = MockHttpServer(self.handle_request)
+        yield self.mock_server.start()
+        self.add_cleanup(self.mock_server.stop)
+
+    def handle_request(self, request):
+        self.requests.put(request)
+        return NOT_DONE_YET
+
+    def get_client(self, concurrency_limit=10, metrics=None):
+        client = PushClient(5, concurrency_limit, 2, metrics=metrics)
+        self.add_cleanup(client.close)
+        return client
+
+    @inlineCallbacks
+    def test_post(self):
+        client = self.get_client()
+        resp_d = client.post(self.mock_server.url, 'data', {'X-Foo': 'bar'})
+        req = yield self.requests.get()
+        self.assertEqual(req.method, 'POST')
+        self.assertEqual(req.content.read(), 'data')
+        self.assertEqual(req.requestHeaders.getRawHeaders('x-foo'), ['bar'])
+        req.setResponseCode(201)
+        req.finish()
+        resp = yield resp_d
+        self.assertEqual(resp.code, 201)
+
+    @inlineCallbacks
+    def test_post_latency_metrics(self):
+        metrics = MetricManager('go.push.')
+        client = self.get_client(metrics=metrics)
+        client.clock = Clock()
+        resp_d = client.post(self.mock_server.url, 'data', {})
+        req = yield self.requests.get()
+        client.clock.advance(0.3)
+        req.finish()
+        yield resp_d
+
+        self.assertEqual(
+            [v for _, v in metrics['push_latency'].poll()], [0.3])
+        self.assertEqual(
+            [v for _, v in metrics['push_latency_buckets.le_500ms'].poll()],
+            [1.0])
+        self.assertEqual(
+            metrics['push_latency_buckets.le_250ms'].poll(), [])
+        self.assertTrue('push_latency_buckets.gt_10000ms' in metrics)
+
+    @inlineCallbacks
+    def test_post_concurrency_limit(self):
+        client = self.get_client(concurrency_limit=1)
+        resp1_d = client.post(self.mock_server.url, 'data1', {})
+        resp2_d = client.post(self.mock_server.url, 'data2', {})
+        req1 = yield self.requests.get()
+        self.assertEqual(req1.content.read(), 'data1')
+        self.assertEqual(self.requests.pending, [])
+
+        req1.finish()
+        yield resp1_d
+        req2 = yield self.requests.get()
+        self.assertEqual(req2.content.read(), 'data2')
+        req2.finish()
+        yield resp2_d
+
+
 class TestNoStreamingHTTPWorkerBase(VumiTestCase):
 
     def setUp(self):
@@ -1219,6 +1289,32 @@ class TestNoStreamingHTTPWorker(TestNoStreamingHTTPWorkerBase):
 
         self.assertEqual(TransportEvent.from_json(posted_json_data), ack1)
 
+    @inlineCallbacks
+    def test_post_inbound_events_batched(self):
+        yield self.start_app_worker({'event_batch_size': 2})
+        self.conversation.config['http_api_nostream']['batch_events'] = True
+        yield self.conversation.save()
+        msg1 = yield self.app_helper.make_stored_outbound(
+            self.conversation, 'out 1', message_id='1')
+        msg2 = yield self.app_helper.make_stored_outbound(
+            self.conversation, 'out 2', message_id='2')
+        event1_d = self.app_helper.make_dispatch_ack(
+            msg1, conv=self.conversation)
+        event2_d = self.app_helper.make_dispatch_ack(
+            msg2, conv=self.conversation)
+
+        req = yield self.push_calls.get()
+        posted_json_data = json.loads(req.content.read())
+        req.finish()
+        ack1 = yield event1_d
+        ack2 = yield event2_d
+
+        self.assertEqual(
+            [TransportEvent.from_json(json.dumps(event))
+             for event in posted_json_data],
+            [ack1, ack2])
+        self.assertEqual(self.push_calls.pending, [])
+
     @inlineCallbacks
     def test_post_inbound_event_500_schedules_retry(self):
         retry_url, retry_calls = yield self.start_retry_server()
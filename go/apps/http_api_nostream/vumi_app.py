@@ -1,12 +1,16 @@
 # -*- test-case-name: go.apps.http_api_nostream.tests.test_vumi_app -*-
 import base64
+import bisect
 import json
 
+from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, Deferred, succeed)
+    inlineCallbacks, returnValue, Deferred, succeed, gatherResults)
+from twisted.web.client import Agent, HTTPConnectionPool
 from twisted.web.error import SchemeNotSupported
 
-from vumi.config import ConfigInt, ConfigText, ConfigList
+from vumi.blinkenlights.metrics import MetricManager, Metric, Count, AVG, MAX
+from vumi.config import ConfigInt, ConfigText, ConfigList, ConfigFloat
 from vumi.utils import http_request_full
 from vumi.transports.httprpc import httprpc
 from vumi import log
@@ -56,6 +60,27 @@ class HTTPWorkerConfig(GoApplicationWorker.CONFIG_CLASS):
     http_retry_timeout = ConfigInt(
         "How long to wait for a response from the retry API (in seconds).",
         default=5, static=True)
+    push_concurrency_limit = ConfigInt(
+        "Maximum number of concurrent requests when pushing messages and"
+        " events to a URL. Further requests are queued. A value less than"
+        " zero disables the limit.",
+        default=10, static=True)
+    push_max_persistent_per_host = ConfigInt(
+        "Maximum number of idle keep-alive connections to keep open to each"
+        " host that messages and events are pushed to.",
+        default=10, static=True)
+    push_metrics_prefix = ConfigText(
+        "Prefix for push request latency metrics. If unset, push latency"
+        " metrics are not published.",
+        static=True)
+    event_batch_size = ConfigInt(
+        "Maximum number of events to push in a single request for"
+        " conversations that have `batch_events` enabled.",
+        default=100, static=True)
+    event_batch_interval = ConfigFloat(
+        "Maximum time (in seconds) to wait for more events before pushing a"
+        " partial batch for conversations that have `batch_events` enabled.",
+        default=1.0, static=True)
 
 
 class ConcurrencyLimiterError(Exception):
@@ -209,6 +234,75 @@ class ConcurrencyLimitManager(object):
         self._cleanup_limiter(key)
 
 
+class PushClient(object):
+    """
+    HTTP client for pushing messages and events to customer URLs.
+
+    Requests reuse keep-alive connections from a shared connection pool,
+    which keeps separate connections for each host. The number of concurrent
+    requests to each URL is limited and requests over the limit are queued.
+
+    If a :class:`MetricManager` is given, request latencies are published as
+    `push_latency` (average and maximum) and as counts of requests in each
+    of the :attr:`LATENCY_BUCKETS` (in seconds), named
+    `push_latency_buckets.le_<bound>ms` with a final
+    `push_latency_buckets.gt_<bound>ms` for latencies above the largest
+    bound.
+    """
+
+    clock = reactor
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, timeout, concurrency_limit, max_persistent_per_host,
+                 metrics=None):
+        self.timeout = timeout
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_persistent_per_host
+        self.concurrency_limiter = ConcurrencyLimitManager(concurrency_limit)
+        self.latency_metric = None
+        self.latency_bucket_metrics = []
+        if metrics is not None:
+            self._register_latency_metrics(metrics)
+
+    def _register_latency_metrics(self, metrics):
+        self.latency_metric = metrics.register(
+            Metric('push_latency', [AVG, MAX]))
+        names = ['le_%dms' % (bound * 1000,) for bound in self.LATENCY_BUCKETS]
+        names.append('gt_%dms' % (self.LATENCY_BUCKETS[-1] * 1000,))
+        self.latency_bucket_metrics = [
+            metrics.register(Count('push_latency_buckets.%s' % (name,)))
+            for name in names]
+
+    def close(self):
+        return self.pool.closeCachedConnections()
+
+    def _make_agent(self, reactor, contextFactory):
+        return Agent(reactor, contextFactory=contextFactory, pool=self.pool)
+
+    def record_latency(self, latency):
+        if self.latency_metric is None:
+            return
+        self.latency_metric.set(latency)
+        bucket = bisect.bisect_left(self.LATENCY_BUCKETS, latency)
+        self.latency_bucket_metrics[bucket].inc()
+
+    @inlineCallbacks
+    def post(self, url, data, headers, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        yield self.concurrency_limiter.start(url)
+        start = self.clock.seconds()
+        try:
+            resp = yield http_request_full(
+                url, data=data, headers=headers, timeout=timeout,
+                agent_class=self._make_agent)
+        finally:
+            self.concurrency_limiter.stop(url)
+            self.record_latency(self.clock.seconds() - start)
+        returnValue(resp)
+
+
 class HttpRetryApiError(Exception):
     """
     Raised when an error occurs while submitting HTTP requests for retrying.
@@ -243,6 +337,21 @@ class NoStreamingHTTPWorker(GoApplicationWorker):
 
         self.concurrency_limiter = ConcurrencyLimitManager(
             config.worker_concurrency_limit)
+        self._push_metrics = None
+        if config.push_metrics_prefix is not None:
+            self._push_metrics = MetricManager(
+                config.push_metrics_prefix, publisher=self.metric_publisher)
+            self._push_metrics.start_polling()
+        self.push_client = PushClient(
+            self.http_request_timeout, config.push_concurrency_limit,
+            config.push_max_persistent_per_host, metrics=self._push_metrics)
+
+        # Pending event batches for conversations with `batch_events`
+        # enabled, keyed by account and push URL.
+        self.event_batch_size = config.event_batch_size
+        self.event_batch_interval = config.event_batch_interval
+        self._event_batches = {}
+
         self.webserver = self.start_web_resources([
             (self.get_conversation_resource(), self.web_path),
             (httprpc.HttpRpcHealthResource(self), self.health_path),
@@ -255,6 +364,12 @@ class NoStreamingHTTPWorker(GoApplicationWorker):
     def teardown_application(self):
         yield super(NoStreamingHTTPWorker, self).teardown_application()
         yield self.webserver.loseConnection()
+        yield gatherResults([
+            self.flush_event_batch(batch_key)
+            for batch_key in self._event_batches.keys()])
+        yield self.push_client.close()
+        if self._push_metrics is not None:
+            self._push_metrics.stop_polling()
 
     def get_all_api_config(self, conversation):
         return conversation.config.get('http_api_nostream', {})
@@ -298,8 +413,56 @@ class NoStreamingHTTPWorker(GoApplicationWorker):
                 "push_event_url not configured for conversation: %s" % (
                     conversation.key))
             return
+        if self.get_api_config(conversation, 'batch_events', False):
+            return self.push_batched_event(
+                conversation.user_account.key, push_url, event)
         return self.push(conversation.user_account.key, push_url, event)
 
+    def push_batched_event(self, user_account_key, url, event):
+        """
+        Add an event to the batch for a URL, which is pushed as a JSON list
+        when it is full or has been waiting for `event_batch_interval`.
+
+        Returns a deferred that fires when the event's batch has been pushed.
+        """
+        batch_key = (user_account_key, url)
+        batch = self._event_batches.get(batch_key)
+        if batch is None:
+            batch = self._event_batches[batch_key] = {
+                'events': [],
+                'waiters': [],
+                'timer': self.push_client.clock.callLater(
+                    self.event_batch_interval,
+                    self.flush_event_batch, batch_key),
+            }
+        d = Deferred()
+        batch['events'].append(event)
+        batch['waiters'].append(d)
+        if len(batch['events']) >= self.event_batch_size:
+            self.flush_event_batch(batch_key)
+        return d
+
+    def flush_event_batch(self, batch_key):
+        batch = self._event_batches.pop(batch_key, None)
+        if batch is None:
+            return succeed(None)
+        if batch['timer'].active():
+            batch['timer'].cancel()
+        user_account_key, url = batch_key
+        data = '[%s]' % (
+            ','.join(event.to_json() for event in batch['events']),)
+        d = self.push_data(user_account_key, url, data.encode('utf-8'))
+
+        def notify_waiters(result):
+            for waiter in batch['waiters']:
+                waiter.callback(None)
+
+        def notify_waiters_failed(failure):
+            for waiter in batch['waiters']:
+                waiter.errback(failure)
+
+        return d.addCallbacks(notify_waiters, notify_waiters_failed)
+
     @inlineCallbacks
     def schedule_push_retry(self, user_account_key, url, method, data,
                             headers):
@@ -322,8 +485,8 @@ class NoStreamingHTTPWorker(GoApplicationWorker):
             },
         }).encode('utf-8')
         try:
-            resp = yield http_request_full(
-                retry_url, data=retry_data, headers=retry_headers,
+            resp = yield self.push_client.post(
+                retry_url, retry_data, retry_headers,
                 timeout=self.http_retry_timeout)
             if resp.code == 429:
                 log.warning(
@@ -358,16 +521,17 @@ class NoStreamingHTTPWorker(GoApplicationWorker):
                 base64.b64encode('%s:%s' % (username, password)),)
         return headers
 
-    @inlineCallbacks
     def push(self, user_account_key, url, vumi_message):
         data = vumi_message.to_json().encode('utf-8')
+        return self.push_data(user_account_key, url, data)
+
+    @inlineCallbacks
+    def push_data(self, user_account_key, url, data):
         auth, url = extract_auth_from_url(url.encode('utf-8'))
         headers = self._push_headers(auth=auth)
         retry_required = True
         try:
-            resp = yield http_request_full(
-                url, data=data, headers=headers,
-                timeout=self.http_request_timeout)
+            resp = yield self.push_client.post(url, data, headers)
         except Exception as err:
             log.warning('%s pushing message to %s (%r)'
                         % (err.__class__.__name__, url, err))
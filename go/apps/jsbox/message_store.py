@@ -12,6 +12,8 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vxsandbox import SandboxResource
 
+from go.vumitools.conversation.utils import ConversationWrapper
+
 
 def conversation_owner(func):
     @wraps(func)
@@ -42,6 +44,22 @@ class MessageStoreResource(SandboxResource):
         user_api = self.get_user_api(api)
         return user_api.get_wrapped_conversation(conversation_key)
 
+    def parse_throughput_args(self, command):
+        """
+        Return the `(sample_time, resolution)` for a throughput command.
+        `resolution` is `None` if no series was asked for. Raises
+        :class:`ValueError` if either is invalid.
+        """
+        sample_time = int(command.get('sample_time', 300))
+        if sample_time <= 0:
+            raise ValueError("sample_time must be positive")
+        resolution = command.get('resolution')
+        if resolution is not None:
+            resolution = int(resolution)
+            ConversationWrapper.check_throughput_series_args(
+                sample_time, resolution)
+        return sample_time, resolution
+
     @conversation_owner
     @inlineCallbacks
     def handle_progress_status(self, conversation, api, command):
@@ -203,21 +221,37 @@ class MessageStoreResource(SandboxResource):
               conversation is used.
             - ``sample_time``: How far to look back to calculate the
               throughput. Defaults to 300 seconds (5 minutes)
+            - ``resolution``: If specified, the sample time is also split
+              into windows of this many seconds and the throughput for
+              each window is returned in ``throughput_series``. This is
+              optional. The sample time may be split into at most 1440
+              windows.
 
 
         Success reply fields:
             - ``success``: set to ``true``
             - ``throughput``: how many inbound messages per minute the
               conversation has done on average.
+            - ``throughput_series``: how many inbound messages per minute
+              the conversation has done in each window, oldest first.
+              Only included if ``resolution`` is specified.
 
         Failure reply fields:
             - ``success``: set to ``false``
             - ``reason``: Reason for the failure.
 
         """
-        sample_time = int(command.get('sample_time', 300))
+        try:
+            sample_time, resolution = self.parse_throughput_args(command)
+        except (TypeError, ValueError) as e:
+            returnValue(self.reply(command, success=False, reason=str(e)))
         throughput = yield conversation.get_inbound_throughput(sample_time)
-        returnValue(self.reply(command, success=True, throughput=throughput))
+        reply_fields = {'throughput': throughput}
+        if resolution is not None:
+            reply_fields['throughput_series'] = (
+                yield conversation.get_inbound_throughput_series(
+                    sample_time, resolution))
+        returnValue(self.reply(command, success=True, **reply_fields))
 
     @conversation_owner
     @inlineCallbacks
@@ -234,18 +268,34 @@ class MessageStoreResource(SandboxResource):
               conversation is used.
             - ``sample_time``: How far to look back to calculate the
               throughput. Defaults to 300 seconds (5 minutes)
+            - ``resolution``: If specified, the sample time is also split
+              into windows of this many seconds and the throughput for
+              each window is returned in ``throughput_series``. This is
+              optional. The sample time may be split into at most 1440
+              windows.
 
 
         Success reply fields:
             - ``success``: set to ``true``
             - ``throughput``: how many outbound messages per minute the
               conversation has done on average.
+            - ``throughput_series``: how many outbound messages per minute
+              the conversation has done in each window, oldest first.
+              Only included if ``resolution`` is specified.
 
         Failure reply fields:
             - ``success``: set to ``false``
             - ``reason``: Reason for the failure.
 
         """
-        sample_time = int(command.get('sample_time', 300))
+        try:
+            sample_time, resolution = self.parse_throughput_args(command)
+        except (TypeError, ValueError) as e:
+            returnValue(self.reply(command, success=False, reason=str(e)))
         throughput = yield conversation.get_outbound_throughput(sample_time)
-        returnValue(self.reply(command, success=True, throughput=throughput))
+        reply_fields = {'throughput': throughput}
+        if resolution is not None:
+            reply_fields['throughput_series'] = (
+                yield conversation.get_outbound_throughput_series(
+                    sample_time, resolution))
+        returnValue(self.reply(command, success=True, **reply_fields))
@@ -107,6 +107,49 @@ class TestMessageStoreResource(ResourceTestCaseBase):
         self.assertTrue(reply['success'])
         self.assertEqual(reply['throughput'], 1)
 
+    @inlineCallbacks
+    def test_handle_inbound_throughput_series(self):
+        reply = yield self.dispatch_command('inbound_throughput',
+                                            sample_time=60, resolution=30)
+        self.assertTrue(reply['success'])
+        self.assertEqual(reply['throughput'], 1)
+        self.assertEqual(reply['throughput_series'], [0, 2])
+
+    @inlineCallbacks
+    def test_handle_outbound_throughput_series(self):
+        reply = yield self.dispatch_command('outbound_throughput',
+                                            sample_time=60, resolution=30)
+        self.assertTrue(reply['success'])
+        self.assertEqual(reply['throughput'], 1)
+        self.assertEqual(reply['throughput_series'], [0, 2])
+
+    @inlineCallbacks
+    def test_handle_throughput_invalid_resolution(self):
+        reply = yield self.dispatch_command('inbound_throughput',
+                                            sample_time=60, resolution=0)
+        self.assertFalse(reply['success'])
+        self.assertEqual(reply['reason'], 'resolution must be positive')
+        reply = yield self.dispatch_command('outbound_throughput',
+                                            sample_time=60, resolution=-30)
+        self.assertFalse(reply['success'])
+        self.assertEqual(reply['reason'], 'resolution must be positive')
+
+    @inlineCallbacks
+    def test_handle_throughput_invalid_sample_time(self):
+        reply = yield self.dispatch_command('inbound_throughput',
+                                            sample_time=0)
+        self.assertFalse(reply['success'])
+        self.assertEqual(reply['reason'], 'sample_time must be positive')
+
+    @inlineCallbacks
+    def test_handle_throughput_too_many_windows(self):
+        reply = yield self.dispatch_command('outbound_throughput',
+                                            sample_time=86400, resolution=1)
+        self.assertFalse(reply['success'])
+        self.assertEqual(
+            reply['reason'],
+            'sample_time may be split into at most 1440 windows')
+
     @inlineCallbacks
     def test_invalid_conversation_key(self):
         reply = yield self.dispatch_command('progress_status',
@@ -4,7 +4,9 @@ import pkg_resources
 
 import mock
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, DeferredSemaphore
+from twisted.internet.task import deferLater
 
 from vxsandbox import JsSandbox
 from vxsandbox.resources import SandboxCommand
@@ -164,6 +166,84 @@ class TestJsBoxApplication(VumiTestCase):
         self.assertEqual(msg1['from_addr'], contact1.twitter_handle)
         self.assertEqual(msg2['from_addr'], contact2.twitter_handle)
 
+    @inlineCallbacks
+    def test_send_jsbox_command_resume(self):
+        """
+        If a send_jsbox command is interrupted and reprocessed, we skip the
+        contacts we've already sent to.
+        """
+        group = yield self.app_helper.create_group(u'group')
+        contacts = []
+        for i in range(3):
+            contact = yield self.app_helper.create_contact(
+                msisdn=u'+27%s' % (i,), name=u'a', surname=u'a',
+                groups=[group])
+            contacts.append(contact)
+        contacts.sort(key=lambda c: c.key)
+
+        config = self.mk_conv_config(
+            app=self.APPS['cmd'] % {'method': 'on_inbound_message'})
+        conv = yield self.setup_conversation(config=config, groups=[group])
+        yield self.app_helper.start_conversation(conv)
+
+        cmd_id = 'cmd-1'
+        yield self.app.set_send_progress(conv, cmd_id, contacts[0].key)
+
+        with LogCatcher(message='msg') as lc:
+            yield self.app_helper.dispatch_command(
+                "send_jsbox",
+                command_id=cmd_id,
+                user_account_key=conv.user_account.key,
+                conversation_key=conv.key,
+                batch_id=conv.batch.key)
+            from_addrs = sorted(
+                json.loads(m)['msg']['from_addr'] for m in lc.messages())
+
+        self.assertEqual(
+            from_addrs, sorted(c.msisdn for c in contacts[1:]))
+        progress = yield self.app.get_send_progress(conv, cmd_id)
+        self.assertEqual(progress, None)
+
+    @inlineCallbacks
+    def test_send_inbound_push_triggers_concurrency(self):
+        """
+        Push triggers for a bunch of contacts run concurrently, up to the
+        semaphore's limit, and we publish throughput metrics.
+        """
+        group = yield self.app_helper.create_group(u'group')
+        contacts = []
+        for i in range(5):
+            contact = yield self.app_helper.create_contact(
+                msisdn=u'+27%s' % (i,), name=u'a', surname=u'a',
+                groups=[group])
+            contacts.append(contact)
+        conv = yield self.setup_conversation(groups=[group])
+
+        running = []
+        max_running = []
+        triggered = []
+
+        def send_inbound_push_trigger(to_addr, conversation):
+            triggered.append(to_addr)
+            running.append(to_addr)
+            max_running.append(len(running))
+            return deferLater(reactor, 0, running.remove, to_addr)
+        self.patch(
+            self.app, 'send_inbound_push_trigger', send_inbound_push_trigger)
+
+        published = []
+        self.patch(
+            self.app, 'publish_send_jsbox_metrics',
+            lambda conv, triggers, elapsed: published.append(triggers))
+
+        yield self.app.send_inbound_push_triggers(
+            conv, contacts, None, DeferredSemaphore(2))
+
+        self.assertEqual(
+            sorted(triggered), sorted(c.msisdn for c in contacts))
+        self.assertEqual(max(max_running), 2)
+        self.assertEqual(published, [5])
+
     @inlineCallbacks
     def test_send_jsbox_command_bad_config(self):
         group = yield self.app_helper.create_group(u'group')
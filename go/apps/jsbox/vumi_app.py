@@ -5,17 +5,21 @@
 
 import logging
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, gatherResults, DeferredSemaphore)
 
 from vxsandbox import JsSandbox, SandboxResource
 
-from vumi.config import ConfigDict
+from vumi.blinkenlights.metrics import Metric, AVG, SUM
+from vumi.config import ConfigDict, ConfigInt
 from vumi import log
 
 from go.apps.jsbox.outbound import mk_inbound_push_trigger
 from go.apps.jsbox.utils import jsbox_config_value, jsbox_js_config
 from go.vumitools.app_worker import (
     GoApplicationMixin, GoApplicationConfigMixin)
+from go.vumitools.contact_send import ContactSendMixin
 
 
 class ConversationConfigResource(SandboxResource):
@@ -35,6 +39,10 @@ class JsBoxConfig(JsSandbox.CONFIG_CLASS, GoApplicationConfigMixin):
         "Custom configuration passed to the javascript code.", default={})
     jsbox = ConfigDict(
         "Must have 'javascript' field containing JavaScript code to run.")
+    send_jsbox_concurrency = ConfigInt(
+        "Maximum number of push triggers to run concurrently when processing "
+        "a send_jsbox command.",
+        default=10, static=True)
 
     @property
     def javascript(self):
@@ -47,7 +55,7 @@ class JsBoxConfig(JsSandbox.CONFIG_CLASS, GoApplicationConfigMixin):
         return self.conversation.user_account.key
 
 
-class JsBoxApplication(GoApplicationMixin, JsSandbox):
+class JsBoxApplication(ContactSendMixin, GoApplicationMixin, JsSandbox):
     """
     Application that processes message in a Node.js Javascript Sandbox.
 
@@ -68,6 +76,7 @@ class JsBoxApplication(GoApplicationMixin, JsSandbox):
     ALLOWED_ENDPOINTS = None
     CONFIG_CLASS = JsBoxConfig
     worker_name = 'jsbox_application'
+    clock = reactor
 
     @inlineCallbacks
     def setup_application(self):
@@ -151,23 +160,66 @@ class JsBoxApplication(GoApplicationMixin, JsSandbox):
                 % (jsbox_config_value(conv.config, 'config'),))
             return
 
+    def publish_send_jsbox_metrics(self, conv, triggers, elapsed):
+        metrics = self.get_conversation_metric_manager(conv)
+        metrics.oneshot(Metric('send_jsbox.triggers', [SUM]), triggers)
+        if elapsed > 0:
+            metrics.oneshot(
+                Metric('send_jsbox.triggers_per_second', [AVG]),
+                triggers / elapsed)
+        metrics.publish_metrics()
+
+    @inlineCallbacks
+    def send_inbound_push_triggers(self, conv, contacts, delivery_class,
+                                   semaphore, opt_outs=None):
+        """
+        Run a push trigger for each opted-in contact in a bunch, with no
+        more concurrent triggers than `semaphore` allows.
+        """
+        to_addrs = yield conv.get_opted_in_contact_addresses(
+            contacts, delivery_class, opt_outs)
+        to_addrs = [to_addr for to_addr in to_addrs if to_addr]
+        start = self.clock.seconds()
+        yield gatherResults([
+            semaphore.run(self.send_inbound_push_trigger, to_addr, conv)
+            for to_addr in to_addrs], consumeErrors=True)
+        self.publish_send_jsbox_metrics(
+            conv, len(to_addrs), self.clock.seconds() - start)
+
     @inlineCallbacks
     def process_command_send_jsbox(self, cmd_id, user_account_key,
                                    conversation_key, batch_id):
+        """
+        Run a push trigger in the sandbox for every contact in every group
+        attached to a conversation.
+
+        Contacts are processed a bunch at a time in contact key order, with
+        up to `send_jsbox_concurrency` triggers running at once. Progress is
+        checkpointed after each bunch, so if this command is interrupted the
+        next time it is processed it will skip the contacts it has already
+        handled.
+        """
         conv = yield self.get_conversation(user_account_key, conversation_key)
+        if conv is None:
+            log.warning("Cannot find conversation '%s' for user '%s'." % (
+                conversation_key, user_account_key))
+            return
+
         js_config = self.get_jsbox_js_config(conv)
         if js_config is None:
             return
         delivery_class = js_config.get('delivery_class')
+        semaphore = DeferredSemaphore(
+            self.get_static_config().send_jsbox_concurrency)
+        opt_outs = conv.get_opt_out_snapshot()
 
-        if conv is None:
-            log.warning("Cannot find conversation '%s' for user '%s'." % (
-                conversation_key, user_account_key))
-            return
+        @inlineCallbacks
+        def send_bunch(contacts):
+            yield self.send_inbound_push_triggers(
+                conv, contacts, delivery_class, semaphore, opt_outs)
+            yield self.set_send_progress(conv, cmd_id, contacts[-1].key)
+
+        yield self.for_each_contact_bunch(conv, cmd_id, send_bunch)
 
-        for contacts in (yield conv.get_opted_in_contact_bunches(
-                delivery_class)):
-            for contact in (yield contacts):
-                to_addr = contact.addr_for(delivery_class)
-                yield self.send_inbound_push_trigger(
-                    to_addr, conv)
+        # All finished, so clear the send progress.
+        yield self.clear_send_progress(conv, cmd_id)
@@ -1,6 +1,6 @@
 """Tests for go.apps.sequential_send.vumi_app"""
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
 from twisted.internet.task import Clock, LoopingCall
 
 from vumi.message import TransportUserMessage
@@ -340,3 +340,93 @@ class TestSequentialSendApplication(VumiTestCase):
             key=lambda m: m['to_addr'])
         self.assertEqual(msg['content'], 'bar')
         self.assertEqual(msg['to_addr'], contact3.msisdn)
+
+    @inlineCallbacks
+    def test_sends_message_index_in_redis(self):
+        """
+        The index of the next message for each contact is stored in Redis
+        rather than on the contact.
+        """
+        group = yield self.app_helper.create_group(u'group')
+        contact = yield self.app_helper.create_contact(
+            u'27831234567', name=u'First', surname=u'Contact', groups=[group])
+
+        conv = yield self.app_helper.create_conversation(config={
+            'schedule': {'recurring': 'daily', 'time': '00:01:40'},
+            'messages': ['foo', 'bar'],
+        }, groups=[group])
+        yield self.app_helper.start_conversation(conv)
+        conv = yield self.app_helper.get_conversation(conv.key)
+
+        yield self.app.send_scheduled_messages(conv)
+        [msg] = self.app_helper.get_dispatched_outbound()
+        self.assertEqual(msg['content'], 'foo')
+
+        indexes = yield self.app.get_message_indexes(conv, [contact])
+        self.assertEqual(indexes, [1])
+        ttl = yield self.app.redis.ttl(self.app._message_index_key(conv))
+        self.assertTrue(0 < ttl <= 90 * 24 * 3600)
+        user_helper = yield self.app_helper.vumi_helper.get_or_create_user()
+        contact = yield user_helper.user_api.contact_store.get_contact_by_key(
+            contact.key)
+        self.assertEqual(
+            contact.extra['scheduled_message_index_%s' % (conv.key,)], None)
+
+    @inlineCallbacks
+    def test_sends_legacy_message_index(self):
+        """
+        Contacts with a message index stored in their extras continue where
+        they left off.
+        """
+        group = yield self.app_helper.create_group(u'group')
+        contact = yield self.app_helper.create_contact(
+            u'27831234567', name=u'First', surname=u'Contact', groups=[group])
+
+        conv = yield self.app_helper.create_conversation(config={
+            'schedule': {'recurring': 'daily', 'time': '00:01:40'},
+            'messages': ['foo', 'bar'],
+        }, groups=[group])
+        yield self.app_helper.start_conversation(conv)
+        conv = yield self.app_helper.get_conversation(conv.key)
+
+        contact.extra['scheduled_message_index_%s' % (conv.key,)] = u'1'
+        yield contact.save()
+
+        yield self.app.send_scheduled_messages(conv)
+        [msg] = self.app_helper.get_dispatched_outbound()
+        self.assertEqual(msg['content'], 'bar')
+
+        # The contact has now been sent everything.
+        yield self.app.send_scheduled_messages(conv)
+        self.assertEqual(len(self.app_helper.get_dispatched_outbound()), 1)
+
+    @inlineCallbacks
+    def test_poll_conversations_concurrency(self):
+        """
+        Conversations are processed concurrently, up to the configured limit.
+        """
+        self.app = yield self.app_helper.get_app_worker(
+            {'poll_concurrency': 2})
+        convs = []
+        for _ in range(3):
+            conv = yield self.app_helper.create_conversation(config={
+                'schedule': {'recurring': 'daily', 'time': '00:01:40'}})
+            yield self.app_helper.start_conversation(conv)
+            convs.append((yield self.app_helper.get_conversation(conv.key)))
+
+        yield self._stub_out_async(*convs)
+        processing = []
+
+        def process_conversation_schedule(then, now, conv):
+            d = Deferred()
+            processing.append(d)
+            return d
+        self.app.process_conversation_schedule = process_conversation_schedule
+
+        poll_d = self.app.poll_conversations()
+        self.assertEqual(len(processing), 2)
+        processing[0].callback(None)
+        self.assertEqual(len(processing), 3)
+        processing[1].callback(None)
+        processing[2].callback(None)
+        yield poll_d
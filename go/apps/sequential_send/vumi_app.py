@@ -3,7 +3,9 @@
 import functools
 import json
 
-from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, DeferredList,
+    DeferredSemaphore)
 from twisted.internet.task import LoopingCall
 
 from vumi import log
@@ -26,6 +28,20 @@ class SequentialSendConfig(GoApplicationWorker.CONFIG_CLASS):
     poll_interval = ConfigInt(
         "Interval between polling watched conversations for scheduled events.",
         default=60, static=True)
+    poll_concurrency = ConfigInt(
+        "Maximum number of conversations to process concurrently when "
+        "polling.",
+        default=10, static=True)
+    send_concurrency = ConfigInt(
+        "Maximum number of messages to send concurrently for each "
+        "conversation.",
+        default=50, static=True)
+    message_index_expiry = ConfigInt(
+        "Time (in seconds) to keep a conversation's message indexes after its"
+        " schedule last fired. Contacts without an index start again from"
+        " the first message, so this should be longer than the longest gap"
+        " between scheduled sends. Defaults to 90 days.",
+        default=90 * 24 * 3600, static=True)
 
     schedule = ConfigDict("Scheduler config.")
     messages = ConfigList("List of messages to send in sequence")
@@ -46,6 +62,13 @@ class SequentialSendApplication(GoApplicationWorker):
     each conversation it's watching. Any conversations that are scheduled to
     send between the last poll time and the current time are processed
     accordingly.
+
+    The index of the next message to send to each contact is kept in a Redis
+    hash per conversation. Older versions stored it in the contact's `extra`
+    field, which is still used for contacts that have no index in Redis.
+    The hash expires `message_index_expiry` seconds after the conversation's
+    schedule last fired, so it doesn't outlive stopped and archived
+    conversations forever.
     """
 
     CONFIG_CLASS = SequentialSendConfig
@@ -113,9 +136,11 @@ class SequentialSendApplication(GoApplicationWorker):
             [json.loads(c) for c in conv_jsons])
         log.debug("Processing %s to %s: %s" % (
             then, now, [c.key for c in conversations]))
-        for conv in conversations:
-            if conv.active():
-                yield self.process_conversation_schedule(then, now, conv)
+        semaphore = DeferredSemaphore(
+            self.get_static_config().poll_concurrency)
+        yield gatherResults([
+            semaphore.run(self.process_conversation_schedule, then, now, conv)
+            for conv in conversations if conv.active()])
 
     @catch_and_log_errors
     @inlineCallbacks
@@ -127,6 +152,61 @@ class SequentialSendApplication(GoApplicationWorker):
                 ' account %s' % (conv.key, conv.user_account.key))
             yield self.send_scheduled_messages(conv)
 
+    def _message_index_key(self, conv):
+        return 'message_index:%s' % (conv.key,)
+
+    @inlineCallbacks
+    def get_message_indexes(self, conv, contacts):
+        """
+        Get the index of the next message to send to each contact.
+        """
+        key = self._message_index_key(conv)
+        extra_key = 'scheduled_message_index_%s' % (conv.key,)
+        indexes = yield gatherResults([
+            self.redis.hget(key, contact.key) for contact in contacts])
+        returnValue([
+            int(index if index is not None else
+                (contact.extra[extra_key] or '0'))
+            for contact, index in zip(contacts, indexes)])
+
+    def set_message_indexes(self, conv, indexes):
+        """
+        Set the index of the next message to send for each contact key in
+        `indexes`.
+        """
+        key = self._message_index_key(conv)
+        return gatherResults([
+            self.redis.hmset(key, dict(
+                (contact_key, str(index))
+                for contact_key, index in indexes.iteritems())),
+            self.refresh_message_indexes(conv),
+        ])
+
+    def refresh_message_indexes(self, conv):
+        """
+        Push back the expiry of a conversation's message indexes.
+        """
+        return self.redis.expire(
+            self._message_index_key(conv),
+            self.get_static_config().message_index_expiry)
+
+    @inlineCallbacks
+    def send_scheduled_message(self, conv, contact, message, message_options):
+        """
+        Send a message to a contact.
+
+        :returns: ``True`` if the message was sent, ``False`` otherwise.
+        """
+        to_addr = contact.addr_for(conv.delivery_class)
+        if not to_addr:
+            log.info("No suitable address found for contact %s %r" % (
+                contact.key, contact,))
+            returnValue(False)
+
+        yield self.send_to(
+            to_addr, message, endpoint='default', **message_options)
+        returnValue(True)
+
     @inlineCallbacks
     def send_scheduled_messages(self, conv):
         config = self.get_config_for_conversation(conv)
@@ -134,28 +214,42 @@ class SequentialSendApplication(GoApplicationWorker):
         message_options = {}
         conv.set_go_helper_metadata(
             message_options.setdefault('helper_metadata', {}))
-
-        for contacts in (yield conv.get_opted_in_contact_bunches(
-                conv.delivery_class)):
-            for contact in (yield contacts):
-                index_key = 'scheduled_message_index_%s' % (conv.key,)
-                message_index = int(contact.extra[index_key] or '0')
-                if message_index >= len(messages):
-                    # We have nothing more to send to this person.
-                    continue
-
-                to_addr = contact.addr_for(conv.delivery_class)
-                if not to_addr:
-                    log.info("No suitable address found for contact %s %r" % (
-                        contact.key, contact,))
-                    continue
-
-                yield self.send_to(
-                    to_addr, messages[message_index], endpoint='default',
-                    **message_options)
-
-                contact.extra[index_key] = u'%s' % (message_index + 1)
-                yield contact.save()
+        semaphore = DeferredSemaphore(
+            self.get_static_config().send_concurrency)
+        # Contacts that have been sent everything won't have their indexes
+        # written again, so we keep them alive here.
+        yield self.refresh_message_indexes(conv)
+
+        bunches = yield conv.get_opted_in_contact_bunches(conv.delivery_class)
+        # We start loading each bunch of contacts before we send to the
+        # previous one.
+        next_bunch = next(bunches, None)
+        while next_bunch is not None:
+            bunch, next_bunch = next_bunch, next(bunches, None)
+            contacts = yield bunch
+            message_indexes = yield self.get_message_indexes(conv, contacts)
+            # We have nothing more to send to contacts who have already been
+            # sent all the messages.
+            pending = [
+                (contact, message_index)
+                for contact, message_index in zip(contacts, message_indexes)
+                if message_index < len(messages)]
+            results = yield DeferredList([
+                semaphore.run(
+                    self.send_scheduled_message, conv, contact,
+                    messages[message_index], message_options)
+                for contact, message_index in pending], consumeErrors=True)
+            # We record progress for the messages we sent before we raise
+            # any errors, so we don't send them again next time.
+            new_indexes = dict(
+                (contact.key, message_index + 1)
+                for (contact, message_index), (success, was_sent)
+                in zip(pending, results) if success and was_sent)
+            if new_indexes:
+                yield self.set_message_indexes(conv, new_indexes)
+            for success, result in results:
+                if not success:
+                    result.raiseException()
 
     @inlineCallbacks
     def process_command_start(self, cmd_id, user_account_key,
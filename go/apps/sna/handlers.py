@@ -15,7 +15,8 @@ class SNAEventHandler(EventHandler):
     @inlineCallbacks
     def find_contact(self, account_key, msisdn):
         contact_store = ContactStore(
-            self.dispatcher.vumi_api.manager, account_key)
+            self.dispatcher.vumi_api.manager, account_key,
+            redis=self.dispatcher.vumi_api.redis)
         try:
             contact = yield contact_store.contact_for_addr('ussd', msisdn)
             returnValue(contact)
@@ -4,7 +4,8 @@ import math
 from decimal import Decimal
 
 from twisted.python import log
-from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.internet import defer, reactor
 from twisted.internet.threads import deferToThread
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
@@ -91,11 +92,157 @@ class BaseResource(Resource):
         return None
 
 
+class MessageCostIndex(object):
+    """
+    In-memory index of the message cost table.
+
+    Resolves message costs with the same precedence as the database query
+    used by :meth:`TransactionResource.get_cost_row`: account specific costs
+    before fallback costs, then tag pool specific costs before fallback costs,
+    then provider specific costs before fallback costs.
+    """
+
+    KEY_FIELDS = (
+        'account_number', 'tag_pool_name', 'provider', 'message_direction')
+
+    def __init__(self, rows):
+        self._costs = {}
+        for row in rows:
+            self._costs.setdefault(tuple(pluck(row, self.KEY_FIELDS)), row)
+
+    def __len__(self):
+        return len(self._costs)
+
+    def lookup(self, account_number, tag_pool_name, provider,
+               message_direction):
+        """Return the most specific cost row for a message, or ``None``"""
+        for account_key in (account_number, None):
+            for tag_pool_key in (tag_pool_name, None):
+                for provider_key in (provider, None):
+                    row = self._costs.get((
+                        account_key, tag_pool_key, provider_key,
+                        message_direction))
+                    if row is not None:
+                        return row
+        return None
+
+
+class MessageCostCache(object):
+    """
+    Keeps a :class:`MessageCostIndex` of the message cost table.
+
+    The index is loaded on first use and reloaded when it is older than
+    ``ttl`` seconds or has been invalidated, either by calling
+    :meth:`invalidate` or by a change notification from the database. Each
+    invalidation increments :attr:`version` and a load that was in progress
+    during an invalidation is retried.
+    """
+
+    QUERY = """
+        SELECT a.account_number, t.name AS tag_pool_name,
+               c.provider, c.message_direction,
+               c.message_cost, c.storage_cost, c.session_cost,
+               c.session_unit_time, c.session_unit_cost,
+               c.markup_percent
+        FROM billing_messagecost c
+        LEFT OUTER JOIN billing_tagpool t ON (c.tag_pool_id = t.id)
+        LEFT OUTER JOIN billing_account a ON (c.account_id = a.id)
+    """
+
+    def __init__(self, reactor, connection_pool, ttl):
+        self._reactor = reactor
+        self._connection_pool = connection_pool
+        self._ttl = ttl
+        self._index = None
+        self._loaded_at = None
+        self._waiters = []
+        self._listener = None
+        self.version = 0
+
+    def invalidate(self):
+        """Discard the current index"""
+        self.version += 1
+        self._index = None
+
+    def listen(self, connection_string):
+        """
+        Invalidate the index whenever the message cost table changes.
+
+        Change notifications are received on a dedicated connection rather
+        than one of the pool's, and we LISTEN again (and invalidate the
+        index, since we may have missed notifications) whenever that
+        connection is re-established.
+
+        Returns a deferred that fires once we're listening.
+        """
+        detector = DeadConnectionDetector(
+            reconnectedCallback=self._listener_reconnected)
+        self._listener = self._make_listener(detector)
+        self._listener.addNotifyObserver(self._notified)
+        d = self._listener.connect(connection_string)
+        return d.addCallback(lambda _: self._listen())
+
+    def stop_listening(self):
+        """Close the connection used for change notifications."""
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def _make_listener(self, detector):
+        return DictRowConnection(detector=detector)
+
+    def _listen(self):
+        return self._listener.runOperation(
+            "LISTEN %s" % (app_settings.MESSAGE_COST_NOTIFY_CHANNEL,))
+
+    def _listener_reconnected(self, _result=None):
+        self.invalidate()
+        d = self._listen()
+        d.addErrback(log.err, "Failed to LISTEN for message cost changes.")
+        return d
+
+    def _notified(self, notify):
+        if notify.channel == app_settings.MESSAGE_COST_NOTIFY_CHANNEL:
+            self.invalidate()
+
+    def get_index(self):
+        """Return a deferred that fires with an up to date index"""
+        if (self._index is not None and
+                self._reactor.seconds() - self._loaded_at >= self._ttl):
+            self._index = None
+        if self._index is not None:
+            return defer.succeed(self._index)
+
+        d = defer.Deferred()
+        self._waiters.append(d)
+        if len(self._waiters) == 1:
+            self._load()
+        return d
+
+    @defer.inlineCallbacks
+    def _load(self):
+        version = None
+        try:
+            while version != self.version:
+                version = self.version
+                rows = yield self._connection_pool.runQuery(self.QUERY)
+        except Exception:
+            failure = Failure()
+            waiters, self._waiters = self._waiters, []
+            for d in waiters:
+                d.errback(failure)
+            return
+
+        self._index = MessageCostIndex(rows)
+        self._loaded_at = self._reactor.seconds()
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(self._index)
+
+
 class TransactionResource(BaseResource):
     """Expose a REST interface for a transaction"""
 
-    isLeaf = True
-
     FIELDS = (
         'account_number', 'message_id', 'tag_pool_name',
         'tag_name', 'provider', 'message_direction',
@@ -105,8 +252,27 @@ class TransactionResource(BaseResource):
     NULLABLE_FIELDS = ('provider', 'session_length')
     NON_NULLABLE_FIELDS = tuple(set(FIELDS) - set(NULLABLE_FIELDS))
 
-    def __init__(self, connection_pool):
+    COST_FIELDS = (
+        'account_number', 'tag_pool_name', 'provider', 'message_direction')
+
+    TRANSACTION_COLUMNS = (
+        'account_number', 'message_id', 'transaction_type',
+        'tag_pool_name', 'tag_name',
+        'provider', 'message_direction',
+        'message_cost', 'storage_cost', 'session_cost',
+        'session_unit_cost', 'session_length_cost',
+        'session_created', 'markup_percent',
+        'message_credits', 'storage_credits', 'session_credits',
+        'session_length_credits',
+        'credit_factor', 'credit_amount',
+        'session_unit_time', 'session_length')
+
+    RETURNING_COLUMNS = (
+        ('id',) + TRANSACTION_COLUMNS + ('status', 'created', 'last_modified'))
+
+    def __init__(self, connection_pool, cost_cache=None):
         BaseResource.__init__(self, connection_pool)
+        self._cost_cache = cost_cache
         self._notification_mapping = self._create_notification_mapping()
 
     def _create_notification_mapping(self):
@@ -147,8 +313,15 @@ class TransactionResource(BaseResource):
 
         return NOT_DONE_YET
 
+    def getChild(self, name, request):
+        if name == '':
+            return self
+        return BaseResource.getChild(self, name, request)
+
     def _parse_post(self, request):
-        data = self._parse_json(request) or {}
+        return self._parse_transaction(self._parse_json(request) or {})
+
+    def _parse_transaction(self, data):
         data = dict((k, data.get(k)) for k in self.FIELDS)
 
         if any(data[k] is None for k in self.NON_NULLABLE_FIELDS):
@@ -160,6 +333,22 @@ class TransactionResource(BaseResource):
     def get_cost(self, account_number, tag_pool_name, provider,
                  message_direction, session_created, session_length):
         """Return the message cost"""
+        message_cost = yield self.get_cost_row(
+            account_number, tag_pool_name, provider, message_direction)
+        if message_cost is not None:
+            message_cost = self._price_message(
+                message_cost, session_created, session_length)
+        defer.returnValue(message_cost)
+
+    @defer.inlineCallbacks
+    def get_cost_row(self, account_number, tag_pool_name, provider,
+                     message_direction):
+        """Return the most specific ``MessageCost`` row for a message"""
+        if self._cost_cache is not None:
+            index = yield self._cost_cache.get_index()
+            defer.returnValue(index.lookup(
+                account_number, tag_pool_name, provider, message_direction))
+
         query = """
             SELECT t.account_number, t.tag_pool_name,
                    t.provider, t.message_direction,
@@ -200,45 +389,36 @@ class TransactionResource(BaseResource):
 
         result = yield self._connection_pool.runQuery(query, params)
         if len(result) > 0:
-            message_cost = result[0]
-            message_cost['credit_amount'] = MessageCost.calculate_credit_cost(
-                message_cost=message_cost['message_cost'],
-                storage_cost=message_cost['storage_cost'],
-                session_cost=message_cost['session_cost'],
-                session_unit_length=message_cost['session_unit_time'],
-                session_unit_cost=message_cost['session_unit_cost'],
-                session_length=session_length,
-                markup_percent=message_cost['markup_percent'],
-                session_created=session_created)
-
-            defer.returnValue(message_cost)
+            defer.returnValue(result[0])
         else:
             defer.returnValue(None)
 
-    @defer.inlineCallbacks
-    def create_transaction_interaction(self, cursor, account_number,
-                                       message_id, tag_pool_name, tag_name,
-                                       provider, message_direction,
-                                       session_created, session_length,
-                                       transaction_type):
-        """Create a new transaction for the given ``account_number``"""
-        # Get the message cost
-        result = yield self.get_cost(account_number, tag_pool_name, provider,
-                                     message_direction, session_created,
-                                     session_length)
-        if result is None:
-            raise BillingError(
-                "Unable to determine %s message cost for account %s"
-                " and tag pool %s" % (
-                    message_direction, account_number, tag_pool_name))
-
-        message_cost = result.get('message_cost', 0)
-        session_cost = result.get('session_cost', 0)
-        storage_cost = result.get('storage_cost', 0)
-        session_unit_cost = result.get('session_unit_cost', 0)
-        session_unit_time = result.get('session_unit_time', 0)
-        markup_percent = result.get('markup_percent', 0)
-        credit_amount = result.get('credit_amount', 0)
+    def _price_message(self, cost_row, session_created, session_length):
+        """Return a copy of ``cost_row`` with the message's credit amount"""
+        message_cost = dict(cost_row)
+        message_cost['credit_amount'] = MessageCost.calculate_credit_cost(
+            message_cost=message_cost['message_cost'],
+            storage_cost=message_cost['storage_cost'],
+            session_cost=message_cost['session_cost'],
+            session_unit_length=message_cost['session_unit_time'],
+            session_unit_cost=message_cost['session_unit_cost'],
+            session_length=session_length,
+            markup_percent=message_cost['markup_percent'],
+            session_created=session_created)
+        return message_cost
+
+    def _transaction_params(self, cost, account_number, message_id,
+                            tag_pool_name, tag_name, provider,
+                            message_direction, session_created,
+                            session_length, transaction_type):
+        """Return the ``billing_transaction`` values for a priced message"""
+        message_cost = cost.get('message_cost', 0)
+        session_cost = cost.get('session_cost', 0)
+        storage_cost = cost.get('storage_cost', 0)
+        session_unit_cost = cost.get('session_unit_cost', 0)
+        session_unit_time = cost.get('session_unit_time', 0)
+        markup_percent = cost.get('markup_percent', 0)
+        credit_amount = cost.get('credit_amount', 0)
 
         session_len_cost = MessageCost.calculate_session_length_cost(
             session_unit_cost, session_unit_time, session_length)
@@ -255,6 +435,57 @@ class TransactionResource(BaseResource):
         session_len_credits = MessageCost.calculate_session_length_credit_cost(
             session_len_cost, markup_percent)
 
+        return {
+            'account_number': account_number,
+            'message_id': message_id,
+            'transaction_type': transaction_type,
+            'tag_pool_name': tag_pool_name,
+            'tag_name': tag_name,
+            'provider': provider,
+            'message_direction': message_direction,
+            'message_cost': message_cost,
+            'storage_cost': storage_cost,
+            'session_created': session_created,
+            'session_cost': session_cost,
+            'session_unit_cost': session_unit_cost,
+            'session_length_cost': session_len_cost,
+            'markup_percent': markup_percent,
+            'message_credits': message_credits,
+            'storage_credits': storage_credits,
+            'session_credits': session_credits,
+            'session_length_credits': session_len_credits,
+            'credit_factor': app_settings.CREDIT_CONVERSION_FACTOR,
+            'credit_amount': -credit_amount,
+            'session_unit_time': session_unit_time,
+            'session_length': session_length,
+        }
+
+    def _credit_cutoff_reached(self, credit_balance, last_topup_balance):
+        """Return ``True`` if the balance is below the credit cutoff"""
+        if not (app_settings.ENABLE_LOW_CREDIT_CUTOFF and last_topup_balance):
+            return False
+        return (self._ceil_percent(credit_balance, last_topup_balance) <
+                self._notification_mapping[0])
+
+    @defer.inlineCallbacks
+    def create_transaction_interaction(self, cursor, account_number,
+                                       message_id, tag_pool_name, tag_name,
+                                       provider, message_direction,
+                                       session_created, session_length,
+                                       transaction_type):
+        """Create a new transaction for the given ``account_number``"""
+        # Get the message cost
+        cost = yield self.get_cost(account_number, tag_pool_name, provider,
+                                   message_direction, session_created,
+                                   session_length)
+        if cost is None:
+            raise BillingError(
+                "Unable to determine %s message cost for account %s"
+                " and tag pool %s" % (
+                    message_direction, account_number, tag_pool_name))
+
+        credit_amount = cost.get('credit_amount', 0)
+
         query = """SELECT credit_balance, last_topup_balance
                    FROM billing_account
                    WHERE account_number = %(account_number)s"""
@@ -273,16 +504,20 @@ class TransactionResource(BaseResource):
         credit_balance = result.get('credit_balance')
 
         # If the message is outbound and limit is reached, don't charge
-        if (app_settings.ENABLE_LOW_CREDIT_CUTOFF and last_topup_balance and
-                message_direction == MESSAGE_DIRECTION_OUTBOUND):
-            if (self._ceil_percent(credit_balance, last_topup_balance) <
-                    self._notification_mapping[0]):
-                defer.returnValue({
-                    'credit_cutoff_reached': True,
-                    'transaction': None,
-                })
+        if (message_direction == MESSAGE_DIRECTION_OUTBOUND and
+                self._credit_cutoff_reached(
+                    credit_balance, last_topup_balance)):
+            defer.returnValue({
+                'credit_cutoff_reached': True,
+                'transaction': None,
+            })
 
         # Create a new transaction
+        params = self._transaction_params(
+            cost, account_number, message_id, tag_pool_name, tag_name,
+            provider, message_direction, session_created, session_length,
+            transaction_type)
+
         query = """
             INSERT INTO billing_transaction
                 (account_number, message_id, transaction_type,
@@ -321,31 +556,6 @@ class TransactionResource(BaseResource):
                       status, created, last_modified
         """
 
-        params = {
-            'account_number': account_number,
-            'message_id': message_id,
-            'transaction_type': transaction_type,
-            'tag_pool_name': tag_pool_name,
-            'tag_name': tag_name,
-            'provider': provider,
-            'message_direction': message_direction,
-            'message_cost': message_cost,
-            'storage_cost': storage_cost,
-            'session_created': session_created,
-            'session_cost': session_cost,
-            'session_unit_cost': session_unit_cost,
-            'session_length_cost': session_len_cost,
-            'markup_percent': markup_percent,
-            'message_credits': message_credits,
-            'storage_credits': storage_credits,
-            'session_credits': session_credits,
-            'session_length_credits': session_len_credits,
-            'credit_factor': app_settings.CREDIT_CONVERSION_FACTOR,
-            'credit_amount': -credit_amount,
-            'session_unit_time': session_unit_time,
-            'session_length': session_length,
-        }
-
         cursor = yield cursor.execute(query, params)
         transaction = yield cursor.fetchone()
 
@@ -380,19 +590,149 @@ class TransactionResource(BaseResource):
                 credit_balance, credit_amount, last_topup_balance,
                 account_number)
 
-        if app_settings.ENABLE_LOW_CREDIT_CUTOFF and last_topup_balance:
-            if (self._ceil_percent(credit_balance, last_topup_balance) <
-                    self._notification_mapping[0]):
-                defer.returnValue({
-                    'transaction': transaction,
-                    'credit_cutoff_reached': True,
-                })
-
         defer.returnValue({
             'transaction': transaction,
-            'credit_cutoff_reached': False,
+            'credit_cutoff_reached': self._credit_cutoff_reached(
+                credit_balance, last_topup_balance),
         })
 
+    @defer.inlineCallbacks
+    def create_transactions_interaction(self, cursor, transactions):
+        """Create transactions for a batch of messages.
+
+        Each message is priced and checked against the credit cutoff in
+        order, as if it had been sent on its own, but the transactions are
+        inserted with a single multi-row ``INSERT`` and the credit balances
+        of all the accounts involved are updated with a single ``UPDATE``.
+
+        Returns a list with a result for each transaction, in the same
+        order. Each result is either in the form returned by
+        :meth:`create_transaction_interaction` or ``{'error': <message>}``
+        if the transaction couldn't be created.
+        """
+        results = [None] * len(transactions)
+
+        # Look up the cost of each distinct kind of message only once.
+        cost_rows = {}
+        for data in transactions:
+            key = tuple(pluck(data, self.COST_FIELDS))
+            if key not in cost_rows:
+                cost_rows[key] = yield self.get_cost_row(*key)
+
+        accounts = {}
+        account_numbers = tuple(set(
+            data['account_number'] for data in transactions))
+        if account_numbers:
+            query = """SELECT account_number, credit_balance,
+                              last_topup_balance
+                       FROM billing_account
+                       WHERE account_number IN %(account_numbers)s"""
+
+            params = {'account_numbers': account_numbers}
+            cursor = yield cursor.execute(query, params)
+            for row in cursor.fetchall():
+                accounts[row['account_number']] = {
+                    'credit_balance': row['credit_balance'],
+                    'last_topup_balance': row['last_topup_balance'],
+                    'credit_amount': 0,
+                }
+
+        # Price each transaction against the running balance of its account.
+        pending = []
+        charged_accounts = []
+        for i, data in enumerate(transactions):
+            account_number = data['account_number']
+            message_direction = data['message_direction']
+            cost_row = cost_rows[tuple(pluck(data, self.COST_FIELDS))]
+            if cost_row is None:
+                results[i] = {'error': (
+                    "Unable to determine %s message cost for account %s"
+                    " and tag pool %s" % (
+                        message_direction, account_number,
+                        data['tag_pool_name']))}
+                continue
+
+            account = accounts.get(account_number)
+            if account is None:
+                results[i] = {'error': (
+                    "Unable to find billing account %s while checking"
+                    " credit balance. Message was %s to/from tag pool %s." % (
+                        account_number, message_direction,
+                        data['tag_pool_name']))}
+                continue
+
+            last_topup_balance = account['last_topup_balance']
+            if (message_direction == MESSAGE_DIRECTION_OUTBOUND and
+                    self._credit_cutoff_reached(
+                        account['credit_balance'], last_topup_balance)):
+                results[i] = {
+                    'credit_cutoff_reached': True,
+                    'transaction': None,
+                }
+                continue
+
+            cost = self._price_message(
+                cost_row, data['session_created'], data['session_length'])
+            credit_amount = cost.get('credit_amount', 0)
+            account['credit_balance'] -= credit_amount
+            account['credit_amount'] += credit_amount
+            if account_number not in charged_accounts:
+                charged_accounts.append(account_number)
+
+            pending.append((i, self._transaction_params(cost, **data)))
+            results[i] = {
+                'transaction': None,
+                'credit_cutoff_reached': self._credit_cutoff_reached(
+                    account['credit_balance'], last_topup_balance),
+            }
+
+        if not pending:
+            defer.returnValue(results)
+
+        # Create all the new transactions
+        row = "(%s, 'Completed', now(), now())" % (
+            ", ".join(["%s"] * len(self.TRANSACTION_COLUMNS)),)
+        query = """
+            INSERT INTO billing_transaction
+                (%s, status, created, last_modified)
+            VALUES %s
+            RETURNING %s
+        """ % (", ".join(self.TRANSACTION_COLUMNS),
+               ", ".join([row] * len(pending)),
+               ", ".join(self.RETURNING_COLUMNS))
+
+        params = [
+            values[column]
+            for _, values in pending for column in self.TRANSACTION_COLUMNS]
+        cursor = yield cursor.execute(query, params)
+        # Rows are returned in the order they were listed in VALUES.
+        for (i, _), transaction in zip(pending, cursor.fetchall()):
+            results[i]['transaction'] = transaction
+
+        # Update the credit balances of all the accounts charged
+        query = """
+            UPDATE billing_account AS a
+            SET credit_balance = a.credit_balance - v.credit_amount
+            FROM (VALUES %s) AS v (account_number, credit_amount)
+            WHERE a.account_number = v.account_number
+            RETURNING a.account_number, a.credit_balance
+        """ % (", ".join(["(%s, %s::numeric)"] * len(charged_accounts)),)
+
+        params = []
+        for account_number in charged_accounts:
+            params.extend(
+                [account_number, accounts[account_number]['credit_amount']])
+        cursor = yield cursor.execute(query, params)
+
+        if app_settings.ENABLE_LOW_CREDIT_NOTIFICATION:
+            for row in cursor.fetchall():
+                account = accounts[row['account_number']]
+                yield self.check_and_notify_low_credit_threshold(
+                    row['credit_balance'], account['credit_amount'],
+                    account['last_topup_balance'], row['account_number'])
+
+        defer.returnValue(results)
+
     def check_and_notify_low_credit_threshold(
             self, credit_balance, credit_amount, last_topup_balance,
             account_number):
@@ -482,6 +822,64 @@ class TransactionResource(BaseResource):
 
         defer.returnValue(result)
 
+    def create_transactions(self, transactions):
+        """Create a batch of transactions in a single interaction"""
+        return self._connection_pool.runInteraction(
+            self.create_transactions_interaction, transactions)
+
+
+class TransactionBatchResource(TransactionResource):
+    """Expose a REST interface for creating a batch of transactions"""
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        """Handle an HTTP POST request"""
+        transactions = self._parse_batch_post(request)
+
+        if transactions is None:
+            self._handle_bad_request(request)
+        else:
+            d = self.create_transactions(transactions)
+            d.addCallback(lambda results: {'results': results})
+            d.addCallbacks(self._render_to_json, self._handle_error,
+                           callbackArgs=[request], errbackArgs=[request])
+
+        return NOT_DONE_YET
+
+    def _parse_batch_post(self, request):
+        data = self._parse_json(request) or {}
+        if not isinstance(data, dict):
+            return None
+
+        transactions = data.get('transactions')
+        if not isinstance(transactions, list):
+            return None
+
+        if not all(isinstance(t, dict) for t in transactions):
+            return None
+
+        transactions = [self._parse_transaction(t) for t in transactions]
+        if None in transactions:
+            return None
+
+        return transactions
+
+
+class InvalidateMessageCostsResource(Resource):
+    """Discard the billing API's copy of the message cost table"""
+
+    isLeaf = True
+
+    def __init__(self, cost_cache):
+        Resource.__init__(self)
+        self._cost_cache = cost_cache
+
+    def render_POST(self, request):
+        self._cost_cache.invalidate()
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps({'version': self._cost_cache.version})
+
 
 class HealthResource(Resource):
     isLeaf = True
@@ -507,7 +905,19 @@ class Root(BaseResource):
 
     def __init__(self, connection_pool):
         BaseResource.__init__(self, connection_pool)
-        self.putChild('transactions', TransactionResource(connection_pool))
+        self.cost_cache = None
+        if app_settings.MESSAGE_COST_CACHE_TTL > 0:
+            self.cost_cache = MessageCostCache(
+                reactor, connection_pool, app_settings.MESSAGE_COST_CACHE_TTL)
+            message_costs = Resource()
+            message_costs.putChild(
+                'invalidate', InvalidateMessageCostsResource(self.cost_cache))
+            self.putChild('message_costs', message_costs)
+
+        transactions = TransactionResource(connection_pool, self.cost_cache)
+        batch = TransactionBatchResource(connection_pool, self.cost_cache)
+        transactions.putChild('batch', batch)
+        self.putChild('transactions', transactions)
         self.putChild('health', HealthResource(self.health_check))
 
     def getChild(self, name, request):
@@ -542,7 +952,11 @@ def billing_api_resource():
     resource = Root(connection_pool)
     # Tests need to know when we're connected, so stash the deferred on the
     # resource for them to look at.
-    resource._connection_pool_started = connection_pool.start()
+    d = connection_pool.start()
+    if resource.cost_cache is not None:
+        d.addCallback(lambda _: resource.cost_cache.listen(connection_string))
+        d.addCallback(lambda _: connection_pool)
+    resource._connection_pool_started = d
     return resource
 
 
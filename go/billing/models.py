@@ -1,7 +1,7 @@
 from decimal import Decimal, ROUND_CEILING
 
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import connection, models
+from django.db.models.signals import post_delete, post_save
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
@@ -250,6 +250,32 @@ class MessageCost(models.Model):
         return u"%s (%s)" % (self.tag_pool, self.message_direction)
 
 
+def notify_message_cost_changed(sender, **kwargs):
+    """
+    Tell the billing API to reload its copy of the message cost table.
+    """
+    if connection.vendor == 'postgresql':
+        connection.cursor().execute(
+            "NOTIFY %s" % (app_settings.MESSAGE_COST_NOTIFY_CHANNEL,))
+
+
+post_save.connect(
+    notify_message_cost_changed, sender=MessageCost,
+    dispatch_uid='go.billing.models.notify_message_cost_saved')
+
+post_delete.connect(
+    notify_message_cost_changed, sender=MessageCost,
+    dispatch_uid='go.billing.models.notify_message_cost_deleted')
+
+post_save.connect(
+    notify_message_cost_changed, sender=TagPool,
+    dispatch_uid='go.billing.models.notify_tag_pool_saved')
+
+post_delete.connect(
+    notify_message_cost_changed, sender=TagPool,
+    dispatch_uid='go.billing.models.notify_tag_pool_deleted')
+
+
 class Transaction(models.Model):
     """Represents a credit transaction"""
 
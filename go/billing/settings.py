@@ -66,6 +66,15 @@ LOW_CREDIT_NOTIFICATION_SUPPORT_EMAIL = getattr(
 ENABLE_LOW_CREDIT_CUTOFF = getattr(
     settings, 'BILLING_ENABLE_LOW_CREDIT_CUTOFF', False)
 
+# Maximum age (in seconds) of the billing API's in-memory copy of the message
+# cost table. Set to 0 to look up message costs in the database instead.
+MESSAGE_COST_CACHE_TTL = getattr(
+    settings, 'BILLING_MESSAGE_COST_CACHE_TTL', 300)
+
+# PostgreSQL notification channel used to tell the billing API that the
+# message cost table has changed.
+MESSAGE_COST_NOTIFY_CHANNEL = 'billing_messagecost_changed'
+
 PROVIDERS = getattr(settings, 'BILLING_PROVIDERS', {
     'mtn': 'MTN',
     'vodacom': 'Vodacom',
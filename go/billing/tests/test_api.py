@@ -3,7 +3,9 @@ from decimal import Decimal
 
 import mock
 import pytest
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, Deferred)
+from twisted.internet.task import Clock
 from vumi.tests.helpers import VumiTestCase
 
 from go.vumitools.tests.helpers import djangotest_imports
@@ -50,6 +52,8 @@ class BillingApiTestCase(VumiTestCase):
         root = api.billing_api_resource()
         connection_pool = yield root._connection_pool_started
         self.add_cleanup(connection_pool.close)
+        if root.cost_cache is not None:
+            self.add_cleanup(root.cost_cache.stop_listening)
         returnValue(DummySite(root))
 
     @inlineCallbacks
@@ -128,6 +132,185 @@ class TestTransactionNoDatabase(VumiTestCase):
         self.assertEqual(crossed(105, 1, 100), None)
 
 
+class FakeConnectionPool(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def runQuery(self, query, params=None):
+        self.queries.append(query)
+        return succeed(self.rows)
+
+
+class FakeListenerConnection(object):
+
+    def __init__(self):
+        self.connected_to = None
+        self.observers = []
+        self.operations = []
+        self.closed = False
+
+    def connect(self, connection_string):
+        self.connected_to = connection_string
+        return succeed(self)
+
+    def addNotifyObserver(self, observer):
+        self.observers.append(observer)
+
+    def runOperation(self, operation):
+        self.operations.append(operation)
+        return succeed(None)
+
+    def close(self):
+        self.closed = True
+
+
+class TestMessageCostIndex(VumiTestCase):
+
+    def mk_row(self, account_number=None, tag_pool_name=None, provider=None,
+               message_direction='Inbound', message_cost=0):
+        return {
+            'account_number': account_number,
+            'tag_pool_name': tag_pool_name,
+            'provider': provider,
+            'message_direction': message_direction,
+            'message_cost': message_cost,
+        }
+
+    def test_lookup_exact(self):
+        row = self.mk_row('acc1', 'pool1', 'mtn')
+        index = api.MessageCostIndex([row, self.mk_row()])
+        self.assertEqual(index.lookup('acc1', 'pool1', 'mtn', 'Inbound'), row)
+
+    def test_lookup_missing(self):
+        index = api.MessageCostIndex([self.mk_row('acc1', 'pool1')])
+        self.assertEqual(index.lookup('acc2', 'pool1', None, 'Inbound'), None)
+        self.assertEqual(
+            index.lookup('acc1', 'pool1', None, 'Outbound'), None)
+
+    def test_lookup_precedence(self):
+        """
+        Account specific costs win over tag pool specific costs, which win
+        over provider specific costs.
+        """
+        rows = [
+            self.mk_row(None, None, None, message_cost=1),
+            self.mk_row(None, None, 'mtn', message_cost=2),
+            self.mk_row(None, 'pool1', None, message_cost=3),
+            self.mk_row(None, 'pool1', 'mtn', message_cost=4),
+            self.mk_row('acc1', None, None, message_cost=5),
+            self.mk_row('acc1', None, 'mtn', message_cost=6),
+            self.mk_row('acc1', 'pool1', None, message_cost=7),
+        ]
+        index = api.MessageCostIndex(rows)
+
+        def cost(*args):
+            return index.lookup(*args + ('Inbound',))['message_cost']
+
+        self.assertEqual(cost('acc1', 'pool1', 'mtn'), 7)
+        self.assertEqual(cost('acc1', 'pool1', None), 7)
+        self.assertEqual(cost('acc1', 'pool2', 'mtn'), 6)
+        self.assertEqual(cost('acc1', 'pool2', 'vodacom'), 5)
+        self.assertEqual(cost('acc2', 'pool1', 'mtn'), 4)
+        self.assertEqual(cost('acc2', 'pool1', 'vodacom'), 3)
+        self.assertEqual(cost('acc2', 'pool2', 'mtn'), 2)
+        self.assertEqual(cost('acc2', 'pool2', None), 1)
+
+
+class TestMessageCostCache(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = FakeConnectionPool([{
+            'account_number': None,
+            'tag_pool_name': 'pool1',
+            'provider': None,
+            'message_direction': 'Inbound',
+        }])
+        self.cache = api.MessageCostCache(self.clock, self.pool, 60)
+
+    @inlineCallbacks
+    def test_get_index(self):
+        index = yield self.cache.get_index()
+        self.assertEqual(len(index), 1)
+        self.assertEqual(len(self.pool.queries), 1)
+
+        cached_index = yield self.cache.get_index()
+        self.assertTrue(cached_index is index)
+        self.assertEqual(len(self.pool.queries), 1)
+
+    @inlineCallbacks
+    def test_get_index_expired(self):
+        yield self.cache.get_index()
+        self.clock.advance(60)
+        yield self.cache.get_index()
+        self.assertEqual(len(self.pool.queries), 2)
+
+    @inlineCallbacks
+    def test_invalidate(self):
+        yield self.cache.get_index()
+        self.cache.invalidate()
+        self.assertEqual(self.cache.version, 1)
+        yield self.cache.get_index()
+        self.assertEqual(len(self.pool.queries), 2)
+
+    @inlineCallbacks
+    def test_concurrent_loads(self):
+        d = Deferred()
+        self.pool.runQuery = lambda query: d
+        d1 = self.cache.get_index()
+        d2 = self.cache.get_index()
+        d.callback([])
+        index1 = yield d1
+        index2 = yield d2
+        self.assertTrue(index1 is index2)
+
+    @inlineCallbacks
+    def test_invalidate_during_load(self):
+        queries = [Deferred(), Deferred()]
+        self.pool.runQuery = lambda query: queries[0]
+        d = self.cache.get_index()
+        self.cache.invalidate()
+        first_query = queries.pop(0)
+        first_query.callback([])
+        self.assertFalse(d.called)
+        queries[0].callback(self.pool.rows)
+        index = yield d
+        self.assertEqual(len(index), 1)
+
+    def test_change_notification(self):
+        notify = mock.Mock(channel=app_settings.MESSAGE_COST_NOTIFY_CHANNEL)
+        self.cache._notified(notify)
+        self.assertEqual(self.cache.version, 1)
+        self.cache._notified(mock.Mock(channel='other'))
+        self.assertEqual(self.cache.version, 1)
+
+    @inlineCallbacks
+    def test_listen_again_on_reconnect(self):
+        listener = FakeListenerConnection()
+        detectors = []
+
+        def make_listener(detector):
+            detectors.append(detector)
+            return listener
+
+        self.cache._make_listener = make_listener
+        yield self.cache.listen('dbname=billing')
+        self.assertEqual(listener.connected_to, 'dbname=billing')
+        self.assertEqual(listener.observers, [self.cache._notified])
+        listen = "LISTEN %s" % (app_settings.MESSAGE_COST_NOTIFY_CHANNEL,)
+        self.assertEqual(listener.operations, [listen])
+
+        [detector] = detectors
+        yield detector.reconnectedCallback(listener)
+        self.assertEqual(listener.operations, [listen, listen])
+        self.assertEqual(self.cache.version, 1)
+
+        self.cache.stop_listening()
+        self.assertTrue(listener.closed)
+
+
 @pytest.mark.django_db(transaction=True)
 class TestTransaction(BillingApiTestCase):
 
@@ -169,6 +352,37 @@ class TestTransaction(BillingApiTestCase):
         content.update(kwargs)
         return self.call_api(self.web, 'post', 'transactions', content=content)
 
+    def create_api_transactions(self, *transactions):
+        """
+        Create a batch of transaction records via the billing API.
+        """
+        content = []
+        for kwargs in transactions:
+            transaction = {
+                'account_number': self.account.account_number,
+                'message_id': 'msg-id-1',
+                'tag_pool_name': 'pool1',
+                'tag_name': 'tag1',
+                'message_direction': MessageCost.DIRECTION_INBOUND,
+                'session_created': False,
+                'provider': None,
+                'transaction_type': Transaction.TRANSACTION_TYPE_MESSAGE,
+                'session_length': None,
+            }
+            transaction.update(kwargs)
+            content.append(transaction)
+        d = self.call_api(
+            self.web, 'post', 'transactions/batch',
+            content={'transactions': content})
+        return d.addCallback(lambda result: result['results'])
+
+    def invalidate_message_costs(self):
+        """
+        Make the billing API reload message costs without waiting for the
+        change notification from the database.
+        """
+        return self.call_api(self.web, 'post', 'message_costs/invalidate')
+
     def assert_dict(self, dict_obj, **kw):
         for name, value in kw.iteritems():
             self.assertEqual(dict_obj[name], value)
@@ -513,6 +727,7 @@ class TestTransaction(BillingApiTestCase):
             storage_cost=8.0,
             session_cost=7.0,
             markup_percent=11.0)
+        yield self.invalidate_message_costs()
 
         transaction = yield self.create_api_transaction(
             account_number=account.account_number,
@@ -556,6 +771,7 @@ class TestTransaction(BillingApiTestCase):
             storage_cost=0.3,
             session_cost=0.2,
             markup_percent=12.0)
+        yield self.invalidate_message_costs()
 
         transaction = yield self.create_api_transaction(
             account_number=account2.account_number,
@@ -778,3 +994,127 @@ class TestTransaction(BillingApiTestCase):
             session_length_cost=Decimal(0),
             session_length_credits=Decimal(0),
             session_length=None)
+
+    @inlineCallbacks
+    def test_transaction_batch(self):
+        mk_message_cost(
+            tag_pool=self.pool1,
+            message_direction=MessageCost.DIRECTION_INBOUND,
+            message_cost=0.6,
+            markup_percent=10.0)
+
+        mk_message_cost(
+            tag_pool=self.pool1,
+            message_direction=MessageCost.DIRECTION_OUTBOUND,
+            message_cost=0.8,
+            markup_percent=10.0)
+
+        results = yield self.create_api_transactions(
+            {'message_id': 'msg-id-1'},
+            {'message_id': 'msg-id-2',
+             'message_direction': MessageCost.DIRECTION_OUTBOUND},
+            {'message_id': 'msg-id-3',
+             'account_number': self.account2.account_number})
+
+        self.assertEqual(
+            [r['transaction']['message_id'] for r in results],
+            ['msg-id-1', 'msg-id-2', 'msg-id-3'])
+        self.assertEqual(
+            [r['credit_cutoff_reached'] for r in results],
+            [False, False, False])
+
+        for result in results:
+            self.assert_result(
+                result=result,
+                model=Transaction.objects.get(
+                    message_id=result['transaction']['message_id']),
+                account_number=result['transaction']['account_number'],
+                status=Transaction.STATUS_COMPLETED)
+
+        inbound_credits = get_message_credits(0.6, 10.0)
+        outbound_credits = get_message_credits(0.8, 10.0)
+
+        account = Account.objects.get(id=self.account.id)
+        self.assertEqual(
+            account.credit_balance, -(inbound_credits + outbound_credits))
+
+        account2 = Account.objects.get(id=self.account2.id)
+        self.assertEqual(account2.credit_balance, -inbound_credits)
+
+    @inlineCallbacks
+    def test_transaction_batch_errors(self):
+        mk_message_cost(
+            tag_pool=self.pool1,
+            message_direction=MessageCost.DIRECTION_INBOUND,
+            message_cost=0.6)
+
+        results = yield self.create_api_transactions(
+            {'message_id': 'msg-id-1', 'tag_pool_name': 'pool2'},
+            {'message_id': 'msg-id-2', 'account_number': 'unknown-account'},
+            {'message_id': 'msg-id-3'})
+
+        self.assertEqual(results[0], {
+            'error': (
+                "Unable to determine Inbound message cost for account %s"
+                " and tag pool pool2" % (self.account.account_number,))})
+        self.assertEqual(results[1], {
+            'error': (
+                "Unable to find billing account unknown-account while"
+                " checking credit balance. Message was Inbound to/from"
+                " tag pool pool1.")})
+        self.assertEqual(results[2]['transaction']['message_id'], 'msg-id-3')
+        self.assertEqual(
+            [t.message_id for t in Transaction.objects.all()], ['msg-id-3'])
+
+    @inlineCallbacks
+    def test_transaction_batch_credit_cutoff(self):
+        self.patch(app_settings, 'ENABLE_LOW_CREDIT_CUTOFF', True)
+
+        mk_message_cost(
+            tag_pool=self.pool1,
+            message_direction=MessageCost.DIRECTION_OUTBOUND,
+            message_cost=0.4)
+
+        load_account_credits(self.account, 10)
+        self.account.credit_balance = 7
+        self.account.save()
+
+        # Each message costs 4 credits, so the first message takes the
+        # balance below the cutoff and the second isn't charged.
+        results = yield self.create_api_transactions(
+            {'message_id': 'msg-id-1',
+             'message_direction': MessageCost.DIRECTION_OUTBOUND},
+            {'message_id': 'msg-id-2',
+             'message_direction': MessageCost.DIRECTION_OUTBOUND})
+
+        self.assertTrue(results[0]['credit_cutoff_reached'])
+        self.assertTrue(results[0]['transaction'] is not None)
+        self.assertEqual(results[1], {
+            'credit_cutoff_reached': True,
+            'transaction': None,
+        })
+        self.assertEqual(Transaction.objects.count(), 2)
+
+    @inlineCallbacks
+    def test_transaction_batch_invalid(self):
+        response = yield self.web.post(
+            'transactions/batch',
+            headers={'content-type': 'application/json'},
+            content={'transactions': [{'message_id': 'msg-id-1'}]})
+        self.assertEqual(response.responseCode, 400)
+
+    @inlineCallbacks
+    def test_transaction_batch_not_an_object(self):
+        response = yield self.web.post(
+            'transactions/batch',
+            headers={'content-type': 'application/json'},
+            content=[{'message_id': 'msg-id-1'}])
+        self.assertEqual(response.responseCode, 400)
+
+    @inlineCallbacks
+    def test_transaction_batch_transaction_not_an_object(self):
+        response = yield self.web.post(
+            'transactions/batch',
+            headers={'content-type': 'application/json'},
+            content={'transactions': ['msg-id-1']})
+        self.assertEqual(response.responseCode, 400)
@@ -1135,6 +1135,39 @@ class TestConversationViews(BaseConversationViewTestCase):
         self.assertNotContains(r_out, "<td>Sending", html=True)
         self.assertNotContains(r_out, "<td>Rejected", html=True)
 
+    def test_message_list_outbound_status_from_summary(self):
+        self.enable_event_statuses()
+        conv = self.user_helper.create_conversation(u'dummy', started=True)
+        msg = self.msg_helper.make_stored_outbound(conv, "hi")
+        statuses = self.vumi_helper.get_vumi_api().message_event_statuses
+        statuses.backfill(
+            conv.batch.key, msg['message_id'], u'nack:no spoons')
+
+        r_out = self.client.get(
+            self.get_view_url(conv, 'message_list'),
+            {'direction': 'outbound'})
+        self.assertContains(r_out, "<td>Rejected: no spoons", html=True)
+        self.assertNotContains(r_out, "<td>Sending", html=True)
+        self.assertNotContains(r_out, "<td>Accepted", html=True)
+
+    def test_message_list_outbound_status_summary_backfilled(self):
+        self.enable_event_statuses()
+        conv = self.user_helper.create_conversation(u'dummy', started=True)
+        msg = self.msg_helper.make_stored_outbound(conv, "hi")
+        self.msg_helper.make_stored_ack(conv, msg)
+        statuses = self.vumi_helper.get_vumi_api().message_event_statuses
+        self.assertEqual(
+            statuses.get_summaries(conv.batch.key, [msg['message_id']]),
+            [None])
+
+        r_out = self.client.get(
+            self.get_view_url(conv, 'message_list'),
+            {'direction': 'outbound'})
+        self.assertContains(r_out, "<td>Accepted", html=True)
+        self.assertEqual(
+            statuses.get_summaries(conv.batch.key, [msg['message_id']]),
+            [u'ack'])
+
     def test_message_list_with_bad_transport_type_inbound(self):
         # inbound messages could have an unsupported transport_type
         # if the transport sent something we don't yet support
@@ -262,6 +262,7 @@ class MessageListView(ConversationTemplateView):
         direction = request.GET.get('direction', 'inbound')
         page = request.GET.get('p', 1)
         batch_id = conversation.batch.key
+        status_store = conversation.api.message_event_statuses
         form = self.message_download_form
         if form is None:
             form = MessageDownloadForm(initial={
@@ -269,26 +270,42 @@ class MessageListView(ConversationTemplateView):
                 'date_from': datetime.datetime.utcnow(),
             })
 
-        def add_event_status(msg):
-            if not conversation_settings.ENABLE_EVENT_STATUSES_IN_MESSAGE_LIST:
-                msg.event_status = "-"
-                return msg
-            msg.event_status = u"Sending"
+        def get_stored_event_summary(message_id):
+            # Messages sent before we kept status summaries (or whose
+            # summaries have expired) need their events loaded.
             get_event_info = conversation.mdb.message_event_keys_with_statuses
-            for event_id, _, event_type in get_event_info(msg["message_id"]):
-                if event_type == u"ack":
-                    msg.event_status = u"Accepted"
-                    break
-                if event_type == u"nack":
+            for event_id, _, event_type in get_event_info(message_id):
+                if event_type in (u"ack", u"nack"):
                     event = conversation.mdb.get_event(event_id)
-                    msg.event_status = u"Rejected: %s" % (
-                        event["nack_reason"],)
-                    break
-            return msg
+                    return status_store.summary_for_event(event)
+            return None
+
+        def add_event_statuses(msgs):
+            if not conversation_settings.ENABLE_EVENT_STATUSES_IN_MESSAGE_LIST:
+                for msg in msgs:
+                    msg.event_status = "-"
+                return msgs
+            summaries = status_store.get_summaries(
+                batch_id, [msg["message_id"] for msg in msgs])
+            for msg, summary in zip(msgs, summaries):
+                if summary is None:
+                    summary = get_stored_event_summary(msg["message_id"])
+                    if summary is not None:
+                        status_store.backfill(
+                            batch_id, msg["message_id"], summary)
+                status, reason = status_store.parse_summary(
+                    summary or status_store.SENDING)
+                if status == status_store.ACK:
+                    msg.event_status = u"Accepted"
+                elif status == status_store.NACK:
+                    msg.event_status = u"Rejected: %s" % (reason or u"",)
+                else:
+                    msg.event_status = u"Sending"
+            return msgs
 
         def get_sent_messages(start, stop):
-            return [add_event_status(m)
-                    for m in conversation.sent_messages_in_cache(start, stop)]
+            return add_event_statuses(
+                conversation.sent_messages_in_cache(start, stop))
 
         # Paginator starts counting at 1 so 0 would also be invalid
         inbound_message_paginator = Paginator(PagedMessageCache(
@@ -2,8 +2,9 @@ from twisted.internet.defer import inlineCallbacks
 
 from vumi.tests.helpers import VumiTestCase
 
-from go.routers.group.vumi_app import GroupRouter
+from go.routers.group.vumi_app import GroupRouter, GroupRuleIndex
 from go.routers.tests.helpers import RouterWorkerHelper
+from go.vumitools.contact import ContactStore
 
 
 class TestGroupRouter(VumiTestCase):
@@ -97,3 +98,57 @@ class TestGroupRouter(VumiTestCase):
                 for group in groups
             ]})
         yield self.assert_routed_inbound(contact.msisdn, router, 'group2_ep')
+
+    @inlineCallbacks
+    def test_inbound_contact_groups_cached(self):
+        """
+        Contact group memberships are cached until the account's contact
+        groups version changes, which the contact store does whenever a
+        contact's groups change.
+        """
+        group = yield self.router_helper.create_group(u"group")
+        contact = yield self.router_helper.create_contact(u"+27831234567")
+        router = yield self.router_helper.create_router(started=True, config={
+            'rules': [
+                {'group': group.key, 'endpoint': 'group_ep'},
+            ]})
+        yield self.assert_routed_inbound(contact.msisdn, router, 'default')
+
+        # A store without Redis doesn't bump the version, so the cached
+        # memberships are still used.
+        user_helper = yield self.router_helper.vumi_helper.get_or_create_user()
+        user_account = yield user_helper.get_user_account()
+        contact_store = ContactStore.from_user_account(user_account)
+        other_contact = yield contact_store.get_contact_by_key(contact.key)
+        other_contact.add_to_group(group)
+        yield other_contact.save()
+        yield self.assert_routed_inbound(contact.msisdn, router, 'default')
+
+        contact.add_to_group(group)
+        yield contact.save()
+        yield self.assert_routed_inbound(contact.msisdn, router, 'group_ep')
+
+        contact.groups.remove(group)
+        yield contact.save()
+        yield self.assert_routed_inbound(contact.msisdn, router, 'default')
+
+
+class TestGroupRuleIndex(VumiTestCase):
+
+    def test_no_rules(self):
+        rule_index = GroupRuleIndex([])
+        self.assertEqual(rule_index.endpoint_for_groups([]), 'default')
+        self.assertEqual(rule_index.endpoint_for_groups(['g1']), 'default')
+
+    def test_first_matching_rule(self):
+        rule_index = GroupRuleIndex([
+            {'group': 'g1', 'endpoint': 'ep1'},
+            {'group': 'g2', 'endpoint': 'ep2'},
+            {'group': 'g3', 'endpoint': 'ep3'},
+            {'group': 'g2', 'endpoint': 'ep4'},
+        ])
+        self.assertEqual(rule_index.endpoint_for_groups(['g3', 'g2']), 'ep2')
+        self.assertEqual(rule_index.endpoint_for_groups(['g3']), 'ep3')
+        self.assertEqual(
+            rule_index.endpoint_for_groups(['g0', 'g3', 'g1']), 'ep1')
+        self.assertEqual(rule_index.endpoint_for_groups(['g0']), 'default')
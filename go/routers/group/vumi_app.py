@@ -1,9 +1,9 @@
 # -*- test-case-name: go.routers.group.tests.test_vumi_app -*-
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi import log
-from vumi.config import ConfigList
+from vumi.config import ConfigFloat, ConfigInt, ConfigList
 
 from go.vumitools.app_worker import GoRouterWorker
 from go.vumitools.contact import ContactError, ContactNotFoundError
@@ -13,6 +13,39 @@ class GroupRouterConfig(GoRouterWorker.CONFIG_CLASS):
     rules = ConfigList(
         "List of groups and endpoint pairs",
         default=[])
+    contact_group_cache_ttl = ConfigFloat(
+        "TTL (in seconds) for cached contact group memberships. If less than"
+        " or equal to zero, contact groups will not be cached.",
+        static=True, default=300)
+    contact_group_cache_max_entries = ConfigInt(
+        "Maximum number of contact group memberships to cache. The least"
+        " recently used memberships are evicted when the cache is full.",
+        static=True, default=100000)
+
+
+class GroupRuleIndex(object):
+    """
+    Lookup from contact groups to the endpoint of the first matching rule.
+
+    Each group is mapped to the position of the first rule for it, so finding
+    the endpoint for a contact only needs a dict lookup for each of the
+    contact's groups.
+    """
+
+    def __init__(self, rules, default='default'):
+        self.rules = rules
+        self.default = default
+        self.priorities = {}
+        for priority, rule in enumerate(rules):
+            self.priorities.setdefault(
+                rule['group'], (priority, rule['endpoint']))
+
+    def endpoint_for_groups(self, group_keys):
+        matches = [self.priorities[group_key] for group_key in group_keys
+                   if group_key in self.priorities]
+        if not matches:
+            return self.default
+        return min(matches)[1]
 
 
 class GroupRouter(GoRouterWorker):
@@ -23,28 +56,80 @@ class GroupRouter(GoRouterWorker):
 
     worker_name = 'group_router'
 
-    def endpoint_for_contact(self, config, contact):
-        if contact is None:
+    @inlineCallbacks
+    def setup_router(self):
+        yield super(GroupRouter, self).setup_router()
+        config = self.get_static_config()
+        # Rule indexes for each router, rebuilt when the router's rules
+        # change.
+        self.rule_indexes = {}
+        # Contact group memberships are cached by account, contact groups
+        # version, delivery class and address. Bumping the version when
+        # memberships change leaves stale entries to expire or be evicted.
+        self._contact_group_cache = self.make_model_cache(
+            'contact_group_cache', config.contact_group_cache_ttl,
+            config.contact_group_cache_max_entries)
+
+    @inlineCallbacks
+    def teardown_router(self):
+        yield self._contact_group_cache.cleanup()
+        yield super(GroupRouter, self).teardown_router()
+
+    def get_rule_index(self, config):
+        router_key = config.router.key
+        rule_index = self.rule_indexes.get(router_key)
+        if rule_index is None or rule_index.rules != config.rules:
+            rule_index = GroupRuleIndex(config.rules)
+            self.rule_indexes[router_key] = rule_index
+        return rule_index
+
+    def endpoint_for_groups(self, config, group_keys):
+        if group_keys is None:
             return 'default'
-        contact_groups = set(contact.groups.keys())
-        for rule in config.rules:
-            if rule['group'] in contact_groups:
-                return rule['endpoint']
-        return 'default'
+        return self.get_rule_index(config).endpoint_for_groups(group_keys)
+
+    @inlineCallbacks
+    def _fetch_contact_groups(self, cache_key):
+        user_account_key, _version, delivery_class, addr = cache_key
+        user_api = self.get_user_api(user_account_key)
+        try:
+            contact = yield user_api.contact_store.contact_for_addr(
+                delivery_class, addr, create=False)
+        except ContactNotFoundError:
+            returnValue(None)
+        returnValue(frozenset(contact.groups.keys()))
+
+    @inlineCallbacks
+    def get_contact_groups_for_message(self, msg):
+        """
+        Return the keys of the groups the contact that sent `msg` is in, or
+        `None` if there is no such contact.
+        """
+        msg_mdh = self.get_metadata_helper(msg)
+        if not msg_mdh.has_user_account():
+            # If we have no user account we can't look up contacts.
+            returnValue(None)
+
+        user_api = msg_mdh.get_user_api()
+        version = yield user_api.get_contact_groups_version()
+        cache_key = (
+            user_api.user_account_key, version,
+            user_api.delivery_class_for_msg(msg), msg.user())
+        group_keys = yield self._contact_group_cache.get_model(
+            self._fetch_contact_groups, cache_key)
+        returnValue(group_keys)
 
     @inlineCallbacks
     def handle_inbound(self, config, msg, conn_name):
         log.msg("Handling inbound: %s" % (msg,))
 
         try:
-            contact = yield self.get_contact_for_message(msg, create=False)
-        except ContactNotFoundError:
-            contact = None
+            group_keys = yield self.get_contact_groups_for_message(msg)
         except ContactError:
             log.err()
             return
 
-        endpoint = self.endpoint_for_contact(config, contact)
+        endpoint = self.endpoint_for_groups(config, group_keys)
         yield self.publish_inbound(msg, endpoint)
 
     def handle_outbound(self, config, msg, conn_name):
@@ -3,7 +3,7 @@ from twisted.internet.defer import inlineCallbacks
 from vumi.tests.helpers import VumiTestCase
 
 from go.vumitools.routing import RoutingMetadata
-from go.routers.keyword.vumi_app import KeywordRouter
+from go.routers.keyword.vumi_app import KeywordRouter, KeywordMatcher
 from go.routers.tests.helpers import RouterWorkerHelper
 
 
@@ -108,6 +108,64 @@ class TestKeywordRouter(VumiTestCase):
         yield self.assert_routed_inbound(" FoO bar", router, 'app1')
         yield self.assert_routed_inbound(" aBc123 baz", router, 'app2')
 
+    @inlineCallbacks
+    def test_inbound_keyword_regex(self):
+        router = yield self.router_helper.create_router(started=True, config={
+            'keyword_endpoint_mapping': {
+                'foo': 'app1',
+                're:ba[rz]': 'app2',
+            },
+        })
+        yield self.assert_routed_inbound("foo bar", router, 'app1')
+        yield self.assert_routed_inbound("BAR quux", router, 'app2')
+        yield self.assert_routed_inbound("baz quux", router, 'app2')
+        yield self.assert_routed_inbound("bazz quux", router, 'default')
+
+    @inlineCallbacks
+    def test_inbound_keyword_matcher_rebuilt_on_config_change(self):
+        router = yield self.router_helper.create_router(started=True, config={
+            'keyword_endpoint_mapping': {
+                'foo': 'app1',
+            },
+        })
+        yield self.assert_routed_inbound("foo bar", router, 'app1')
+        matcher = self.router_worker.matchers[router.key]
+        yield self.assert_routed_inbound("foo bar", router, 'app1')
+        self.assertEqual(self.router_worker.matchers[router.key], matcher)
+
+        router.config = {'keyword_endpoint_mapping': {'foo': 'app2'}}
+        yield router.save()
+        yield self.assert_routed_inbound("foo bar", router, 'app2')
+        self.assertNotEqual(self.router_worker.matchers[router.key], matcher)
+
+    @inlineCallbacks
+    def test_inbound_keyword_match_metrics(self):
+        self.assertEqual(self.router_worker._match_metrics, None)
+
+        router_helper = self.add_helper(RouterWorkerHelper(KeywordRouter))
+        router_worker = yield router_helper.get_router_worker({
+            'keyword_metrics_prefix': 'go.system.keyword.',
+        })
+        router = yield router_helper.create_router(started=True, config={
+            'keyword_endpoint_mapping': {
+                'foo': 'app1',
+            },
+        })
+        for content in ["foo bar", "FOO", "baz quux"]:
+            yield router_helper.ri.make_dispatch_inbound(
+                content, router=router)
+        metrics = router_worker._match_metrics
+        self.assertEqual(sorted(metrics._metrics_lookup.keys()), [
+            '%s.app1' % (router.key,),
+            '%s.default' % (router.key,),
+        ])
+        self.assertEqual(
+            [v for _, v in metrics['%s.app1' % (router.key,)].poll()],
+            [1.0, 1.0])
+        self.assertEqual(
+            [v for _, v in metrics['%s.default' % (router.key,)].poll()],
+            [1.0])
+
     @inlineCallbacks
     def test_outbound_no_config(self):
         router = yield self.router_helper.create_router(started=True)
@@ -175,3 +233,83 @@ class TestKeywordRouter(VumiTestCase):
             [['app1', 'default'], ['kwr1', 'bar']],
             [['kwr1', 'foo'], ['sphex', 'default']],
         ])
+
+
+class TestKeywordMatcher(VumiTestCase):
+
+    def test_exact(self):
+        matcher = KeywordMatcher({'foo': 'app1', 'abc123': 'app2'})
+        self.assertEqual(matcher.lookup('foo'), 'app1')
+        self.assertEqual(matcher.lookup('FoO'), 'app1')
+        self.assertEqual(matcher.lookup('ABC123'), 'app2')
+        self.assertEqual(matcher.lookup('bar'), 'default')
+        self.assertEqual(matcher.lookup(''), 'default')
+        self.assertEqual(matcher.patterns, [])
+
+    def test_regex(self):
+        matcher = KeywordMatcher({
+            'foo': 'app1',
+            're:ba[rz]': 'app2',
+            're:(sub)?scribe': 'app3',
+        })
+        self.assertEqual(matcher.lookup('foo'), 'app1')
+        self.assertEqual(matcher.lookup('BAR'), 'app2')
+        self.assertEqual(matcher.lookup('baz'), 'app2')
+        self.assertEqual(matcher.lookup('subscribe'), 'app3')
+        self.assertEqual(matcher.lookup('scribe'), 'app3')
+        self.assertEqual(matcher.lookup('bazz'), 'default')
+        self.assertEqual(matcher.lookup('xbar'), 'default')
+
+    def test_metacharacters_are_literal(self):
+        matcher = KeywordMatcher({'help?': 'app1', '1.2': 'app2'})
+        self.assertEqual(matcher.lookup('HELP?'), 'app1')
+        self.assertEqual(matcher.lookup('help'), 'default')
+        self.assertEqual(matcher.lookup('1.2'), 'app2')
+        self.assertEqual(matcher.lookup('1x2'), 'default')
+        self.assertEqual(matcher.patterns, [])
+
+    def test_exact_before_regex(self):
+        matcher = KeywordMatcher({'re:f.o': 'app1', 'foo': 'app2'})
+        self.assertEqual(matcher.lookup('foo'), 'app2')
+        self.assertEqual(matcher.lookup('fxo'), 'app1')
+
+    def test_invalid_regex_is_literal(self):
+        matcher = KeywordMatcher({'re:c++': 'app1'})
+        self.assertEqual(matcher.lookup('RE:C++'), 'app1')
+        self.assertEqual(matcher.lookup('c'), 'default')
+
+    def test_unicode(self):
+        matcher = KeywordMatcher({u'\xc9t\xe9': 'app1', u're:caf.': 'app2'})
+        self.assertEqual(matcher.lookup(u'\xe9T\xc9'), 'app1')
+        self.assertEqual(matcher.lookup(u'CAF\xc9'), 'app2')
+
+    def test_many_regexes(self):
+        mapping = dict(
+            ('re:k(w)%d' % (i,), 'app%d' % (i,)) for i in range(200))
+        matcher = KeywordMatcher(mapping)
+        self.assertTrue(len(matcher.patterns) > 1)
+        for i in range(200):
+            self.assertEqual(matcher.lookup('KW%d' % (i,)), 'app%d' % (i,))
+        self.assertEqual(matcher.lookup('kw200'), 'default')
+
+    def test_backreferences(self):
+        matcher = KeywordMatcher({
+            're:a(b)': 'app1',
+            're:(x)y\\1': 'app2',
+            're:(?P<c>z)(?P=c)': 'app3',
+            're:q(r)': 'app4',
+        })
+        self.assertEqual(len(matcher.patterns), 3)
+        self.assertEqual(matcher.lookup('ab'), 'app1')
+        self.assertEqual(matcher.lookup('xyx'), 'app2')
+        self.assertEqual(matcher.lookup('xy'), 'default')
+        self.assertEqual(matcher.lookup('zz'), 'app3')
+        self.assertEqual(matcher.lookup('qr'), 'app4')
+
+    def test_mapping_copied(self):
+        mapping = {'foo': 'app1', 're:ba[rz]': 'app2'}
+        matcher = KeywordMatcher(mapping)
+        mapping['foo'] = 'app3'
+        self.assertEqual(
+            matcher.mapping, {'foo': 'app1', 're:ba[rz]': 'app2'})
+        self.assertEqual(matcher.lookup('foo'), 'app1')
@@ -1,16 +1,122 @@
 # -*- test-case-name: go.routers.keyword.tests.test_vumi_app -*-
 # -*- coding: utf-8 -*-
 
+import re
+
+from twisted.internet.defer import inlineCallbacks
+
 from vumi import log
-from vumi.config import ConfigDict
+from vumi.blinkenlights.metrics import MetricManager, Count
+from vumi.config import ConfigDict, ConfigText
 
 from go.vumitools.app_worker import GoRouterWorker
 
 
 class KeywordRouterConfig(GoRouterWorker.CONFIG_CLASS):
     keyword_endpoint_mapping = ConfigDict(
-        "Mapping from case-insensitive keyword regex to endpoint name.",
+        "Mapping from case-insensitive keyword to endpoint name. Keywords"
+        " are matched literally unless prefixed with `re:`, in which case"
+        " the rest of the keyword is a regex that must match the whole"
+        " first word.",
         default={})
+    keyword_metrics_prefix = ConfigText(
+        "Prefix for per-router keyword match count metrics, published as"
+        " `<prefix><router_key>.<endpoint>`. If unset, match counts are not"
+        " published.",
+        static=True)
+
+
+class KeywordMatcher(object):
+    """
+    Compiled lookup from the first word of a message to an endpoint.
+
+    Keywords are matched exactly via a dict of lower-cased keywords unless
+    they start with :attr:`REGEX_PREFIX`. Regex keywords are combined into
+    as few case-insensitive alternation patterns as Python's group limit
+    allows and must match the whole first word. Regexes that refer to their
+    own groups (backreferences, named groups or conditionals) can't be
+    combined and are compiled separately. Exact keywords take precedence
+    over regex keywords and regex keywords are tried in sorted order.
+    """
+
+    REGEX_PREFIX = 're:'
+    # Python's re module supports at most 100 groups per pattern.
+    MAX_GROUPS = 99
+    FLAGS = re.IGNORECASE | re.UNICODE
+    GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+    def __init__(self, keyword_endpoint_mapping, default='default'):
+        self.mapping = dict(keyword_endpoint_mapping)
+        self.default = default
+        self.exact = {}
+        self.patterns = []
+        regexes = []
+        for keyword, endpoint in sorted(keyword_endpoint_mapping.items()):
+            regex = self.get_regex(keyword)
+            if regex is not None:
+                regexes.append((regex, endpoint))
+            else:
+                self.exact.setdefault(keyword.lower(), endpoint)
+        self._compile_patterns(regexes)
+
+    @classmethod
+    def get_regex(cls, keyword):
+        """
+        Return the compiled regex for a `re:` keyword, or `None` if the
+        keyword should be matched literally.
+        """
+        if not keyword.startswith(cls.REGEX_PREFIX):
+            return None
+        try:
+            return re.compile(keyword[len(cls.REGEX_PREFIX):], cls.FLAGS)
+        except re.error:
+            log.warning("Treating invalid keyword regex %r as a literal." % (
+                keyword,))
+            return None
+
+    @classmethod
+    def is_standalone(cls, regex):
+        return bool(regex.groupindex or
+                    cls.GROUP_REFERENCE.search(regex.pattern))
+
+    def _compile_patterns(self, regexes):
+        alternatives, endpoints, groups = [], {}, 0
+        for regex, endpoint in regexes:
+            standalone = self.is_standalone(regex)
+            if alternatives and (
+                    standalone or groups + regex.groups + 1 > self.MAX_GROUPS):
+                self._add_pattern(alternatives, endpoints)
+                alternatives, endpoints, groups = [], {}, 0
+            if standalone:
+                self._add_pattern([regex.pattern], None, endpoint)
+                continue
+            # The outer group for each alternative is the last one to close
+            # when it matches, so `lastindex` identifies the alternative.
+            endpoints[groups + 1] = endpoint
+            alternatives.append('(%s)' % (regex.pattern,))
+            groups += regex.groups + 1
+        if alternatives:
+            self._add_pattern(alternatives, endpoints)
+
+    def _add_pattern(self, alternatives, endpoints, endpoint=None):
+        pattern = re.compile(
+            '(?:%s)$' % ('|'.join(alternatives),), self.FLAGS)
+        self.patterns.append((pattern, endpoints, endpoint))
+
+    def lookup(self, word):
+        endpoint = self.exact.get(word.lower())
+        if endpoint is None:
+            endpoint = self._lookup_regex(word)
+        return endpoint
+
+    def _lookup_regex(self, word):
+        for pattern, endpoints, endpoint in self.patterns:
+            match = pattern.match(word)
+            if match is not None:
+                if endpoints is None:
+                    return endpoint
+                return endpoints[match.lastindex]
+        return self.default
 
 
 class KeywordRouter(GoRouterWorker):
@@ -21,12 +127,47 @@ class KeywordRouter(GoRouterWorker):
 
     worker_name = 'keyword_router'
 
+    @inlineCallbacks
+    def setup_router(self):
+        # Compiled matchers for each router, rebuilt when the router's
+        # keyword mapping changes.
+        self.matchers = {}
+        yield super(KeywordRouter, self).setup_router()
+        config = self.get_static_config()
+        self._match_metrics = None
+        if config.keyword_metrics_prefix is not None:
+            self._match_metrics = MetricManager(
+                config.keyword_metrics_prefix,
+                publisher=self.metric_publisher)
+            self._match_metrics.start_polling()
+
+    def teardown_router(self):
+        if self._match_metrics is not None:
+            self._match_metrics.stop_polling()
+        return super(KeywordRouter, self).teardown_router()
+
+    def get_matcher(self, config):
+        router_key = config.router.key
+        mapping = config.keyword_endpoint_mapping
+        matcher = self.matchers.get(router_key)
+        if matcher is None or matcher.mapping != mapping:
+            matcher = KeywordMatcher(mapping)
+            self.matchers[router_key] = matcher
+        return matcher
+
+    def count_match(self, router_key, endpoint):
+        if self._match_metrics is None:
+            return
+        name = '%s.%s' % (router_key, endpoint)
+        if name not in self._match_metrics:
+            self._match_metrics.register(Count(name))
+        self._match_metrics[name].inc()
+
     def lookup_target(self, config, msg):
         first_word = ((msg['content'] or '').strip().split() + [''])[0]
-        for keyword, target in config.keyword_endpoint_mapping.iteritems():
-            if keyword.lower() == first_word.lower():
-                return target
-        return 'default'
+        endpoint = self.get_matcher(config).lookup(first_word)
+        self.count_match(config.router.key, endpoint)
+        return endpoint
 
     def handle_inbound(self, config, msg, conn_name):
         log.debug("Handling inbound: %s" % (msg,))
@@ -1,9 +1,16 @@
+import hashlib
+import struct
 import sys
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from itertools import islice
+
 from twisted.python import usage
 from twisted.internet import reactor
 from twisted.internet.defer import (
-    maybeDeferred, Deferred, DeferredQueue, inlineCallbacks, returnValue)
-from twisted.internet.task import deferLater
+    maybeDeferred, Deferred, DeferredQueue, DeferredSemaphore, FirstError,
+    gatherResults, inlineCallbacks, returnValue)
 from vumi.service import Worker, WorkerCreator
 from vumi.servicemaker import VumiOptions
 import yaml
@@ -21,6 +28,13 @@ class ScriptError(Exception):
 
 
 class JsBoxSendOptions(VumiOptions):
+    optFlags = [
+        ["stream", None,
+         "Send messages while contact addresses are still being loaded."],
+        ["resume", None,
+         "Skip addresses already listed in the checkpoint file."],
+    ]
+
     optParameters = [
         ["user-account-key", None, None,
          "User account that owns the conversation."],
@@ -30,8 +44,18 @@ class JsBoxSendOptions(VumiOptions):
          "File containing persistence configuration."],
         ["hz", None, "60.0",
          "Maximum number of messages to send per second."],
+        ["burst", None, "1",
+         "Maximum number of messages to send at once after a pause."],
         ["exclude-addresses-file", None, None,
          "File containing addresses to exclude, one per line."],
+        ["checkpoint-file", None, None,
+         "File to record the addresses messages are sent to in."],
+        ["queue-size", None, "1000",
+         "Maximum number of addresses to load ahead of sending when"
+         " streaming."],
+        ["publishers", None, "1",
+         "Number of addresses to send messages to concurrently when"
+         " streaming."],
     ]
 
     def postOptions(self):
@@ -55,41 +79,175 @@ class JsBoxSendOptions(VumiOptions):
             raise usage.UsageError(
                 "Please provide a positive float for hz")
         self['hz'] = hz
+        for name in ['burst', 'queue-size', 'publishers']:
+            self[name] = self.positive_int(name)
+        if self['resume'] and not self['checkpoint-file']:
+            raise usage.UsageError(
+                "Please provide the checkpoint-file parameter to resume.")
+
+    def positive_int(self, name):
+        try:
+            value = int(self[name])
+        except (TypeError, ValueError):
+            value = 0
+        if value <= 0:
+            raise usage.UsageError(
+                "Please provide a positive integer for %s" % (name,))
+        return value
 
     def get_vumigo_config(self):
         with file(self['vumigo-config'], 'r') as stream:
             return yaml.safe_load(stream)
 
 
-class Ticker(object):
+class TokenBucket(object):
     """
-    An object that limits calls to a fixed number per second.
+    A token bucket rate limiter.
+
+    Calls to :meth:`take` are limited to `hz` per second on average, but up
+    to `burst` calls may happen at once if there haven't been any for a
+    while.
 
     :param float hz:
-       Times per second that :meth:``tick`` may be called.
+       Times per second that :meth:`take` may be called.
+    :param int burst:
+       Maximum number of tokens in the bucket.
     """
 
     clock = reactor
 
-    def __init__(self, hz):
+    def __init__(self, hz, burst=1):
         self._hz = hz
-        self._min_dt = 1.0 / hz
+        self._burst = burst
+        self._tokens = float(burst)
         self._last = None
 
-    def tick(self):
+    def take(self):
+        """
+        Take a token from the bucket. Returns a deferred that fires once
+        the token is available.
+        """
+        now = self.clock.seconds()
+        if self._last is not None:
+            self._tokens = min(
+                self._burst, self._tokens + (now - self._last) * self._hz)
+        self._last = now
+        # The bucket may go into debt, in which case later calls wait until
+        # the debt has been paid.
+        self._tokens -= 1
+        delay = 0 if self._tokens >= 0 else -self._tokens / self._hz
         d = Deferred()
-        delay = 0
-        if self._last is None:
-            self._last = self.clock.seconds()
-        else:
-            now = self.clock.seconds()
-            dt = now - self._last
-            delay = 0 if (dt > self._min_dt) else (self._min_dt - dt)
-            self._last = now
         self.clock.callLater(delay, d.callback, None)
         return d
 
 
+class HashedAddressSet(object):
+    """
+    A compact, read-only set of addresses.
+
+    Only a 64-bit hash of each address is kept, in a sorted array, so large
+    address lists take a fraction of the memory of a set of strings.
+
+    Hashes are sorted in chunks of at most :attr:`CHUNK_SIZE` which are then
+    merged, so we never hold more than one chunk of them as Python ints.
+    """
+
+    TYPECODE = 'L'
+    CHUNK_SIZE = 100000
+
+    def __init__(self, hashes=()):
+        if array(self.TYPECODE).itemsize != 8:
+            raise ScriptError(
+                "HashedAddressSet needs 64-bit array items, but %r items are"
+                " %d bytes on this platform." % (
+                    self.TYPECODE, array(self.TYPECODE).itemsize))
+        hashes = iter(hashes)
+        chunks = []
+        while True:
+            chunk = sorted(islice(hashes, self.CHUNK_SIZE))
+            if not chunk:
+                break
+            chunks.append(array(self.TYPECODE, chunk))
+        if len(chunks) == 1:
+            self._hashes = chunks[0]
+        else:
+            self._hashes = array(self.TYPECODE)
+            self._hashes.extend(merge(*chunks))
+
+    @classmethod
+    def hash_addr(cls, addr):
+        if isinstance(addr, unicode):
+            addr = addr.encode('utf-8')
+        [addr_hash] = struct.unpack('<Q', hashlib.md5(addr).digest()[:8])
+        return addr_hash
+
+    @classmethod
+    def iter_hashes_from_files(cls, paths):
+        for path in paths:
+            if path is None:
+                continue
+            with open(path, 'r') as addr_file:
+                for line in addr_file:
+                    line = line.strip()
+                    if line:
+                        yield cls.hash_addr(line)
+
+    @classmethod
+    def from_files(cls, paths):
+        """
+        Build a set from files containing one address per line. Paths that
+        are `None` are skipped.
+        """
+        return cls(cls.iter_hashes_from_files(paths))
+
+    def __contains__(self, addr):
+        addr_hash = self.hash_addr(addr)
+        i = bisect_left(self._hashes, addr_hash)
+        return i < len(self._hashes) and self._hashes[i] == addr_hash
+
+
+class BoundedQueue(object):
+    """
+    A queue that holds at most `size` items. :meth:`put` returns a deferred
+    that fires once there is space for the item.
+
+    Once the queue is closed, queued items are discarded and anything put in
+    it (including puts that are waiting for space) is dropped.
+    """
+
+    def __init__(self, size):
+        self._queue = DeferredQueue()
+        self._space = DeferredSemaphore(size)
+        self.closed = False
+
+    def put(self, item):
+        d = self._space.acquire()
+        d.addCallback(self._put, item)
+        return d
+
+    def _put(self, _, item):
+        if self.closed:
+            self._space.release()
+        else:
+            self._queue.put(item)
+
+    def close(self):
+        self.closed = True
+        # Releasing the space held by queued items lets waiting puts finish.
+        while self._queue.pending:
+            self._queue.pending.pop()
+            self._space.release()
+
+    def get(self):
+        d = self._queue.get()
+        d.addCallback(self._got)
+        return d
+
+    def _got(self, item):
+        self._space.release()
+        return item
+
+
 class JsBoxSendWorker(Worker):
 
     WORKER_QUEUE = DeferredQueue()
@@ -102,7 +260,6 @@ class JsBoxSendWorker(Worker):
         'dialogue': dialogue_js_config,
     }
     SUPPORTED_APPS = tuple(JSBOX_CONFIG.keys())
-    SEND_DELAY = 0.01  # No more than 100 msgs/second to the queue.
 
     def send_inbound_push_trigger(self, to_addr, conversation):
         self.emit('Starting %r [%s] -> %s' % (
@@ -112,54 +269,132 @@ class JsBoxSendWorker(Worker):
 
     @inlineCallbacks
     def send_jsbox(self, user_account_key, conversation_key, hz=60,
-                   addr_exclude_path=None):
+                   addr_exclude_path=None, burst=1, checkpoint_path=None,
+                   resume=False, stream=False, queue_size=1000,
+                   publishers=1):
         conv = yield self.get_conversation(user_account_key, conversation_key)
         delivery_class = self.get_delivery_class(conv)
-        excluded_addrs = self.get_excluded_addrs(addr_exclude_path)
-        to_addrs = yield self.get_contact_addrs_for_conv(
-            conv, delivery_class, excluded_addrs)
-        ticker = Ticker(hz=hz)
-        for i, to_addr in enumerate(to_addrs):
-            yield self.send_inbound_push_trigger(to_addr, conv)
-            if (i + 1) % 100 == 0:
-                self.emit("Messages sent: %s / %s" % (i + 1, len(to_addrs)))
-            yield ticker.tick()
+        excluded_addrs = self.get_excluded_addrs(
+            addr_exclude_path, checkpoint_path if resume else None)
+        rate_limiter = TokenBucket(hz=hz, burst=burst)
+        checkpoint = None
+        if checkpoint_path is not None:
+            checkpoint = open(checkpoint_path, 'a')
+        try:
+            if stream:
+                yield self.send_jsbox_streamed(
+                    conv, delivery_class, excluded_addrs, rate_limiter,
+                    checkpoint, queue_size, publishers)
+            else:
+                to_addrs = yield self.get_contact_addrs_for_conv(
+                    conv, delivery_class, excluded_addrs)
+                for i, to_addr in enumerate(to_addrs):
+                    yield self.send_to_addr(
+                        to_addr, conv, rate_limiter, checkpoint)
+                    if (i + 1) % 100 == 0:
+                        self.emit("Messages sent: %s / %s" % (
+                            i + 1, len(to_addrs)))
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+
+    @inlineCallbacks
+    def send_jsbox_streamed(self, conv, delivery_class, excluded_addrs,
+                            rate_limiter, checkpoint, queue_size, publishers):
+        """
+        Send messages while contact addresses are still being loaded.
+
+        Addresses are passed from the loader to `publishers` senders through
+        a queue of at most `queue_size` addresses. If a sender fails, the
+        queue is closed to stop the loader and the failure is raised once the
+        loader has stopped.
+        """
+        queue = BoundedQueue(queue_size)
+        sent = [0]
+
+        @inlineCallbacks
+        def send_from_queue():
+            while True:
+                to_addr = yield queue.get()
+                if to_addr is None:
+                    return
+                yield self.send_to_addr(
+                    to_addr, conv, rate_limiter, checkpoint)
+                sent[0] += 1
+                if sent[0] % 100 == 0:
+                    self.emit("Messages sent: %s" % (sent[0],))
+
+        @inlineCallbacks
+        def stop_publishers(result):
+            for _ in range(publishers):
+                yield queue.put(None)
+            returnValue(result)
+
+        senders_d = gatherResults(
+            [send_from_queue() for _ in range(publishers)],
+            consumeErrors=True)
+        loader_d = self.queue_contact_addrs_for_conv(
+            conv, delivery_class, excluded_addrs, queue.put,
+            stopped=lambda: queue.closed)
+        loader_d.addBoth(stop_publishers)
+        try:
+            yield senders_d
+        except FirstError as e:
+            queue.close()
+            yield loader_d
+            e.subFailure.raiseException()
+        yield loader_d
+
+    @inlineCallbacks
+    def send_to_addr(self, to_addr, conv, rate_limiter, checkpoint):
+        yield rate_limiter.take()
+        yield self.send_inbound_push_trigger(to_addr, conv)
+        if checkpoint is not None:
+            if isinstance(to_addr, unicode):
+                to_addr = to_addr.encode('utf-8')
+            checkpoint.write('%s\n' % (to_addr,))
+            checkpoint.flush()
 
     def get_delivery_class(self, conv):
         config_loader = self.JSBOX_CONFIG[conv.conversation_type]
         config = config_loader(conv)
         return config.get('delivery_class')
 
-    def get_excluded_addrs(self, addr_exclude_path):
-        if addr_exclude_path is None:
-            return set()
-
-        excluded_addrs = set()
-        with open(addr_exclude_path, 'r') as exclude_file:
-            for line in exclude_file.readlines():
-                line = line.strip()
-                if line:
-                    excluded_addrs.add(line)
-        return excluded_addrs
+    def get_excluded_addrs(self, addr_exclude_path, checkpoint_path=None):
+        return HashedAddressSet.from_files(
+            [addr_exclude_path, checkpoint_path])
 
     @inlineCallbacks
     def get_contact_addrs_for_conv(self, conv, delivery_class, excluded_addrs):
         addrs = []
+        yield self.queue_contact_addrs_for_conv(
+            conv, delivery_class, excluded_addrs, addrs.append)
+        returnValue(addrs)
+
+    @inlineCallbacks
+    def queue_contact_addrs_for_conv(self, conv, delivery_class,
+                                     excluded_addrs, put,
+                                     stopped=lambda: False):
+        """
+        Call `put` with the address of each opted-in contact that isn't in
+        `excluded_addrs`. If `put` returns a deferred, we wait for it before
+        loading more addresses. We stop early once `stopped()` is true.
+        """
+        count = 0
         for contacts in (yield conv.get_opted_in_contact_bunches(
                 delivery_class)):
             for contact in (yield contacts):
+                if stopped():
+                    return
                 addr = contact.addr_for(delivery_class)
                 if addr not in excluded_addrs:
-                    addrs.append(addr)
-            self.emit("Addresses collected: %s" % (len(addrs),))
-        returnValue(addrs)
+                    yield put(addr)
+                    count += 1
+            self.emit("Addresses collected: %s" % (count,))
 
-    @inlineCallbacks
     def send_to_conv(self, conv, msg):
         publisher = self._publishers[conv.conversation_type]
-        yield publisher.publish_message(msg)
-        # Give the reactor time to actually send the message.
-        yield deferLater(reactor, self.SEND_DELAY, lambda: None)
+        return publisher.publish_message(msg)
 
     @inlineCallbacks
     def make_publisher(self, conv_type):
@@ -209,7 +444,10 @@ def main(options):
     worker = yield JsBoxSendWorker.WORKER_QUEUE.get()
     yield worker.send_jsbox(
         options['user-account-key'], options['conversation-key'],
-        options['hz'], options['exclude-addresses-file'])
+        options['hz'], options['exclude-addresses-file'],
+        burst=options['burst'], checkpoint_path=options['checkpoint-file'],
+        resume=options['resume'], stream=options['stream'],
+        queue_size=options['queue-size'], publishers=options['publishers'])
     reactor.stop()
 
 
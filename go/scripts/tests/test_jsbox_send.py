@@ -8,7 +8,8 @@ from twisted.python import usage
 from vumi.tests.helpers import VumiTestCase
 
 from go.scripts.jsbox_send import (
-    JsBoxSendWorker, JsBoxSendOptions, ScriptError, Ticker)
+    JsBoxSendWorker, JsBoxSendOptions, ScriptError, TokenBucket,
+    HashedAddressSet, BoundedQueue)
 from go.vumitools.tests.helpers import VumiApiHelper, GoMessageHelper
 
 
@@ -44,52 +45,168 @@ class TestJsBoxSendOptions(VumiTestCase):
             usage.UsageError,
             self.mk_opts, ["--hz", "foo"])
 
+    def test_streaming_defaults(self):
+        opts = self.mk_opts([])
+        self.assertEqual(opts['burst'], 1)
+        self.assertEqual(opts['queue-size'], 1000)
+        self.assertEqual(opts['publishers'], 1)
+        self.assertEqual(opts['stream'], 0)
+        self.assertEqual(opts['resume'], 0)
+        self.assertEqual(opts['checkpoint-file'], None)
+
+    def test_streaming_overrides(self):
+        opts = self.mk_opts([
+            "--stream", "--burst", "10", "--queue-size", "50",
+            "--publishers", "4"])
+        self.assertEqual(opts['stream'], 1)
+        self.assertEqual(opts['burst'], 10)
+        self.assertEqual(opts['queue-size'], 50)
+        self.assertEqual(opts['publishers'], 4)
+
+    def test_burst_not_positive(self):
+        self.assertRaises(
+            usage.UsageError,
+            self.mk_opts, ["--burst", "0"])
+        self.assertRaises(
+            usage.UsageError,
+            self.mk_opts, ["--burst", "foo"])
 
-class TestTicker(VumiTestCase):
-    def setUp(self):
-        self.override_ticker_clock()
-
-    def override_ticker_clock(self):
-        orig_clock = Ticker.clock
+    def test_resume_requires_checkpoint_file(self):
+        self.assertRaises(
+            usage.UsageError,
+            self.mk_opts, ["--resume"])
+        opts = self.mk_opts(["--resume", "--checkpoint-file", "sent.txt"])
+        self.assertEqual(opts['resume'], 1)
+        self.assertEqual(opts['checkpoint-file'], "sent.txt")
 
-        def restore_clock():
-            Ticker.clock = orig_clock
 
-        Ticker.clock = Clock()
-        self.add_cleanup(restore_clock)
+class TestTokenBucket(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(TokenBucket, 'clock', self.clock)
 
-    def test_first_tick(self):
-        t = Ticker(hz=1)
+    def test_first_take(self):
+        t = TokenBucket(hz=1)
 
-        d1 = t.tick()
+        d1 = t.take()
         self.assertFalse(d1.called)
-        t.clock.advance(0)
+        self.clock.advance(0)
         self.assertTrue(d1.called)
 
     def test_fast(self):
-        t = Ticker(hz=1)
+        t = TokenBucket(hz=1)
 
-        t.tick()
-        t.clock.advance(0.1)
+        t.take()
+        self.clock.advance(0.1)
 
-        d = t.tick()
+        d = t.take()
         self.assertFalse(d.called)
-        t.clock.advance(0.5)
+        self.clock.advance(0.5)
         self.assertFalse(d.called)
-        t.clock.advance(0.5)
+        self.clock.advance(0.4)
         self.assertTrue(d.called)
 
     def test_slow(self):
-        t = Ticker(hz=1)
+        t = TokenBucket(hz=1)
 
-        t.tick()
-        t.clock.advance(1.5)
+        t.take()
+        self.clock.advance(1.5)
 
-        d = t.tick()
+        d = t.take()
         self.assertFalse(d.called)
-        t.clock.advance(0)
+        self.clock.advance(0)
         self.assertTrue(d.called)
 
+    def test_burst(self):
+        t = TokenBucket(hz=1, burst=3)
+
+        ds = [t.take() for _ in range(4)]
+        self.clock.advance(0)
+        self.assertEqual([d.called for d in ds], [True, True, True, False])
+        self.clock.advance(1)
+        self.assertTrue(ds[3].called)
+
+    def test_burst_refills(self):
+        t = TokenBucket(hz=1, burst=2)
+
+        [t.take() for _ in range(2)]
+        self.clock.advance(10)
+        ds = [t.take() for _ in range(3)]
+        self.clock.advance(0)
+        self.assertEqual([d.called for d in ds], [True, True, False])
+
+
+class TestHashedAddressSet(VumiTestCase):
+    def mk_file(self, content):
+        addr_file = NamedTemporaryFile()
+        addr_file.write(content)
+        addr_file.flush()
+        return addr_file
+
+    def test_empty(self):
+        addrs = HashedAddressSet()
+        self.assertFalse('addr1' in addrs)
+
+    def test_contains(self):
+        addrs = HashedAddressSet(
+            HashedAddressSet.hash_addr(a) for a in ['addr1', u'addr\xe9'])
+        self.assertTrue('addr1' in addrs)
+        self.assertTrue(u'addr1' in addrs)
+        self.assertTrue(u'addr\xe9' in addrs)
+        self.assertTrue(u'addr\xe9'.encode('utf-8') in addrs)
+        self.assertFalse('addr2' in addrs)
+
+    def test_from_files(self):
+        file1 = self.mk_file('addr1\naddr2')
+        file2 = self.mk_file('addr3\n')
+        addrs = HashedAddressSet.from_files([file1.name, None, file2.name])
+        for addr in ['addr1', 'addr2', 'addr3']:
+            self.assertTrue(addr in addrs)
+        self.assertFalse('addr4' in addrs)
+
+    def test_chunked_sort(self):
+        self.patch(HashedAddressSet, 'CHUNK_SIZE', 3)
+        hashes = [HashedAddressSet.hash_addr('addr%s' % i) for i in range(10)]
+        addrs = HashedAddressSet(hashes)
+        self.assertEqual(list(addrs._hashes), sorted(hashes))
+        for i in range(10):
+            self.assertTrue('addr%s' % (i,) in addrs)
+        self.assertFalse('addr10' in addrs)
+
+
+class TestBoundedQueue(VumiTestCase):
+    def test_put_waits_for_space(self):
+        queue = BoundedQueue(2)
+        put1 = queue.put('a')
+        put2 = queue.put('b')
+        put3 = queue.put('c')
+        self.assertTrue(put1.called)
+        self.assertTrue(put2.called)
+        self.assertFalse(put3.called)
+
+        self.assertEqual(self.successResultOf(queue.get()), 'a')
+        self.assertTrue(put3.called)
+        self.assertEqual(self.successResultOf(queue.get()), 'b')
+        self.assertEqual(self.successResultOf(queue.get()), 'c')
+
+    def test_get_waits_for_item(self):
+        queue = BoundedQueue(1)
+        d = queue.get()
+        self.assertFalse(d.called)
+        queue.put('a')
+        self.assertEqual(self.successResultOf(d), 'a')
+
+    def test_close(self):
+        queue = BoundedQueue(1)
+        queue.put('a')
+        put2 = queue.put('b')
+        self.assertFalse(put2.called)
+        queue.close()
+        self.assertTrue(queue.closed)
+        self.assertTrue(put2.called)
+        self.assertTrue(queue.put('c').called)
+        self.assertFalse(queue.get().called)
+
 
 class TestJsBoxSend(VumiTestCase):
     @inlineCallbacks
@@ -211,7 +328,7 @@ class TestJsBoxSend(VumiTestCase):
     def test_get_excluded_addrs_no_file(self):
         worker = yield self.get_worker()
         excluded_addrs = worker.get_excluded_addrs(None)
-        self.assertEqual(excluded_addrs, set())
+        self.assertFalse('addr1' in excluded_addrs)
 
     @inlineCallbacks
     def test_get_excluded_addrs_simple(self):
@@ -221,7 +338,9 @@ class TestJsBoxSend(VumiTestCase):
 
         worker = yield self.get_worker()
         excluded_addrs = worker.get_excluded_addrs(exclude_file.name)
-        self.assertEqual(excluded_addrs, set(['addr1', 'addr2']))
+        self.assertTrue('addr1' in excluded_addrs)
+        self.assertTrue('addr2' in excluded_addrs)
+        self.assertFalse('addr3' in excluded_addrs)
 
     @inlineCallbacks
     def test_get_excluded_addrs_messy(self):
@@ -231,7 +350,26 @@ class TestJsBoxSend(VumiTestCase):
 
         worker = yield self.get_worker()
         excluded_addrs = worker.get_excluded_addrs(exclude_file.name)
-        self.assertEqual(excluded_addrs, set(['addr1', 'addr2', 'addr3']))
+        self.assertTrue('addr1' in excluded_addrs)
+        self.assertTrue('addr2' in excluded_addrs)
+        self.assertTrue('addr3' in excluded_addrs)
+        self.assertFalse('' in excluded_addrs)
+
+    @inlineCallbacks
+    def test_get_excluded_addrs_checkpoint(self):
+        exclude_file = NamedTemporaryFile()
+        exclude_file.write('addr1\n')
+        exclude_file.flush()
+        checkpoint_file = NamedTemporaryFile()
+        checkpoint_file.write('addr2\n')
+        checkpoint_file.flush()
+
+        worker = yield self.get_worker()
+        excluded_addrs = worker.get_excluded_addrs(
+            exclude_file.name, checkpoint_file.name)
+        self.assertTrue('addr1' in excluded_addrs)
+        self.assertTrue('addr2' in excluded_addrs)
+        self.assertFalse('addr3' in excluded_addrs)
 
     @inlineCallbacks
     def test_get_contacts_for_addrs_no_groups(self):
@@ -359,3 +497,100 @@ class TestJsBoxSend(VumiTestCase):
             'Messages sent: 900 / 1000\n',
             'Messages sent: 1000 / 1000\n',
         ]))
+
+    @inlineCallbacks
+    def mk_group_conv(self, msisdns):
+        cs = self.user_helper.user_api.contact_store
+        grp = yield cs.new_group(u'group')
+        for msisdn in msisdns:
+            yield cs.new_contact(msisdn=msisdn, groups=[grp])
+        conv = yield self.user_helper.create_conversation(
+            u'jsbox', groups=[grp])
+        returnValue(conv)
+
+    @inlineCallbacks
+    def test_send_jsbox_stream(self):
+        conv = yield self.mk_group_conv([u'+01', u'+02', u'+03'])
+        worker = yield self.get_worker()
+        worker_helper = self.vumi_helper.get_worker_helper('jsbox_transport')
+
+        yield worker.send_jsbox(
+            self.user_helper.account_key, conv.key, stream=True,
+            queue_size=1, publishers=2)
+
+        msgs = worker_helper.get_dispatched_inbound()
+        msg_addrs = sorted(msg['from_addr'] for msg in msgs)
+        self.assertEqual(msg_addrs, [u'+01', u'+02', u'+03'])
+        self.assertTrue(all(msg['inbound_push_trigger'] for msg in msgs))
+
+    @inlineCallbacks
+    def test_send_jsbox_stream_big_group(self):
+        conv = yield self.user_helper.create_conversation(u'jsbox')
+        worker = yield self.get_worker()
+
+        @inlineCallbacks
+        def queue_contact_addrs(conv, delivery_class, excluded_addrs, put,
+                                stopped):
+            for i in xrange(250):
+                yield put('+27831234%03s' % i)
+
+        worker.queue_contact_addrs_for_conv = queue_contact_addrs
+        worker.send_inbound_push_trigger = lambda to_addr, conversation: None
+
+        yield worker.send_jsbox(
+            self.user_helper.account_key, conv.key, 1000, stream=True,
+            queue_size=10, burst=100)
+        self.assertEqual(worker.stdout.getvalue(), ''.join([
+            'Messages sent: 100\n',
+            'Messages sent: 200\n',
+        ]))
+
+    @inlineCallbacks
+    def test_send_jsbox_stream_send_failure(self):
+        conv = yield self.user_helper.create_conversation(u'jsbox')
+        worker = yield self.get_worker()
+        queued = []
+
+        @inlineCallbacks
+        def queue_contact_addrs(conv, delivery_class, excluded_addrs, put,
+                                stopped):
+            for i in xrange(50):
+                if stopped():
+                    return
+                queued.append(i)
+                yield put('+27831234%03s' % i)
+
+        def send_inbound_push_trigger(to_addr, conversation):
+            if to_addr.endswith('002'):
+                raise ValueError('Send failed.')
+
+        worker.queue_contact_addrs_for_conv = queue_contact_addrs
+        worker.send_inbound_push_trigger = send_inbound_push_trigger
+
+        d = worker.send_jsbox(
+            self.user_helper.account_key, conv.key, 1000, stream=True,
+            queue_size=5, burst=100)
+        yield self.assertFailure(d, ValueError)
+        # The loader stopped instead of waiting for space forever.
+        self.assertTrue(len(queued) < 50)
+
+    @inlineCallbacks
+    def test_send_jsbox_checkpoint_and_resume(self):
+        conv = yield self.mk_group_conv([u'+01', u'+02', u'+03'])
+        worker = yield self.get_worker()
+        worker_helper = self.vumi_helper.get_worker_helper('jsbox_transport')
+        checkpoint_path = self.mktemp()
+        with open(checkpoint_path, 'w') as checkpoint_file:
+            checkpoint_file.write('+02\n')
+
+        yield worker.send_jsbox(
+            self.user_helper.account_key, conv.key,
+            checkpoint_path=checkpoint_path, resume=True)
+
+        msgs = worker_helper.get_dispatched_inbound()
+        msg_addrs = sorted(msg['from_addr'] for msg in msgs)
+        self.assertEqual(msg_addrs, [u'+01', u'+03'])
+        with open(checkpoint_path) as checkpoint_file:
+            self.assertEqual(
+                sorted(checkpoint_file.read().splitlines()),
+                ['+01', '+02', '+03'])
@@ -11,7 +11,6 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from vumi.blinkenlights.metrics import MetricManager
 from vumi.errors import VumiError
 from vumi.message import Message
-from vumi.components.tagpool import TagpoolManager
 from vumi.components.message_store import MessageStore
 from vumi.persist.model import Manager
 from vumi.persist.riak_manager import RiakManager
@@ -28,8 +27,13 @@ from go.vumitools.contact import ContactStore
 from go.vumitools.conversation import ConversationStore
 from go.vumitools.opt_out import OptOutStore
 from go.vumitools.router import RouterStore
+from go.vumitools.routing_table import GoConnector
+from go.vumitools.conversation.registry import RunningConversationRegistry
 from go.vumitools.conversation.utils import ConversationWrapper
+from go.vumitools.event_status import MessageEventStatusStore
+from go.vumitools.tagpool import GoTagpoolManager
 from go.vumitools.token_manager import TokenManager
+from go.vumitools.utils import gather_in_order
 
 from vumi.message import TransportUserMessage
 
@@ -39,6 +43,9 @@ class TagpoolSet(object):
 
     :param dict pools:
         Dictionary of `tagpool name` -> `tagpool metadata` mappings.
+    :param dict free_counts:
+        Optional dictionary of `tagpool name` -> `number of free tags`
+        mappings.
     """
 
     # TODO: this should ideally need to be moved somewhere else
@@ -49,12 +56,18 @@ class TagpoolSet(object):
         'gtalk': 'Gtalk',
         }
 
-    def __init__(self, pools):
+    def __init__(self, pools, free_counts=None):
         self._pools = pools
+        self._free_counts = free_counts or {}
 
     def pools(self):
         return self._pools.keys()
 
+    def free_tag_count(self, pool):
+        """Return the number of free tags in a pool, or `None` if the
+        number of free tags wasn't looked up."""
+        return self._free_counts.get(pool)
+
     def display_name(self, pool):
         return self._pools[pool].get('display_name', pool)
 
@@ -91,7 +104,8 @@ class VumiUserApi(object):
         self.conversation_store = ConversationStore(self.api.manager,
                                                     self.user_account_key)
         self.contact_store = ContactStore(self.api.manager,
-                                          self.user_account_key)
+                                          self.user_account_key,
+                                          redis=self.api.redis)
         self.router_store = RouterStore(self.api.manager,
                                         self.user_account_key)
         self.channel_store = ChannelStore(self.api.manager,
@@ -121,6 +135,10 @@ class VumiUserApi(object):
     def get_user_account(self):
         return self.api.get_user_account(self.user_account_key)
 
+    def get_contact_groups_version(self):
+        """Return the current contact group membership version."""
+        return self.contact_store.get_groups_version()
+
     def wrap_conversation(self, conversation):
         """Wrap a conversation with a ConversationWrapper.
 
@@ -149,12 +167,36 @@ class VumiUserApi(object):
 
     @Manager.calls_manager
     def get_channel(self, tag):
-        tagpool_meta = yield self.api.tpm.get_metadata(tag[0])
-        tag_info = yield self.api.mdb.get_tag_info(tag)
-        channel = yield self.channel_store.get_channel_by_tag(
-            tag, tagpool_meta, tag_info.current_batch.key)
+        [channel] = yield self.get_channels([tag])
         returnValue(channel)
 
+    @Manager.calls_manager
+    def get_channels(self, tags):
+        """Return the channels for a list of tags, in the same order.
+
+        Tag infos are loaded in bunches and the metadata for each tagpool is
+        only fetched once, no matter how many of the tags are in it.
+        """
+        tags = [tuple(tag) for tag in tags]
+        pools = sorted(set(pool for pool, _ in tags))
+        metadata = yield gather_in_order(
+            self.api.tpm.get_metadata(pool) for pool in pools)
+        tagpool_metadata = dict(zip(pools, metadata))
+
+        current_tags = self.api.mdb.current_tags
+        batch_ids = {}
+        for bunch in current_tags.load_all_bunches(
+                [u'%s:%s' % tag for tag in tags]):
+            for tag_info in (yield bunch):
+                batch_ids[tuple(tag_info.tag)] = tag_info.current_batch.key
+
+        channels = []
+        for tag in tags:
+            channel = yield self.channel_store.get_channel_by_tag(
+                tag, tagpool_metadata[tag[0]], batch_ids.get(tag))
+            channels.append(channel)
+        returnValue(channels)
+
     @Manager.calls_manager
     def archived_conversations(self):
         conv_store = self.conversation_store
@@ -212,11 +254,8 @@ class VumiUserApi(object):
 
     @Manager.calls_manager
     def active_channels(self):
-        channels = []
         user_account = yield self.get_user_account()
-        for tag in user_account.tags:
-            channel = yield self.get_channel(tuple(tag))
-            channels.append(channel)
+        channels = yield self.get_channels(user_account.tags)
         returnValue(channels)
 
     @Manager.calls_manager
@@ -235,15 +274,12 @@ class VumiUserApi(object):
                         or tp.max_keys > tp_usage[tp.tagpool]):
                     allowed_pools.add(tp.tagpool)
 
-        available_pools = []
-        for pool in all_pools:
-            if pool not in allowed_pools:
-                continue
-            free_tags = yield self.api.tpm.free_tags(pool)
-            if free_tags:
-                available_pools.append(pool)
+        free_counts = yield self.api.free_tag_counts(
+            [pool for pool in all_pools if pool in allowed_pools])
+        available_pools = [pool for pool, count in free_counts.iteritems()
+                           if count > 0]
 
-        returnValue((yield self.api.tagpool_set(available_pools)))
+        returnValue((yield self.api.tagpool_set(available_pools, free_counts)))
 
     @Manager.calls_manager
     def applications(self):
@@ -318,10 +354,10 @@ class VumiUserApi(object):
             routing_connectors.add(src_conn)
             routing_connectors.add(dst_conn)
 
-        # Checking tags is cheap and easy, so do that first.
-        channels = yield self.active_channels()
-        for channel in channels:
-            channel_conn = channel.get_connector()
+        # Checking tags is cheap and easy, so do that first. We only need
+        # the connectors, so we don't load the channels.
+        for tag in user_account.tags:
+            channel_conn = GoConnector.for_transport_tag(*tag)
             if channel_conn in routing_connectors:
                 routing_connectors.remove(channel_conn)
 
@@ -358,6 +394,7 @@ class VumiUserApi(object):
         tag_info.metadata['user_account'] = user_account.key.decode('utf-8')
         yield tag_info.save()
         yield user_account.save()
+        yield self.api.tag_ownership_changed()
 
     @Manager.calls_manager
     def acquire_tag(self, pool):
@@ -426,6 +463,7 @@ class VumiUserApi(object):
             if 'user_account' in tag_info.metadata:
                 del tag_info.metadata['user_account']
             yield tag_info.save()
+            yield self.api.tag_ownership_changed()
             # NOTE: This loads and saves the CurrentTag object a second time.
             #       We should probably refactor the message store to make this
             #       less clumsy.
@@ -524,6 +562,11 @@ class VumiRouterApi(object):
 
 
 class VumiApi(object):
+    # Redis key for a counter that is incremented whenever a tag changes
+    # owner. Workers that cache tag ownership watch this to know when to
+    # throw their caches away.
+    TAG_OWNERSHIP_VERSION_KEY = 'tag_ownership_version'
+
     def __init__(self, manager, redis, sender=None, metric_publisher=None):
         # local import to avoid circular import since
         # go.api.go_api needs to access VumiApi
@@ -532,7 +575,7 @@ class VumiApi(object):
         self.manager = manager
         self.redis = redis
 
-        self.tpm = TagpoolManager(self.redis.sub_manager('tagpool_store'))
+        self.tpm = GoTagpoolManager(self.redis.sub_manager('tagpool_store'))
         self.mdb = MessageStore(
             self.manager, self.redis.sub_manager('message_store'))
         self.account_store = AccountStore(self.manager)
@@ -540,6 +583,10 @@ class VumiApi(object):
             self.redis.sub_manager('token_manager'))
         self.session_manager = SessionManager(
             self.redis.sub_manager('session_manager'))
+        self.running_conversation_registry = RunningConversationRegistry(
+            self.redis.sub_manager('running_conversations'))
+        self.message_event_statuses = MessageEventStatusStore(
+            self.redis.sub_manager('message_event_statuses'))
         self.mapi = sender
         self.metric_publisher = metric_publisher
 
@@ -612,17 +659,39 @@ class VumiApi(object):
         return self.mapi.send_command(
             VumiApiCommand.command(worker_name, command, *args, **kwargs))
 
+    def tag_ownership_changed(self):
+        """Record that a tag has been acquired or released."""
+        return self.redis.incr(self.TAG_OWNERSHIP_VERSION_KEY)
+
+    def get_tag_ownership_version(self):
+        """Return the current tag ownership version.
+
+        This changes every time a tag is acquired or released.
+        """
+        return self.redis.get(self.TAG_OWNERSHIP_VERSION_KEY)
+
     def get_metric_manager(self, prefix):
         if self.metric_publisher is None:
             raise VumiError("No metric publisher available.")
         return MetricManager(prefix, publisher=self.metric_publisher)
 
     @Manager.calls_manager
-    def tagpool_set(self, pools):
-        pool_data = dict([
-            (pool, (yield self.tpm.get_metadata(pool)))
-            for pool in pools])
-        returnValue(TagpoolSet(pool_data))
+    def tagpool_set(self, pools, free_counts=None):
+        pools = list(pools)
+        metadata = yield gather_in_order(
+            self.tpm.get_metadata(pool) for pool in pools)
+        returnValue(TagpoolSet(dict(zip(pools, metadata)), free_counts))
+
+    @Manager.calls_manager
+    def free_tag_counts(self, pools):
+        """
+        Return a dict of `tagpool name` -> `number of free tags` for the
+        given pools.
+        """
+        pools = list(pools)
+        counts = yield gather_in_order(
+            self.tpm.free_tag_count(pool) for pool in pools)
+        returnValue(dict(zip(pools, counts)))
 
     @Manager.calls_manager
     def known_tagpools(self):
@@ -7,9 +7,9 @@ from vumi import log
 from vumi.message import TransportUserMessage
 from vumi.worker import BaseWorker
 from vumi.application import ApplicationWorker
-from vumi.blinkenlights.metrics import MetricPublisher, Metric
+from vumi.blinkenlights.metrics import MetricPublisher, MetricManager, Metric
 from vumi.config import (
-    IConfigData, ConfigText, ConfigDict, ConfigField, ConfigFloat)
+    IConfigData, ConfigText, ConfigDict, ConfigField, ConfigFloat, ConfigInt)
 from vumi.connectors import IgnoreMessage
 
 from go.config import get_conversation_definition
@@ -60,6 +60,15 @@ class GoWorkerConfigMixin(object):
         "TTL (in seconds) for cached conversations. If less than or equal to"
         " zero, conversations will not be cached.",
         static=True, default=5)
+    conversation_cache_max_entries = ConfigInt(
+        "Maximum number of conversations to cache. The least recently used"
+        " conversations are evicted when the cache is full. If less than or"
+        " equal to zero, conversations will not be cached.",
+        static=True, default=10000)
+    cache_metrics_prefix = ConfigText(
+        "Prefix for model cache hit, miss and eviction metrics. If unset,"
+        " cache metrics are not published.",
+        static=True)
 
 
 class GoWorkerMixin(object):
@@ -103,12 +112,19 @@ class GoWorkerMixin(object):
         if config.worker_name is not None:
             self.worker_name = config.worker_name
 
+        self.metric_publisher = yield self.start_publisher(MetricPublisher)
+
+        self._cache_metrics = None
+        if config.cache_metrics_prefix is not None:
+            self._cache_metrics = MetricManager(
+                config.cache_metrics_prefix, publisher=self.metric_publisher)
+            self._cache_metrics.start_polling()
+
         # Not all workers need this, but it's cheap if unused and easier to put
         # here than a bunch of more specific places.
-        self._conversation_cache = ModelObjectCache(
-            reactor, config.conversation_cache_ttl)
-
-        self.metric_publisher = yield self.start_publisher(MetricPublisher)
+        self._conversation_cache = self.make_model_cache(
+            'conversation_cache', config.conversation_cache_ttl,
+            config.conversation_cache_max_entries)
 
         yield self._go_setup_command_publisher(config)
         yield self._go_setup_event_publisher(config)
@@ -118,11 +134,23 @@ class GoWorkerMixin(object):
     @inlineCallbacks
     def _go_teardown_worker(self):
         yield self._conversation_cache.cleanup()
+        if self._cache_metrics is not None:
+            self._cache_metrics.stop_polling()
         if self.control_consumer is not None:
             yield self.control_consumer.stop()
             self.control_consumer = None
         yield self.vumi_api.close()
 
+    def make_model_cache(self, name, ttl, max_entries):
+        """
+        Build a :class:`ModelObjectCache` that publishes its metrics as
+        `<cache_metrics_prefix><name>.hits`, etc. if cache metrics are
+        enabled.
+        """
+        return ModelObjectCache(
+            reactor, ttl, max_entries=max_entries,
+            metric_manager=self._cache_metrics, metric_name=name)
+
     def get_user_api(self, user_account_key):
         return self.vumi_api.get_user_api(user_account_key)
 
@@ -387,6 +415,8 @@ class GoApplicationMixin(GoWorkerMixin):
             return
         conv.set_status_started()
         yield conv.save()
+        yield self.vumi_api.running_conversation_registry.add(
+            user_account_key, conversation_key, conv.worker_name)
 
     @inlineCallbacks
     def process_command_stop(self, cmd_id, user_account_key, conversation_key):
@@ -404,6 +434,8 @@ class GoApplicationMixin(GoWorkerMixin):
             return
         conv.set_status_stopped()
         yield conv.save()
+        yield self.vumi_api.running_conversation_registry.remove(
+            user_account_key, conversation_key)
 
     @inlineCallbacks
     def process_command_send_message(self, cmd_id, user_account_key,
@@ -3,12 +3,13 @@ import urllib
 
 from urlparse import urljoin
 
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed, gatherResults)
 from twisted.internet import reactor
 
 from vumi import log
 from vumi.dispatchers.endpoint_dispatchers import Dispatcher
-from vumi.config import ConfigText, ConfigFloat, ConfigBool
+from vumi.config import ConfigText, ConfigFloat, ConfigBool, ConfigInt
 from vumi.message import TransportUserMessage
 from vumi.utils import http_request_full
 
@@ -45,11 +46,13 @@ class BillingApi(object):
         returnValue(response)
 
     @inlineCallbacks
-    def _call_api(self, path, query=None, data=None, method='GET'):
+    def _call_api(self, path, query=None, data=None, method='GET',
+                  retry=True):
         """Perform the actual HTTP call to the billing API.
 
         If the HTTP response code is anything other than 200,
-        raise a BillingError exception.
+        raise a BillingError exception. If ``retry`` is false, network errors
+        are passed on without retrying the request.
         """
         url = urljoin(self.base_url, path)
         if query:
@@ -57,8 +60,12 @@ class BillingApi(object):
         data = json.dumps(data, cls=JSONEncoder)
         headers = {'Content-Type': 'application/json'}
         log.debug("Sending billing request to %r: %r" % (url, data))
-        response = yield self._call_with_retry(
-            url, data, headers=headers, method=method)
+        if retry:
+            response = yield self._call_with_retry(
+                url, data, headers=headers, method=method)
+        else:
+            response = yield http_request_full(
+                url, data, headers=headers, method=method)
 
         log.debug("Got billing response: %r" % (response.delivered_body,))
         if response.code != 200:
@@ -83,6 +90,99 @@ class BillingApi(object):
         }
         return self._call_api("/transactions", data=data, method='POST')
 
+    def create_transactions(self, transactions):
+        """Create a batch of transactions in a single request.
+
+        ``transactions`` is a list of dicts with the same keys as the
+        arguments to :meth:`create_transaction`. The result is a list with a
+        result for each transaction, in the same order. Transactions that
+        couldn't be created have results of the form ``{'error': <reason>}``.
+
+        Batches aren't retried on network errors, since the server may have
+        created the transactions before the error and a retry would then
+        charge for the whole batch twice.
+        """
+        d = self._call_api(
+            "/transactions/batch", data={'transactions': transactions},
+            method='POST', retry=False)
+        return d.addCallback(lambda result: result['results'])
+
+    def flush(self):
+        """Wait for any pending requests to be sent"""
+        return succeed(None)
+
+
+class BatchingBillingApi(BillingApi):
+    """Proxy to the billing REST API that batches transactions.
+
+    Transactions are queued and sent to the batch endpoint when
+    ``batch_size`` transactions are waiting or ``batch_delay`` seconds after
+    the first one was queued, whichever comes first. Each call to
+    :meth:`create_transaction` still gets its own result.
+    """
+
+    clock = reactor
+
+    def __init__(self, base_url, retry_delay, batch_size, batch_delay):
+        super(BatchingBillingApi, self).__init__(base_url, retry_delay)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._queue = []
+        self._flush_call = None
+        self._in_flight = set()
+
+    def create_transaction(self, **kw):
+        """Queue a new transaction for the given ``account_number``"""
+        d = Deferred()
+        self._queue.append((kw, d))
+        if len(self._queue) >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.batch_delay, self.flush)
+        return d
+
+    def flush(self):
+        """Send all queued transactions and wait for any in-flight batches"""
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        if self._queue:
+            queue, self._queue = self._queue, []
+            self._send_batch(queue)
+        return gatherResults(list(self._in_flight))
+
+    def _send_batch(self, queue):
+        d = self.create_transactions([kw for kw, _ in queue])
+        d.addCallbacks(
+            self._batch_sent, self._batch_failed,
+            callbackArgs=(queue,), errbackArgs=(queue,))
+        self._in_flight.add(d)
+        d.addBoth(self._batch_done, d)
+
+    def _batch_sent(self, results, queue):
+        if len(results) != len(queue):
+            # We can't tell which results belong to which transactions.
+            error = BillingError(
+                "Expected %d results for batch, got %d." % (
+                    len(queue), len(results)))
+            for _, d in queue:
+                d.errback(error)
+            return
+        for (_, d), result in zip(queue, results):
+            if 'error' in result:
+                d.errback(BillingError(result['error']))
+            else:
+                d.callback(result)
+
+    def _batch_failed(self, failure, queue):
+        for _, d in queue:
+            d.errback(failure)
+
+    def _batch_done(self, _, d):
+        self._in_flight.discard(d)
+
 
 class BillingDispatcherConfig(Dispatcher.CONFIG_CLASS, GoWorkerConfigMixin):
 
@@ -102,6 +202,16 @@ class BillingDispatcherConfig(Dispatcher.CONFIG_CLASS, GoWorkerConfigMixin):
     credit_limit_message = ConfigText(
         "The message to send when terminating session based transports.",
         static=True, default='Vumi Go account has run out of credits.')
+    batch_size = ConfigInt(
+        "Maximum number of transactions to send to the billing API in a "
+        "single request. A value of 1 disables batching. The dispatcher's "
+        "AMQP prefetch limit should be at least this large for batches to "
+        "fill up.",
+        static=True, default=1)
+    batch_delay = ConfigFloat(
+        "Maximum time to wait for a batch of transactions to fill up before "
+        "sending it, default 0.05s",
+        static=True, default=0.05)
 
     def post_validate(self):
         if len(self.receive_inbound_connectors) != 1:
@@ -137,13 +247,19 @@ class BillingDispatcher(Dispatcher, GoWorkerMixin):
             self.get_configured_ro_connectors()[0]
 
         self.api_url = config.api_url
-        self.billing_api = BillingApi(self.api_url, config.retry_delay)
+        if config.batch_size > 1:
+            self.billing_api = BatchingBillingApi(
+                self.api_url, config.retry_delay, config.batch_size,
+                config.batch_delay)
+        else:
+            self.billing_api = BillingApi(self.api_url, config.retry_delay)
         self.disable_billing = config.disable_billing
         self.session_metadata_field = config.session_metadata_field
         self.credit_limit_message = config.credit_limit_message
 
     @inlineCallbacks
     def teardown_dispatcher(self):
+        yield self.billing_api.flush()
         yield self._go_teardown_worker()
         yield super(BillingDispatcher, self).teardown_dispatcher()
 
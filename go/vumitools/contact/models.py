@@ -1,5 +1,6 @@
 # -*- test-case-name: go.vumitools.tests.test_contact -*-
 
+import heapq
 from uuid import uuid4
 from datetime import datetime
 
@@ -48,6 +49,17 @@ DELIVERY_CLASSES = {
 DEFAULT_DELIVERY_CLASS = 'ussd'
 
 
+def _contact_groups_changed(modelobj):
+    """
+    Tell the contact store a model was loaded through, if any, that contact
+    group memberships have changed.
+    """
+    store = getattr(modelobj.manager, 'contact_store', None)
+    if store is None:
+        return None
+    return store.groups_changed()
+
+
 class ContactError(Exception):
     """Raised when an error occurs accessing or manipulating a Contact"""
 
@@ -88,6 +100,16 @@ class ContactGroup(Model):
             contact.groups.add(self)
             yield contact.save()
 
+    @Manager.calls_manager
+    def save(self):
+        yield super(ContactGroup, self).save()
+        yield _contact_groups_changed(self)
+
+    @Manager.calls_manager
+    def delete(self):
+        yield super(ContactGroup, self).delete()
+        yield _contact_groups_changed(self)
+
     def is_smart_group(self):
         return self.query is not None
 
@@ -125,6 +147,37 @@ class Contact(Model):
         'msisdn', 'twitter_handle', 'facebook_id', 'bbm_pin', 'gtalk_id',
         'mxit_id', 'wechat_id']
 
+    def __init__(self, manager, key, _riak_object=None, **field_values):
+        super(Contact, self).__init__(
+            manager, key, _riak_object=_riak_object, **field_values)
+        self._saved_group_routing_state = self._group_routing_state()
+
+    def _group_routing_state(self):
+        """
+        Return the parts of this contact that routing by contact group
+        depends on, or `None` if the contact isn't in any groups.
+        """
+        group_keys = frozenset(self.groups.keys())
+        if not group_keys:
+            return None
+        return (group_keys, tuple(
+            getattr(self, field) for field in self.ADDRESS_FIELDS))
+
+    @Manager.calls_manager
+    def save(self):
+        yield super(Contact, self).save()
+        state = self._group_routing_state()
+        if state != self._saved_group_routing_state:
+            self._saved_group_routing_state = state
+            yield _contact_groups_changed(self)
+
+    @Manager.calls_manager
+    def delete(self):
+        yield super(Contact, self).delete()
+        if self._saved_group_routing_state is not None:
+            self._saved_group_routing_state = None
+            yield _contact_groups_changed(self)
+
     def add_to_group(self, group):
         if isinstance(group, ContactGroup):
             self.groups.add(group)
@@ -168,6 +221,45 @@ class ContactStore(PerAccountStore):
     FIND_BY_INDEX = True
     FIND_BY_INDEX_SEARCH_FALLBACK = False
 
+    # The number of contact keys fetched at a time when walking through the
+    # contacts for a conversation.
+    CONTACT_KEYS_PAGE_SIZE = 1000
+
+    # Prefix for per-account counters in Redis that are incremented whenever
+    # contact group memberships change, for workers that cache them.
+    GROUPS_VERSION_KEY = 'contact_groups_version'
+
+    def __init__(self, base_manager, user_account_key, redis=None):
+        self.redis = redis
+        super(ContactStore, self).__init__(base_manager, user_account_key)
+        # Contacts and groups find the store through their manager so that
+        # saving or deleting them keeps the groups version up to date.
+        self.manager.contact_store = self
+
+    def _groups_version_key(self):
+        return '%s:%s' % (self.GROUPS_VERSION_KEY, self.user_account_key)
+
+    def groups_changed(self):
+        """
+        Record that contact group memberships in this account have changed.
+
+        This is called whenever contacts or groups loaded through this store
+        are saved with different memberships or deleted. It does nothing if
+        the store has no Redis manager.
+        """
+        if self.redis is None:
+            return None
+        return self.redis.incr(self._groups_version_key())
+
+    def get_groups_version(self):
+        """
+        Return the current contact groups version, which changes whenever
+        contact group memberships in this account change.
+        """
+        if self.redis is None:
+            return None
+        return self.redis.get(self._groups_version_key())
+
     def setup_proxies(self):
         self.contacts = self.manager.proxy(Contact)
         self.groups = self.manager.proxy(ContactGroup)
@@ -244,18 +336,48 @@ class ContactStore(PerAccountStore):
         """
         Collect all contacts relating to a conversation from static &
         dynamic groups.
+
+        Callers that don't need all the keys at once should use
+        :meth:`get_sorted_contact_keys_for_conversation` instead.
+        """
+        contact_keys = []
+        sorted_keys = yield self.get_sorted_contact_keys_for_conversation(
+            conversation)
+        keys = yield sorted_keys.next_keys(self.CONTACT_KEYS_PAGE_SIZE)
+        while keys:
+            contact_keys.extend(keys)
+            keys = yield sorted_keys.next_keys(self.CONTACT_KEYS_PAGE_SIZE)
+        returnValue(contact_keys)
+
+    @Manager.calls_manager
+    def get_sorted_contact_keys_for_conversation(self, conversation,
+                                                 max_results=None):
         """
-        # TODO: FIXME: Avoid building up the whole set in memory.
-        # Grab all contacts we can find
-        contacts = set([])
+        Return a :class:`SortedKeyMerger` that walks through the unique keys
+        of all contacts relating to a conversation in sorted order.
+
+        Static groups are read one index page of ``max_results`` keys at a
+        time. Riak search doesn't return results in key order, so the keys
+        for each smart group are still collected and sorted up front and a
+        smart group's keys are all held in memory.
+        """
+        if max_results is None:
+            max_results = self.CONTACT_KEYS_PAGE_SIZE
+        pages = []
         for groups in conversation.groups.load_all_bunches():
             for group in (yield groups):
-                index_page = yield self.get_contact_keys_for_group(group)
-                while index_page is not None:
-                    contacts.update(index_page)
-                    index_page = yield index_page.next_page()
-
-        returnValue(list(contacts))
+                if group.is_smart_group():
+                    keys = set()
+                    index_page = yield self.get_contact_keys_for_group(group)
+                    while index_page is not None:
+                        keys.update(index_page)
+                        index_page = yield index_page.next_page()
+                    pages.append(SortedKeysPage(sorted(keys)))
+                else:
+                    index_page = yield self.get_static_contact_keys_for_group(
+                        group, max_results=max_results)
+                    pages.append(index_page)
+        returnValue(SortedKeyMerger(self.manager, pages))
 
     @Manager.calls_manager
     def get_contact_keys_for_group(self, group):
@@ -268,11 +390,14 @@ class ContactStore(PerAccountStore):
         else:
             returnValue(index_page)
 
-    def get_static_contact_keys_for_group(self, group):
+    def get_static_contact_keys_for_group(self, group, max_results=None):
         """
         Look up contacts through Riak 2i
+
+        If ``max_results`` is given, the keys are returned in pages of at most
+        that many keys, sorted by key.
         """
-        return group.backlinks.contact_keys()
+        return group.backlinks.contact_keys(max_results=max_results)
 
     def get_dynamic_contact_keys_for_group(self, group):
         """
@@ -444,6 +569,77 @@ class PaginatedSearch(object):
             results))
 
 
+class SortedKeysPage(object):
+    """
+    A single index page wrapped around a list of keys.
+    """
+
+    def __init__(self, keys):
+        self._keys = keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def has_next_page(self):
+        return False
+
+    def next_page(self):
+        return None
+
+
+class SortedKeyMerger(object):
+    """
+    Merge several sequences of index pages, each of which returns its keys in
+    sorted order, into a single sorted stream of unique keys.
+
+    Only the current page of each sequence is held in memory.
+    """
+
+    def __init__(self, manager, pages):
+        self.manager = manager
+        self._pages = list(pages)
+        self._iters = [None] * len(self._pages)
+        self._heap = None
+        self._last_key = None
+
+    @Manager.calls_manager
+    def _push_next_key(self, i):
+        """
+        Push the next key from the ``i``th sequence of pages onto the heap,
+        fetching the next page if necessary.
+        """
+        while self._pages[i] is not None:
+            if self._iters[i] is None:
+                self._iters[i] = iter(self._pages[i])
+            key = next(self._iters[i], None)
+            if key is not None:
+                heapq.heappush(self._heap, (key, i))
+                return
+            page, self._pages[i], self._iters[i] = self._pages[i], None, None
+            if page.has_next_page():
+                self._pages[i] = yield page.next_page()
+
+    @Manager.calls_manager
+    def next_keys(self, count):
+        """
+        Return a list of up to ``count`` more keys, or an empty list if there
+        are no more.
+        """
+        if self._heap is None:
+            self._heap = []
+            for i in range(len(self._pages)):
+                yield self._push_next_key(i)
+
+        keys = []
+        while self._heap and len(keys) < count:
+            key, i = heapq.heappop(self._heap)
+            yield self._push_next_key(i)
+            if key != self._last_key:
+                keys.append(key)
+                self._last_key = key
+        returnValue(keys)
+
+
 class ChainedIndexPages(object):
     """
     Wrapper around a list of index pages to walk through them one after the
@@ -1,12 +1,12 @@
 from uuid import uuid4
 
-from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 
 from go.vumitools.account.models import AccountStore
 from go.vumitools.contact.models import (
     ContactNotFoundError, Contact, ContactStore, PaginatedSearch,
-    ChainedIndexPages)
+    ChainedIndexPages, SortedKeyMerger, SortedKeysPage)
 from go.vumitools.contact.old_models import ContactVNone, ContactV1
 from go.vumitools.tests.helpers import VumiApiHelper
 
@@ -387,6 +387,42 @@ class TestContactStore(VumiTestCase):
         self.assertEqual(list(third_page), [static_contact.key])
         self.assertEqual(third_page.has_next_page(), False)
 
+    @inlineCallbacks
+    def test_get_sorted_contact_keys_for_conversation(self):
+        """
+        The keys for all groups in a conversation are returned in sorted
+        order with duplicates removed.
+        """
+        store = self.contact_store
+        group1 = yield store.new_group(u'group 1')
+        group2 = yield store.new_group(u'group 2')
+        contact_keys = []
+        for i in range(5):
+            contact = yield store.new_contact(
+                name=u'Contact', surname=u'%d' % i, msisdn=u'12345',
+                groups=[group1, group2] if i % 2 else [group1])
+            contact_keys.append(contact.key)
+        for i in range(3):
+            contact = yield store.new_contact(
+                name=u'Contact', surname=u'%d' % i, msisdn=u'12345',
+                groups=[group2])
+            contact_keys.append(contact.key)
+        conv = yield self.user_helper.create_conversation(
+            u'bulk_message', groups=[group1, group2])
+
+        sorted_keys = yield store.get_sorted_contact_keys_for_conversation(
+            conv, max_results=2)
+        pages = []
+        keys = yield sorted_keys.next_keys(3)
+        while keys:
+            pages.append(keys)
+            keys = yield sorted_keys.next_keys(3)
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual(sum(pages, []), sorted(contact_keys))
+
+        all_keys = yield store.get_contacts_for_conversation(conv)
+        self.assertEqual(all_keys, sorted(contact_keys))
+
 
 class TestPaginatedSearch(VumiTestCase):
     @inlineCallbacks
@@ -646,3 +682,73 @@ class TestChainedIndexPages(VumiTestCase):
 
         fifth_page = yield fourth_page.next_page()
         self.assertEqual(fifth_page, None)
+
+
+class TestSortedKeyMerger(VumiTestCase):
+
+    @inlineCallbacks
+    def get_all_keys(self, merger, count):
+        batches = []
+        keys = yield merger.next_keys(count)
+        while keys:
+            batches.append(keys)
+            keys = yield merger.next_keys(count)
+        returnValue(batches)
+
+    @inlineCallbacks
+    def test_no_pages(self):
+        merger = SortedKeyMerger(FakeManager, [])
+        keys = yield merger.next_keys(10)
+        self.assertEqual(keys, [])
+
+    @inlineCallbacks
+    def test_empty_pages(self):
+        merger = SortedKeyMerger(FakeManager, [
+            FakeIndexPage("empty1", []),
+            FakeIndexPage("empty2", [], []),
+        ])
+        keys = yield merger.next_keys(10)
+        self.assertEqual(keys, [])
+
+    @inlineCallbacks
+    def test_single_sequence(self):
+        merger = SortedKeyMerger(FakeManager, [
+            FakeIndexPage("multi", ["a", "b"], ["c"], ["d", "e"]),
+        ])
+        batches = yield self.get_all_keys(merger, 2)
+        self.assertEqual(batches, [["a", "b"], ["c", "d"], ["e"]])
+
+    @inlineCallbacks
+    def test_merge_and_dedupe(self):
+        merger = SortedKeyMerger(FakeManager, [
+            FakeIndexPage("multi1", ["a", "c"], ["e", "g"]),
+            FakeIndexPage("multi2", ["b", "c"], [], ["d", "g"], ["h"]),
+            SortedKeysPage(["a", "f"]),
+        ])
+        batches = yield self.get_all_keys(merger, 3)
+        self.assertEqual(
+            batches, [["a", "b", "c"], ["d", "e", "f"], ["g", "h"]])
+
+    @inlineCallbacks
+    def test_pages_fetched_lazily(self):
+        """
+        We only fetch the next page of a sequence once we've used up the
+        current one.
+        """
+        fetched = []
+
+        class TrackingIndexPage(FakeIndexPage):
+            def next_page(self):
+                fetched.append(self.name)
+                return super(TrackingIndexPage, self).next_page()
+
+        merger = SortedKeyMerger(FakeManager, [
+            TrackingIndexPage("multi1", ["a", "b"], ["e"]),
+            TrackingIndexPage("multi2", ["c", "d"], ["f"]),
+        ])
+        keys = yield merger.next_keys(1)
+        self.assertEqual(keys, ["a"])
+        self.assertEqual(fetched, [])
+        keys = yield merger.next_keys(2)
+        self.assertEqual(keys, ["b", "c"])
+        self.assertEqual(fetched, ["multi1"])
@@ -0,0 +1,82 @@
+# -*- test-case-name: go.vumitools.tests.test_contact_send -*-
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi import log
+
+
+SEND_PROGRESS_EXPIRY = 3600 * 24 * 7  # One week
+
+
+class ContactSendMixin(object):
+    """
+    Mixin for application workers with commands that do something for every
+    contact in every group attached to a conversation.
+
+    Contacts are visited in contact key order and the progress of each
+    command is kept in Redis, so a command that is interrupted (by a worker
+    restart, for example) skips the contacts it has already handled the next
+    time it is processed.
+
+    Requires `self.redis` and `self.worker_name`.
+    """
+
+    contact_keys_page_size = 1000
+
+    def _send_progress_key(self, conv, command_id):
+        return ':'.join([self.worker_name, conv.key, command_id])
+
+    def get_send_progress(self, conv, command_id):
+        return self.redis.get(self._send_progress_key(conv, command_id))
+
+    def set_send_progress(self, conv, command_id, contact_key):
+        key = self._send_progress_key(conv, command_id)
+        return self.redis.setex(key, SEND_PROGRESS_EXPIRY, contact_key)
+
+    def clear_send_progress(self, conv, command_id):
+        return self.redis.delete(self._send_progress_key(conv, command_id))
+
+    @inlineCallbacks
+    def for_each_contact_bunch(self, conv, command_id, handle_bunch):
+        """
+        Call `handle_bunch` with each bunch of contacts for `conv` that
+        comes after the command's send progress.
+
+        Contact keys are read a page at a time in sorted order and the
+        contacts are loaded in bunches, so we never hold all of them in
+        memory. Each bunch is a non-empty list of contacts in key order and
+        the next bunch starts loading before `handle_bunch` is called.
+        `handle_bunch` is responsible for checkpointing the send progress.
+        """
+        contact_store = conv.user_api.contact_store
+        interrupted_progress = yield self.get_send_progress(conv, command_id)
+        if interrupted_progress is not None:
+            log.warning(
+                "Resuming interrupted send for conversation '%s' at '%s'." % (
+                    conv.key, interrupted_progress))
+
+        sorted_keys = yield (
+            contact_store.get_sorted_contact_keys_for_conversation(
+                conv, max_results=self.contact_keys_page_size))
+        while True:
+            contact_keys = yield sorted_keys.next_keys(
+                self.contact_keys_page_size)
+            if not contact_keys:
+                break
+            if interrupted_progress:
+                # Skip the contacts we handled before we were interrupted.
+                # This is safe because our contact keys are both sorted and
+                # unique.
+                contact_keys = [
+                    key for key in contact_keys if key > interrupted_progress]
+
+            # We start loading each bunch of contacts before we handle the
+            # previous one.
+            bunches = contact_store.contacts.load_all_bunches(contact_keys)
+            next_bunch = next(bunches, None)
+            while next_bunch is not None:
+                bunch, next_bunch = next_bunch, next(bunches, None)
+                # Contacts in a bunch may be returned in any order.
+                contacts = sorted((yield bunch), key=lambda c: c.key)
+                if contacts:
+                    yield handle_bunch(contacts)
@@ -0,0 +1,111 @@
+# -*- test-case-name: go.vumitools.conversation.tests.test_registry -*-
+
+"""Registry of running conversations, kept up to date by the workers that
+   start and stop them.
+   """
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+
+class RunningConversationRegistry(object):
+    """A registry of running conversations and the workers that run them.
+
+    Entries are kept in a single Redis hash so that the whole registry can
+    be read with one command.
+
+    The registry can be rebuilt from a scan of the conversation store.
+    Conversations can be started and stopped while the scan is running, so
+    every add and remove is also recorded in a hash of changes that is
+    cleared when a rebuild starts. The changes take precedence over the scan
+    results when the rebuild finishes.
+
+    :type redis: TxRedisManager or RedisManager
+    :param redis:
+        Redis manager object.
+    """
+
+    RUNNING_KEY = 'running'
+    CHANGES_KEY = 'changes'
+    LAST_REBUILT_KEY = 'last_rebuilt'
+
+    def __init__(self, redis):
+        self.manager = redis
+
+    def _field(self, user_account_key, conversation_key):
+        return u'%s:%s' % (user_account_key, conversation_key)
+
+    def _parse_field(self, field):
+        user_account_key, _, conversation_key = field.partition(':')
+        return (user_account_key, conversation_key)
+
+    @Manager.calls_manager
+    def add(self, user_account_key, conversation_key, worker_name):
+        """Record that a conversation is running."""
+        field = self._field(user_account_key, conversation_key)
+        yield self.manager.hset(self.RUNNING_KEY, field, worker_name)
+        yield self.manager.hset(self.CHANGES_KEY, field, worker_name)
+
+    @Manager.calls_manager
+    def remove(self, user_account_key, conversation_key):
+        """Record that a conversation is no longer running."""
+        field = self._field(user_account_key, conversation_key)
+        yield self.manager.hdel(self.RUNNING_KEY, field)
+        # An empty worker name marks a removal.
+        yield self.manager.hset(self.CHANGES_KEY, field, '')
+
+    @Manager.calls_manager
+    def list_running(self):
+        """Return a sorted list of `(user_account_key, conversation_key,
+           worker_name)` tuples for all running conversations.
+           """
+        entries = yield self.manager.hgetall(self.RUNNING_KEY)
+        running = []
+        for field, worker_name in entries.iteritems():
+            running.append(self._parse_field(field) + (worker_name,))
+        returnValue(sorted(running))
+
+    @Manager.calls_manager
+    def get_last_rebuilt(self):
+        """Return the timestamp of the last rebuild, or `None` if the
+           registry has never been rebuilt.
+           """
+        timestamp = yield self.manager.get(self.LAST_REBUILT_KEY)
+        returnValue(float(timestamp) if timestamp is not None else None)
+
+    def start_rebuild(self):
+        """Start recording changes for a rebuild. This must be called before
+           the scan for the rebuild starts.
+           """
+        return self.manager.delete(self.CHANGES_KEY)
+
+    @Manager.calls_manager
+    def finish_rebuild(self, running, timestamp):
+        """Update the registry from the `(user_account_key, conversation_key,
+           worker_name)` tuples found by a scan, keeping any adds and removes
+           made since :meth:`start_rebuild` was called, and return the new
+           contents of the registry.
+           """
+        rebuilt = dict(
+            (self._field(account_key, conv_key), worker_name)
+            for account_key, conv_key, worker_name in running)
+        changes = yield self.manager.hgetall(self.CHANGES_KEY)
+        for field, worker_name in changes.iteritems():
+            if worker_name:
+                rebuilt[field] = worker_name
+            else:
+                rebuilt.pop(field, None)
+
+        # We only write the entries that differ rather than replacing the
+        # whole hash so that changes made while we do this aren't lost.
+        current = yield self.manager.hgetall(self.RUNNING_KEY)
+        for field in set(current) - set(rebuilt):
+            yield self.manager.hdel(self.RUNNING_KEY, field)
+        for field, worker_name in rebuilt.iteritems():
+            if current.get(field) != worker_name:
+                yield self.manager.hset(self.RUNNING_KEY, field, worker_name)
+        yield self.manager.set(self.LAST_REBUILT_KEY, repr(timestamp))
+        returnValue(sorted(
+            self._parse_field(field) + (worker_name,)
+            for field, worker_name in rebuilt.iteritems()))
@@ -0,0 +1,107 @@
+"""Tests for go.vumitools.conversation.registry."""
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.vumitools.conversation.registry import RunningConversationRegistry
+
+
+class TestRunningConversationRegistry(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.registry = RunningConversationRegistry(self.redis)
+
+    @inlineCallbacks
+    def test_list_running_empty(self):
+        running = yield self.registry.list_running()
+        self.assertEqual(running, [])
+
+    @inlineCallbacks
+    def test_add(self):
+        yield self.registry.add(u'acc1', u'conv1', u'app1')
+        yield self.registry.add(u'acc2', u'conv2', u'app2')
+        running = yield self.registry.list_running()
+        self.assertEqual(running, [
+            (u'acc1', u'conv1', u'app1'),
+            (u'acc2', u'conv2', u'app2'),
+        ])
+
+    @inlineCallbacks
+    def test_add_twice(self):
+        yield self.registry.add(u'acc1', u'conv1', u'app1')
+        yield self.registry.add(u'acc1', u'conv1', u'app1')
+        running = yield self.registry.list_running()
+        self.assertEqual(running, [(u'acc1', u'conv1', u'app1')])
+
+    @inlineCallbacks
+    def test_remove(self):
+        yield self.registry.add(u'acc1', u'conv1', u'app1')
+        yield self.registry.add(u'acc1', u'conv2', u'app1')
+        yield self.registry.remove(u'acc1', u'conv1')
+        running = yield self.registry.list_running()
+        self.assertEqual(running, [(u'acc1', u'conv2', u'app1')])
+
+    @inlineCallbacks
+    def test_remove_missing(self):
+        yield self.registry.remove(u'acc1', u'conv1')
+        running = yield self.registry.list_running()
+        self.assertEqual(running, [])
+
+    @inlineCallbacks
+    def test_last_rebuilt(self):
+        self.assertEqual((yield self.registry.get_last_rebuilt()), None)
+        yield self.registry.start_rebuild()
+        yield self.registry.finish_rebuild([], 1234.5)
+        self.assertEqual((yield self.registry.get_last_rebuilt()), 1234.5)
+
+    @inlineCallbacks
+    def test_rebuild(self):
+        yield self.registry.add(u'acc1', u'conv1', u'app1')
+        yield self.registry.start_rebuild()
+        running = yield self.registry.finish_rebuild([
+            (u'acc1', u'conv2', u'app1'),
+            (u'acc2', u'conv3', u'app2'),
+        ], 0)
+        expected = [
+            (u'acc1', u'conv2', u'app1'),
+            (u'acc2', u'conv3', u'app2'),
+        ]
+        self.assertEqual(running, expected)
+        self.assertEqual((yield self.registry.list_running()), expected)
+
+    @inlineCallbacks
+    def test_rebuild_empty(self):
+        yield self.registry.add(u'acc1', u'conv1', u'app1')
+        yield self.registry.start_rebuild()
+        running = yield self.registry.finish_rebuild([], 0)
+        self.assertEqual(running, [])
+        self.assertEqual((yield self.registry.list_running()), [])
+
+    @inlineCallbacks
+    def test_rebuild_keeps_changes_made_during_scan(self):
+        yield self.registry.add(u'acc1', u'conv1', u'app1')
+        yield self.registry.start_rebuild()
+        # conv1 is stopped and conv2 is started after the scan has looked at
+        # them, so the scan results are out of date.
+        yield self.registry.remove(u'acc1', u'conv1')
+        yield self.registry.add(u'acc1', u'conv2', u'app1')
+        running = yield self.registry.finish_rebuild([
+            (u'acc1', u'conv1', u'app1'),
+            (u'acc1', u'conv3', u'app1'),
+        ], 0)
+        expected = [
+            (u'acc1', u'conv2', u'app1'),
+            (u'acc1', u'conv3', u'app1'),
+        ]
+        self.assertEqual(running, expected)
+        self.assertEqual((yield self.registry.list_running()), expected)
+
+    @inlineCallbacks
+    def test_rebuild_ignores_changes_from_before_it_started(self):
+        yield self.registry.add(u'acc1', u'conv1', u'app1')
+        yield self.registry.start_rebuild()
+        running = yield self.registry.finish_rebuild([], 0)
+        self.assertEqual(running, [])
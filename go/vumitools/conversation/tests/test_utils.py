@@ -1,6 +1,6 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
 
 from vumi.tests.helpers import VumiTestCase
 
@@ -114,6 +114,33 @@ class TestConversationWrapper(VumiTestCase):
             [msg['message_id'] for msg in collected_msgs],
             [msg['message_id'] for msg in created_msgs])
 
+    def test_collect_messages_concurrency(self):
+        self.patch(self.conv, 'COLLECT_MESSAGES_CONCURRENCY', 2)
+        msgs = [self.msg_helper.make_inbound("in %s" % (i,)) for i in range(5)]
+        loads = []
+
+        def get_msg(key):
+            d = Deferred()
+            loads.append((key, d))
+            return d
+
+        keys = [msg['message_id'] for msg in msgs]
+        collected_d = self.conv.collect_messages(
+            keys, get_msg, include_sensitive=False, scrubber=lambda msg: msg)
+
+        # Loads are started two at a time and can finish in any order.
+        self.assertEqual([key for key, _ in loads], keys[:2])
+        loads[1][1].callback(msgs[1])
+        loads[0][1].callback(msgs[0])
+        self.assertEqual([key for key, _ in loads], keys[:4])
+        loads[2][1].callback(msgs[2])
+        loads[3][1].callback(None)
+        self.assertEqual([key for key, _ in loads], keys)
+        loads[4][1].callback(msgs[4])
+
+        collected_msgs = self.successResultOf(collected_d)
+        self.assertEqual(collected_msgs, [msgs[0], msgs[1], msgs[2], msgs[4]])
+
     @inlineCallbacks
     def test_received_messages(self):
         yield self.conv.start()
@@ -342,6 +369,28 @@ class TestConversationWrapper(VumiTestCase):
 
         self.assertEqual(contact_addr, None)
 
+    @inlineCallbacks
+    def test_get_opted_in_contact_addresses_snapshot(self):
+        """
+        If we ask for the opted-in addresses of a list of contacts using an
+        opt-out snapshot, we get None for the contacts that are opted out.
+        """
+        contact_store = self.user_helper.user_api.contact_store
+        user_account = yield self.user_helper.get_user_account()
+        opt_out_store = OptOutStore.from_user_account(user_account)
+        contact1 = yield contact_store.new_contact(msisdn=u"+27000000001")
+        contact2 = yield contact_store.new_contact(msisdn=u"+27000000002")
+        yield opt_out_store.new_opt_out(u"msisdn", contact2.msisdn, {
+            "message_id": u"some-message-id",
+        })
+
+        opt_outs = self.conv.get_opt_out_snapshot()
+        contact_addrs = yield self.conv.get_opted_in_contact_addresses(
+            [contact1, contact2], None, opt_outs)
+
+        self.assertEqual(contact_addrs, [contact1.msisdn, None])
+        self.assertEqual(opt_outs.keys, frozenset(["msisdn:+27000000002"]))
+
     @inlineCallbacks
     def test_get_opted_in_contact_bunches(self):
         contact_store = self.user_helper.user_api.contact_store
@@ -411,6 +460,63 @@ class TestConversationWrapper(VumiTestCase):
         self.assertEqual(
             (yield self.conv.get_outbound_throughput(sample_time=20)), 60)
 
+    @inlineCallbacks
+    def test_get_inbound_throughput_series(self):
+        yield self.conv.start()
+        now = datetime.now()
+        for seconds in [0, 90, 100]:
+            yield self.msg_helper.make_stored_inbound(
+                self.conv, "inbound", timestamp=now - timedelta(
+                    seconds=seconds))
+        series = yield self.conv.get_inbound_throughput_series(
+            sample_time=180, resolution=60)
+        self.assertEqual(series, [0.0, 2.0, 1.0])
+        series = yield self.conv.get_inbound_throughput_series(
+            sample_time=60, resolution=30)
+        self.assertEqual(series, [0.0, 2.0])
+
+    @inlineCallbacks
+    def test_get_inbound_throughput_series_empty(self):
+        yield self.conv.start()
+        series = yield self.conv.get_inbound_throughput_series(
+            sample_time=300, resolution=60)
+        self.assertEqual(series, [0.0] * 5)
+
+    @inlineCallbacks
+    def test_get_outbound_throughput_series(self):
+        yield self.conv.start()
+        now = datetime.now()
+        for seconds in [0, 90, 100]:
+            yield self.msg_helper.make_stored_outbound(
+                self.conv, "outbound", timestamp=now - timedelta(
+                    seconds=seconds))
+        series = yield self.conv.get_outbound_throughput_series(
+            sample_time=180, resolution=60)
+        self.assertEqual(series, [0.0, 2.0, 1.0])
+
+    @inlineCallbacks
+    def test_get_throughput_series_invalid_resolution(self):
+        yield self.conv.start()
+        yield self.assertFailure(
+            self.conv.get_inbound_throughput_series(
+                sample_time=300, resolution=0),
+            ValueError)
+        yield self.assertFailure(
+            self.conv.get_outbound_throughput_series(
+                sample_time=300, resolution=-60),
+            ValueError)
+
+    @inlineCallbacks
+    def test_get_throughput_series_too_many_windows(self):
+        yield self.conv.start()
+        yield self.assertFailure(
+            self.conv.get_inbound_throughput_series(
+                sample_time=1441, resolution=1),
+            ValueError)
+        series = yield self.conv.get_inbound_throughput_series(
+            sample_time=1440, resolution=1)
+        self.assertEqual(len(series), 1440)
+
     @inlineCallbacks
     def test_get_groups(self):
         groups = yield self.user_helper.user_api.list_groups()
@@ -1,6 +1,7 @@
 # -*- test-case-name: go.vumitools.conversation.tests.test_utils -*-
 # -*- coding: utf-8 -*-
 
+import math
 import warnings
 
 from twisted.internet.defer import returnValue
@@ -8,7 +9,8 @@ from twisted.internet.defer import returnValue
 from vumi.persist.model import Manager
 
 from go.vumitools.opt_out import OptOutStore
-from go.vumitools.utils import MessageMetadataDictHelper, MessageMetadataHelper
+from go.vumitools.utils import (
+    MessageMetadataDictHelper, MessageMetadataHelper, gather_in_order)
 from go.config import configured_conversation_types
 
 
@@ -16,6 +18,16 @@ class ConversationWrapper(object):
     """Wrapper around a conversation, providing extended functionality.
     """
 
+    # How long (in seconds) an opt-out snapshot is used before new opt-outs
+    # are loaded into it.
+    OPT_OUT_SNAPSHOT_TTL = 5
+
+    # How many messages `collect_messages` loads at once.
+    COLLECT_MESSAGES_CONCURRENCY = 20
+
+    # The most windows a throughput series may be split into.
+    MAX_THROUGHPUT_WINDOWS = 1440
+
     def __init__(self, conversation, user_api):
         self.c = conversation
         self.user_api = user_api
@@ -71,13 +83,9 @@ class ConversationWrapper(object):
         incoming = routing_table.transitive_sources(str(conn))
         outbound = routing_table.transitive_targets(str(conn))
         connectors = incoming | outbound
-        channels = []
-        for conn in connectors:
-            if conn.ctype != conn.TRANSPORT_TAG:
-                continue
-            channel = yield self.user_api.get_channel(
-                (conn.tagpool, conn.tagname))
-            channels.append(channel)
+        tags = [(c.tagpool, c.tagname) for c in connectors
+                if c.ctype == c.TRANSPORT_TAG]
+        channels = yield self.user_api.get_channels(tags)
         channels.sort(key=lambda c: c.name)
         self._channels = channels
         returnValue(channels)
@@ -216,6 +224,10 @@ class ConversationWrapper(object):
         """
         Collect the messages using the given keys by using the given callback.
 
+        Under an async manager, up to `COLLECT_MESSAGES_CONCURRENCY`
+        messages are loaded at once. The messages are returned in the same
+        order as their keys.
+
         :param list keys:
             The list of keys to retrieve.
         :param callable get_msg:
@@ -227,10 +239,11 @@ class ConversationWrapper(object):
             object or None.
         """
         messages = []
-        for key in keys:
-            msg = yield get_msg(key)
-            if msg is not None:
-                messages.append(msg)
+        concurrency = self.COLLECT_MESSAGES_CONCURRENCY
+        for i in range(0, len(keys), concurrency):
+            msgs = yield gather_in_order(
+                get_msg(key) for key in keys[i:i + concurrency])
+            messages.extend(msg for msg in msgs if msg is not None)
 
         returnValue(self.filter_and_scrub_messages(
             messages, include_sensitive=include_sensitive, scrubber=scrubber))
@@ -293,13 +306,11 @@ class ConversationWrapper(object):
         keys = yield self.mdb.cache.get_inbound_message_keys(
             self.batch.key, start, limit - 1)
 
+        # The keys are already in timestamp order and collect_messages()
+        # preserves it.
         replies = yield self.collect_messages(
             keys, self.mdb.get_inbound_message, include_sensitive, scrubber)
-
-        # Preserve order
-        returnValue(
-            sorted(replies, key=lambda msg: msg['timestamp'],
-                   reverse=True))
+        returnValue(replies)
 
     def sent_messages(self, start=0, limit=100, include_sensitive=False,
                       scrubber=None):
@@ -335,13 +346,11 @@ class ConversationWrapper(object):
         keys = yield self.mdb.cache.get_outbound_message_keys(
             self.batch.key, start, limit - 1)
 
+        # The keys are already in timestamp order and collect_messages()
+        # preserves it.
         sent_messages = yield self.collect_messages(
             keys, self.mdb.get_outbound_message, include_sensitive, scrubber)
-
-        # Preserve order
-        returnValue(
-            sorted(sent_messages, key=lambda msg: msg['timestamp'],
-                   reverse=True))
+        returnValue(sent_messages)
 
     @property
     def worker_name(self):
@@ -380,55 +389,134 @@ class ConversationWrapper(object):
     def get_inbound_throughput(self, sample_time=300):
         """
         Calculate how many inbound messages per minute we've been doing on
-        average.
-        """
-        inbounds = yield self.mdb.cache.get_inbound_message_keys(
-            self.batch.key, with_timestamp=True)
-        if not inbounds:
-            returnValue(0.0)
-        threshold = inbounds[0][1] - sample_time
-        count = sum(1 for _, timestamp in inbounds if timestamp >= threshold)
+        average over the `sample_time` seconds before the most recent inbound
+        message.
+        """
+        count = yield self.mdb.cache.count_inbound_throughput(
+            self.batch.key, sample_time)
         returnValue(count / (sample_time / 60.0))
 
     @Manager.calls_manager
     def get_outbound_throughput(self, sample_time=300):
         """
         Calculate how many outbound messages per minute we've been doing on
-        average.
-        """
-        outbounds = yield self.mdb.cache.get_outbound_message_keys(
-            self.batch.key, with_timestamp=True)
-        if not outbounds:
-            returnValue(0.0)
-        threshold = outbounds[0][1] - sample_time
-        count = sum(1 for _, timestamp in outbounds if timestamp >= threshold)
+        average over the `sample_time` seconds before the most recent outbound
+        message.
+        """
+        count = yield self.mdb.cache.count_outbound_throughput(
+            self.batch.key, sample_time)
         returnValue(count / (sample_time / 60.0))
 
+    @classmethod
+    def check_throughput_series_args(cls, sample_time, resolution):
+        """
+        Raise :class:`ValueError` if a throughput series can't be calculated
+        for `sample_time` and `resolution`.
+        """
+        if sample_time <= 0:
+            raise ValueError("sample_time must be positive")
+        if resolution <= 0:
+            raise ValueError("resolution must be positive")
+        if math.ceil(sample_time / float(resolution)) > (
+                cls.MAX_THROUGHPUT_WINDOWS):
+            raise ValueError(
+                "sample_time may be split into at most %s windows" % (
+                    cls.MAX_THROUGHPUT_WINDOWS,))
+
     @Manager.calls_manager
-    def get_opted_in_contact_address(self, contact, delivery_class):
-        # TODO: Less hacky address type handling.
-        addr_type = 'gtalk' if delivery_class == 'gtalk' else 'msisdn'
+    def _get_throughput_series(self, redis_key, sample_time, resolution):
+        self.check_throughput_series_args(sample_time, resolution)
+        redis = self.mdb.cache.redis
+        windows = int(math.ceil(sample_time / float(resolution)))
+        last_seen = yield redis.zrange(
+            redis_key, 0, 0, desc=True, withscores=True)
+        if not last_seen:
+            returnValue([0.0] * windows)
+        [(_, latest)] = last_seen
+        counts = yield gather_in_order(
+            redis.zcount(
+                redis_key, '(%r' % (latest - (i + 1) * resolution,),
+                latest - i * resolution)
+            for i in reversed(range(windows)))
+        returnValue([count / (resolution / 60.0) for count in counts])
+
+    def get_inbound_throughput_series(self, sample_time=300, resolution=60):
+        """
+        Calculate how many inbound messages per minute we've been doing in
+        each `resolution` second window of the `sample_time` seconds before
+        the most recent inbound message, oldest window first.
+        """
+        return self._get_throughput_series(
+            self.mdb.cache.inbound_key(self.batch.key), sample_time,
+            resolution)
+
+    def get_outbound_throughput_series(self, sample_time=300, resolution=60):
+        """
+        Calculate how many outbound messages per minute we've been doing in
+        each `resolution` second window of the `sample_time` seconds before
+        the most recent outbound message, oldest window first.
+        """
+        return self._get_throughput_series(
+            self.mdb.cache.outbound_key(self.batch.key), sample_time,
+            resolution)
+
+    def get_opt_out_snapshot(self):
+        """
+        Get a snapshot of the account's opt-outs to pass to
+        :meth:`get_opted_in_contact_addresses` when checking many contacts.
+        """
         opt_out_store = OptOutStore(
             self.api.manager, self.user_api.user_account_key)
+        return opt_out_store.snapshot(max_age=self.OPT_OUT_SNAPSHOT_TTL)
+
+    @Manager.calls_manager
+    def get_opted_in_contact_address(self, contact, delivery_class,
+                                     opt_outs=None):
+        """
+        Get the contact's address for the delivery class, or ``None`` if the
+        contact has no suitable address or the address is opted out.
+
+        :param opt_outs:
+            An :class:`OptOutSnapshot` to check the address against. If
+            ``None``, the opt-out is looked up in Riak.
+        """
+        # TODO: Less hacky address type handling.
+        addr_type = 'gtalk' if delivery_class == 'gtalk' else 'msisdn'
+        if opt_outs is None:
+            opt_outs = OptOutStore(
+                self.api.manager, self.user_api.user_account_key)
 
         contact_addr = contact.addr_for(delivery_class)
         if contact_addr:
-            opt_out = yield opt_out_store.get_opt_out(addr_type, contact_addr)
-            if opt_out:
+            opted_out = yield opt_outs.is_opted_out(addr_type, contact_addr)
+            if opted_out:
                 # If the address is opted out, replace it with None.
                 contact_addr = None
         returnValue(contact_addr)
 
     @Manager.calls_manager
-    def _filter_opted_out_contacts(self, contacts, delivery_class):
-        filtered_contacts = []
-        contacts = yield contacts
+    def get_opted_in_contact_addresses(self, contacts, delivery_class,
+                                       opt_outs=None):
+        """
+        Get the opted-in address (or ``None``) for each of a list of contacts.
+        See :meth:`get_opted_in_contact_address`.
+        """
+        contact_addrs = []
         for contact in contacts:
             contact_addr = yield self.get_opted_in_contact_address(
-                contact, delivery_class)
-            if contact_addr:
-                filtered_contacts.append(contact)
-        returnValue(filtered_contacts)
+                contact, delivery_class, opt_outs)
+            contact_addrs.append(contact_addr)
+        returnValue(contact_addrs)
+
+    @Manager.calls_manager
+    def _filter_opted_out_contacts(self, contacts, delivery_class,
+                                   opt_outs=None):
+        contacts = yield contacts
+        contact_addrs = yield self.get_opted_in_contact_addresses(
+            contacts, delivery_class, opt_outs)
+        returnValue([
+            contact for contact, contact_addr in zip(contacts, contact_addrs)
+            if contact_addr])
 
     @Manager.calls_manager
     def get_opted_in_contact_bunches(self, delivery_class):
@@ -442,12 +530,17 @@ class ConversationWrapper(object):
         contacts_iter = yield contact_store.contacts.load_all_bunches(
             contact_keys)
 
+        # We load the opt-outs now rather than in the first bunch, because
+        # the caller may process more than one bunch at a time.
+        opt_outs = self.get_opt_out_snapshot()
+        yield opt_outs.refresh()
+
         # We return a generator here. It's important that this is iterated over
         # slowly, otherwise we risk hammering our Riak servers to death.
         def opted_in_contacts_generator():
             # NOTE: This is a generator, *not* an async flattener.
             for contacts_bunch in contacts_iter:
                 yield self._filter_opted_out_contacts(
-                    contacts_bunch, delivery_class)
+                    contacts_bunch, delivery_class, opt_outs)
 
         returnValue(opted_in_contacts_generator())
@@ -0,0 +1,113 @@
+# -*- test-case-name: go.vumitools.tests.test_event_status -*-
+
+"""Compact per-message summaries of outbound message event statuses."""
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+from go.vumitools.utils import gather_in_order
+
+
+class MessageEventStatusStore(object):
+    """
+    Stores a compact status summary for each outbound message so that the
+    statuses of a page of messages can be fetched without loading their
+    events from Riak.
+
+    Summaries are kept in a hash per batch. A message is marked as `sending`
+    when it is stored and its summary is set by the first `ack` or `nack`
+    event for it. Later events don't change the summary. A batch's hash
+    expires `SUMMARY_TTL` seconds after it was last written to.
+
+    :type redis: TxRedisManager or RedisManager
+    :param redis:
+        Redis manager object.
+    """
+
+    SENDING = 'sending'
+    ACK = 'ack'
+    NACK = 'nack'
+
+    # Summaries are only used for display, so we don't keep them forever.
+    SUMMARY_TTL = 60 * 60 * 24 * 30
+
+    def __init__(self, redis):
+        self.manager = redis
+
+    @classmethod
+    def summary_for_event(cls, event):
+        """
+        Return the summary for `event`, or `None` if the event doesn't
+        change the status of its message.
+        """
+        if event['event_type'] == 'ack':
+            return cls.ACK
+        if event['event_type'] == 'nack':
+            return u'%s:%s' % (cls.NACK, event['nack_reason'])
+        return None
+
+    @classmethod
+    def parse_summary(cls, summary):
+        """
+        Return a `(status, reason)` tuple for a summary. `reason` is only set
+        for nacks.
+        """
+        status, _, reason = summary.partition(':')
+        return (status, reason or None)
+
+    def _sending_field(self, message_id):
+        # Marking a message as sending uses its own field so that the
+        # message's summary field is only ever set once, with HSETNX.
+        return u'%s:%s' % (message_id, self.SENDING)
+
+    @Manager.calls_manager
+    def _set_field(self, batch_id, field, value):
+        created = yield self.manager.hsetnx(batch_id, field, value)
+        yield self.manager.expire(batch_id, self.SUMMARY_TTL)
+        returnValue(created)
+
+    def mark_sending(self, batch_id, message_id):
+        """
+        Record that a message has been sent but has no ack or nack yet.
+        """
+        return self._set_field(
+            batch_id, self._sending_field(message_id), self.SENDING)
+
+    @Manager.calls_manager
+    def record_event(self, batch_id, event):
+        """
+        Set the summary for an event's message, unless it already has one.
+        """
+        summary = self.summary_for_event(event)
+        if summary is None:
+            return
+        yield self._set_field(batch_id, event['user_message_id'], summary)
+
+    def backfill(self, batch_id, message_id, summary):
+        """
+        Store a summary calculated from a message's stored events, unless
+        the message already has one.
+        """
+        return self._set_field(batch_id, message_id, summary)
+
+    @Manager.calls_manager
+    def get_summaries(self, batch_id, message_ids):
+        """
+        Return a list of summaries for `message_ids` in `batch_id`, with
+        `None` for messages that have neither a summary nor a `sending`
+        mark.
+        """
+        fields = []
+        for message_id in message_ids:
+            fields.extend([message_id, self._sending_field(message_id)])
+        values = yield gather_in_order(
+            self.manager.hget(batch_id, field) for field in fields)
+        summaries = []
+        for summary, sending in zip(values[::2], values[1::2]):
+            if summary is not None:
+                summary = summary.decode('utf-8')
+            elif sending is not None:
+                summary = self.SENDING
+            summaries.append(summary)
+        returnValue(summaries)
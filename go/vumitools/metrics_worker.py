@@ -1,12 +1,15 @@
 # -*- test-case-name: go.vumitools.tests.test_metrics_worker -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+import zlib
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred)
 from twisted.internet.task import LoopingCall
 
 from vumi import log
 from vumi.worker import BaseWorker
 from vumi.config import ConfigInt, ConfigError
-from vumi.persist.model import Manager
 
 from go.vumitools.api import VumiApiCommand, ApiCommandPublisher
 from go.vumitools.app_worker import GoWorkerConfigMixin, GoWorkerMixin
@@ -24,6 +27,11 @@ class GoMetricsWorkerConfig(BaseWorker.CONFIG_CLASS, GoWorkerConfigMixin):
 
        Once all buckets have been processed, active conversations are
        collected again and the cycle repeats.
+
+       Active conversations are read from the running conversation registry,
+       which is updated as conversations are started and stopped. Every
+       `running_conversations_rebuild_interval` seconds (and if it has never
+       been built) the registry is rebuilt from a full scan of all accounts.
        """
 
     metrics_interval = ConfigInt(
@@ -39,6 +47,19 @@ class GoMetricsWorkerConfig(BaseWorker.CONFIG_CLASS, GoWorkerConfigMixin):
         default=5,
         static=True)
 
+    running_conversations_rebuild_interval = ConfigInt(
+        "How often (in seconds) the running conversation registry should be "
+        "rebuilt from a full scan of all accounts. Set to zero to only "
+        "build it if it has never been built.",
+        default=86400,
+        static=True)
+
+    command_batch_size = ConfigInt(
+        "The maximum number of `collect_metrics` commands to publish at "
+        "once.",
+        default=100,
+        static=True)
+
     def post_validate(self):
         if (self.metrics_interval % self.metrics_granularity != 0):
             raise ConfigError("Metrics interval must be an integer multiple"
@@ -56,6 +77,7 @@ class GoMetricsWorker(BaseWorker, GoWorkerMixin):
 
     CONFIG_CLASS = GoMetricsWorkerConfig
     worker_name = 'go_metrics'
+    clock = reactor
 
     @inlineCallbacks
     def setup_worker(self):
@@ -69,7 +91,8 @@ class GoMetricsWorker(BaseWorker, GoWorkerMixin):
         self._num_buckets = (
             config.metrics_interval // config.metrics_granularity)
         self._buckets = dict((i, []) for i in range(self._num_buckets))
-        self._conversation_workers = {}
+        self._rebuild_interval = config.running_conversations_rebuild_interval
+        self._command_batch_size = config.command_batch_size
 
         self._looper = LoopingCall(self.metrics_loop_func)
         self._looper.start(config.metrics_granularity)
@@ -81,37 +104,84 @@ class GoMetricsWorker(BaseWorker, GoWorkerMixin):
         yield self._go_teardown_worker()
 
     def bucket_for_conversation(self, conv_key):
-        return hash(conv_key) % self._num_buckets
+        # We use crc32 rather than hash() so that conversations stay in the
+        # same bucket across restarts and platforms.
+        checksum = zlib.crc32(conv_key.encode('utf-8')) & 0xffffffff
+        return checksum % self._num_buckets
 
     @inlineCallbacks
-    def populate_conversation_buckets(self):
-        account_keys = yield self.find_account_keys()
-        num_conversations = 0
+    def registry_needs_rebuild(self):
+        """Return `True` if the running conversation registry has never been
+           rebuilt or was last rebuilt more than the rebuild interval ago.
+           """
+        registry = self.vumi_api.running_conversation_registry
+        last_rebuilt = yield registry.get_last_rebuilt()
+        if last_rebuilt is None:
+            returnValue(True)
+        if self._rebuild_interval <= 0:
+            returnValue(False)
+        returnValue(
+            self.clock.seconds() - last_rebuilt >= self._rebuild_interval)
+
+    @inlineCallbacks
+    def rebuild_running_conversations(self):
+        """Rebuild the running conversation registry from a full scan of all
+           accounts and return its new contents.
+           """
+        registry = self.vumi_api.running_conversation_registry
+        yield registry.start_rebuild()
+        scanned = []
+        keys = yield self.vumi_api.account_store.users.all_keys()
         # We deliberarely serialise this. We don't want to hit the datastore
         # too hard for metrics.
-        for account_key in account_keys:
+        for account_key in keys:
             conv_keys = yield self.find_conversations_for_account(account_key)
-            num_conversations += len(conv_keys)
+            user_api = self.vumi_api.get_user_api(account_key)
             for conv_key in conv_keys:
-                bucket = self.bucket_for_conversation(conv_key)
-                if conv_key not in self._conversation_workers:
-                    # TODO: Clear out archived conversations
-                    user_api = self.vumi_api.get_user_api(account_key)
-                    conv = yield user_api.get_wrapped_conversation(conv_key)
-                    self._conversation_workers[conv_key] = conv.worker_name
-                worker_name = self._conversation_workers[conv_key]
-                self._buckets[bucket].append(
-                    (account_key, conv_key, worker_name))
+                conv = yield user_api.get_wrapped_conversation(conv_key)
+                scanned.append((account_key, conv_key, conv.worker_name))
+        running = yield registry.finish_rebuild(
+            scanned, self.clock.seconds())
+        log.info("Rebuilt running conversation registry with %d conversations."
+                 % (len(running),))
+        returnValue(running)
+
+    @inlineCallbacks
+    def find_running_conversations(self):
+        """Return a list of `(account_key, conversation_key, worker_name)`
+           tuples for running conversations in accounts that don't have
+           metrics disabled.
+           """
+        needs_rebuild = yield self.registry_needs_rebuild()
+        if needs_rebuild:
+            running = yield self.rebuild_running_conversations()
+        else:
+            registry = self.vumi_api.running_conversation_registry
+            running = yield registry.list_running()
+        disabled_keys = yield self.redis.smembers('disabled_metrics_accounts')
+        disabled_keys = set(disabled_keys)
+        returnValue([conv for conv in running if conv[0] not in disabled_keys])
+
+    @inlineCallbacks
+    def populate_conversation_buckets(self):
+        running = yield self.find_running_conversations()
+        account_keys = set()
+        for account_key, conv_key, worker_name in running:
+            account_keys.add(account_key)
+            bucket = self.bucket_for_conversation(conv_key)
+            self._buckets[bucket].append((account_key, conv_key, worker_name))
         log.info(
             "Scheduled metrics commands for %d conversations in %d accounts."
-            % (num_conversations, len(account_keys)))
+            % (len(running), len(account_keys)))
 
     @inlineCallbacks
     def process_bucket(self, bucket):
         convs, self._buckets[bucket] = self._buckets[bucket], []
-        for account_key, conversation_key, worker_name in convs:
-            yield self.send_metrics_command(
-                account_key, conversation_key, worker_name)
+        batch_size = self._command_batch_size
+        for i in range(0, len(convs), batch_size):
+            yield gatherResults([
+                maybeDeferred(self.send_metrics_command, *conv)
+                for conv in convs[i:i + batch_size]])
 
     def increment_bucket(self):
         self._current_bucket += 1
@@ -127,12 +197,6 @@ class GoMetricsWorker(BaseWorker, GoWorkerMixin):
     def setup_connectors(self):
         pass
 
-    @Manager.calls_manager
-    def find_account_keys(self):
-        keys = yield self.vumi_api.account_store.users.all_keys()
-        disabled_keys = yield self.redis.smembers('disabled_metrics_accounts')
-        returnValue(set(keys) - set(disabled_keys))
-
     def find_conversations_for_account(self, account_key):
         user_api = self.vumi_api.get_user_api(account_key)
         return user_api.conversation_store.list_running_conversations()
@@ -4,9 +4,11 @@ import re
 import time
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 from twisted.internet.task import LoopingCall
 
+from vumi import log
+
 from vumi.config import (
     ConfigBool, ConfigDict, ConfigFloat, ConfigInt, ConfigList, ConfigRiak,
     ConfigText)
@@ -16,13 +18,15 @@ from vumi.middleware.message_storing import (
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.utils import normalize_msisdn
 from vumi.blinkenlights.metrics import (
-    MetricPublisher, Count, Metric, MetricManager, AVG, SUM)
+    MetricPublisher, Count, Metric, MetricManager, AVG, MAX, SUM)
 from vumi.errors import ConfigError
+from vumi.message import TransportUserMessage
 from vumi.persist.txredis_manager import TxRedisManager
 
 from go.vumitools.api import VumiApi
 from go.vumitools.model_object_cache import ModelObjectCache
 from go.vumitools.utils import MessageMetadataHelper
+from go.vumitools.write_behind import WriteBehindJournal, WriteBehindQueue
 
 
 class NormalizeMsisdnMiddlewareConfig(TransportMiddleware.CONFIG_CLASS):
@@ -611,12 +615,28 @@ class ConversationMetricsMiddlewareConfig(BaseMiddleware.CONFIG_CLASS):
     local_store_reset_timer = ConfigInt(
         "Time in seconds to store conversations keys for locally.",
         default=300, static=True)
+    flush_interval = ConfigFloat(
+        "Time in seconds between writes of newly seen conversations to"
+        " Redis.",
+        default=1, static=True)
+    flush_batch_size = ConfigInt(
+        "Number of newly seen conversations that triggers a write to Redis"
+        " before the next flush interval.",
+        default=100, static=True)
+    metrics_prefix = ConfigText(
+        "Prefix for flush size and latency metrics. If unset, these metrics"
+        " are not published.",
+        default=None, static=True)
 
 
 class ConversationMetricsMiddleware(BaseMiddleware):
     """
     Middleware that stores which conversations have received or sent messages
 
+    Newly seen conversations are buffered and added to Redis in a single
+    SADD every `flush_interval` seconds, or sooner if `flush_batch_size` of
+    them are waiting.
+
     :param dict redis_manager:
         Connection configuration details for Redis.
     :param dict riak_manager:
@@ -636,17 +656,64 @@ class ConversationMetricsMiddleware(BaseMiddleware):
             self.config.redis_manager)
         self.redis = self.redis_manager.sub_manager(self.SUBMANAGER_PREFIX)
         self.local_recent_convs = set()
+        self.pending_recent_convs = set()
+        self.metric_manager = None
+        if self.config.metrics_prefix is not None:
+            metric_publisher = yield self.worker.start_publisher(
+                MetricPublisher)
+            self.metric_manager = MetricManager(
+                self.config.metrics_prefix, publisher=metric_publisher)
+            self.metric_manager.register(
+                Metric('recent_convs.flush_size', [AVG, MAX, SUM]))
+            self.metric_manager.register(
+                Metric('recent_convs.flush_time', [AVG, MAX]))
+            self.metric_manager.start_polling()
         self._looper = LoopingCall(self.reset_local_recent_convs)
         self._looper.start(self.config.local_store_reset_timer)
+        self._flush_looper = LoopingCall(self.flush_recent_convs)
+        self._flush_looper.start(self.config.flush_interval, now=False)
 
+    @inlineCallbacks
     def teardown_middleware(self):
         if self._looper.running:
             self._looper.stop()
-        return self.redis_manager.close_manager()
+        if self._flush_looper.running:
+            self._flush_looper.stop()
+        yield self.flush_recent_convs()
+        if self.metric_manager is not None:
+            self.metric_manager.stop_polling()
+        yield self.redis_manager.close_manager()
 
     def reset_local_recent_convs(self):
         self.local_recent_convs.clear()
 
+    def flush_recent_convs(self):
+        """
+        Add the conversations seen since the last flush to Redis.
+
+        If the write fails, the conversations are kept for the next flush.
+        """
+        if not self.pending_recent_convs:
+            return succeed(None)
+        convs = self.pending_recent_convs
+        self.pending_recent_convs = set()
+        start = time.time()
+        # Note: This set will be emptied by a celery task that publishes
+        # the metrics for conversations we have seen
+        d = self.redis.sadd(self.RECENT_CONV_KEY, *convs)
+
+        def flushed(_):
+            if self.metric_manager is not None:
+                self.metric_manager['recent_convs.flush_size'].set(len(convs))
+                self.metric_manager['recent_convs.flush_time'].set(
+                    time.time() - start)
+
+        def flush_failed(failure):
+            log.err(failure, "Error adding recent conversations to Redis.")
+            self.pending_recent_convs.update(convs)
+
+        return d.addCallbacks(flushed, flush_failed)
+
     def record_conv_seen(self, msg):
         mdh = MessageMetadataHelper(None, msg)
         conv_key = mdh.get_conversation_key()
@@ -659,9 +726,9 @@ class ConversationMetricsMiddleware(BaseMiddleware):
 
         if conv_details not in self.local_recent_convs:
             self.local_recent_convs.add(conv_details)
-            # Note: This set will be emptied by a celery task that publishes
-            # the metrics for conversations we have seen
-            self.redis.sadd(self.RECENT_CONV_KEY, *self.local_recent_convs)
+            self.pending_recent_convs.add(conv_details)
+            if len(self.pending_recent_convs) >= self.config.flush_batch_size:
+                return self.flush_recent_convs()
 
     @inlineCallbacks
     def handle_inbound(self, message, connector_name):
@@ -682,9 +749,60 @@ class GoStoringMiddlewareConfig(StoringMiddlewareConfig):
     conversation_cache_ttl = ConfigInt(
         "Time in seconds to cache conversations for.",
         default=5, static=True)
+    conversation_cache_max_entries = ConfigInt(
+        "Maximum number of conversations to cache. If less than or equal to"
+        " zero, conversations will not be cached.",
+        default=10000, static=True)
+    write_behind = ConfigBool(
+        "If `true`, inbound and outbound messages are journalled to disk and"
+        " passed on immediately, and stored in the background.",
+        default=False, static=True)
+    write_behind_journal_path = ConfigText(
+        "Directory for the write-behind journal. Required if `write_behind`"
+        " is enabled. Each middleware instance needs its own directory.",
+        default=None, static=True)
+    write_behind_journal_fsync = ConfigBool(
+        "If `true`, sync the write-behind journal to disk after every write."
+        " This survives machine crashes as well as process crashes, but"
+        " blocks on the disk.",
+        default=False, static=True)
+    write_behind_batch_size = ConfigInt(
+        "Number of waiting writes that triggers a write-behind flush before"
+        " the next flush interval.",
+        default=100, static=True)
+    write_behind_flush_interval = ConfigFloat(
+        "Time in seconds between write-behind flushes.",
+        default=0.5, static=True)
+    write_behind_concurrency = ConfigInt(
+        "Maximum number of messages written concurrently by write-behind"
+        " flushes.",
+        default=5, static=True)
+    write_behind_max_attempts = ConfigInt(
+        "Number of times a write-behind write is attempted before the record"
+        " is moved to the journal's dead-letter file.",
+        default=5, static=True)
+    event_statuses = ConfigBool(
+        "If `true`, keep a status summary for each outbound message so that"
+        " message lists can show event statuses without loading events."
+        " Enable this if the `GO_ENABLE_EVENT_STATUSES_IN_MESSAGE_LIST` Django"
+        " setting is on.",
+        default=False, static=True)
 
 
 class GoStoringMiddleware(StoringMiddleware):
+    """
+    Middleware that stores messages in the batch of the conversation or
+    router they belong to.
+
+    If `write_behind` is enabled, inbound and outbound messages are
+    journalled to disk and stored in batches in the background instead of
+    delaying the message. Events for messages that haven't been stored yet
+    wait for them to be stored first.
+
+    If `event_statuses` is enabled, a status summary is also kept for each
+    outbound message so that message lists can show event statuses without
+    loading events.
+    """
 
     CONFIG_CLASS = GoStoringMiddlewareConfig
 
@@ -699,10 +817,29 @@ class GoStoringMiddleware(StoringMiddleware):
         # we use our own here to avoid duplicate lookups between messages for
         # the same conversation.
         self._conversation_cache = ModelObjectCache(
-            reactor, self.config.conversation_cache_ttl)
+            reactor, self.config.conversation_cache_ttl,
+            max_entries=self.config.conversation_cache_max_entries)
+        self.write_behind = None
+        if self.config.write_behind:
+            if self.config.write_behind_journal_path is None:
+                raise ConfigError(
+                    "write_behind_journal_path is required if write_behind"
+                    " is enabled.")
+            journal = WriteBehindJournal(
+                self.config.write_behind_journal_path,
+                fsync=self.config.write_behind_journal_fsync)
+            self.write_behind = WriteBehindQueue(
+                self.store_record, journal,
+                batch_size=self.config.write_behind_batch_size,
+                flush_interval=self.config.write_behind_flush_interval,
+                concurrency=self.config.write_behind_concurrency,
+                max_attempts=self.config.write_behind_max_attempts)
+            self.write_behind.start()
 
     @inlineCallbacks
     def teardown_middleware(self):
+        if self.write_behind is not None:
+            yield self.write_behind.stop()
         yield self._conversation_cache.cleanup()
         yield self.vumi_api.close()
         yield super(GoStoringMiddleware, self).teardown_middleware()
@@ -710,18 +847,65 @@ class GoStoringMiddleware(StoringMiddleware):
     def get_batch_id(self, msg):
         raise NotImplementedError("Sub-classes should implement .get_batch_id")
 
+    def store_record(self, record):
+        """
+        Store a message from a write-behind record.
+        """
+        message = TransportUserMessage.from_json(record['message'])
+        if record['direction'] == 'inbound':
+            return self.store.add_inbound_message(
+                message, batch_ids=[record['batch_id']])
+        return self.store.add_outbound_message(
+            message, batch_ids=[record['batch_id']])
+
     @inlineCallbacks
-    def handle_inbound(self, message, connector_name):
+    def store_message(self, direction, message):
+        """
+        Store a message (or queue it for storage) and return its batch id.
+        """
         batch_id = yield self.get_batch_id(message)
-        yield self.store.add_inbound_message(message, batch_ids=[batch_id])
+        if self.write_behind is not None:
+            self.write_behind.add({
+                'key': message['message_id'],
+                'batch_id': batch_id,
+                'direction': direction,
+                'message': message.to_json(),
+            })
+        elif direction == 'inbound':
+            yield self.store.add_inbound_message(message, batch_ids=[batch_id])
+        else:
+            yield self.store.add_outbound_message(
+                message, batch_ids=[batch_id])
+        returnValue(batch_id)
+
+    @inlineCallbacks
+    def handle_inbound(self, message, connector_name):
+        yield self.store_message('inbound', message)
         returnValue(message)
 
     @inlineCallbacks
     def handle_outbound(self, message, connector_name):
-        batch_id = yield self.get_batch_id(message)
-        yield self.store.add_outbound_message(message, batch_ids=[batch_id])
+        batch_id = yield self.store_message('outbound', message)
+        if self.config.event_statuses:
+            yield self.vumi_api.message_event_statuses.mark_sending(
+                batch_id, message['message_id'])
         returnValue(message)
 
+    @inlineCallbacks
+    def handle_event(self, event, connector_name):
+        if self.write_behind is not None:
+            # The message store looks up the event's message to find its
+            # batches, so it needs to be stored first.
+            yield self.write_behind.wait_for(event['user_message_id'])
+        event = yield super(GoStoringMiddleware, self).handle_event(
+            event, connector_name)
+        statuses = self.vumi_api.message_event_statuses
+        if (self.config.event_statuses and
+                statuses.summary_for_event(event) is not None):
+            batch_id = yield self.get_batch_id(event)
+            yield statuses.record_event(batch_id, event)
+        returnValue(event)
+
 
 class ConversationStoringMiddleware(GoStoringMiddleware):
     @inlineCallbacks
@@ -1,64 +1,207 @@
-from twisted.internet.defer import inlineCallbacks, returnValue
+# -*- test-case-name: go.vumitools.tests.test_model_object_cache -*-
+
+import math
+from collections import OrderedDict
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+
+from vumi.blinkenlights.metrics import Count
 
 
 class ModelObjectCache(object):
     """
-    Low-TTL cache for model data to avoid hitting Riak too much.
+    Low-TTL, size-bounded cache for model data to avoid hitting Riak too much.
+
+    Cached models are evicted when their TTL expires or, if the cache has a
+    maximum size, when they are the least recently used model and space is
+    needed for a new one. A TTL or maximum size less than or equal to zero
+    disables caching.
+
+    Expiry is handled by a single shared timer wheel: models are placed in a
+    slot based on their expiry time and a single delayed call evicts all the
+    models in the earliest slot when it fires. Models may therefore outlive
+    their TTL by up to `resolution` seconds, but never expire early.
+
+    Concurrent gets for the same uncached key share a single fetch. Fetches
+    that are in flight when :meth:`cleanup` is called still return their
+    models to the callers waiting for them, but don't put them in the cache.
+
+    Hit, miss and eviction counts are kept in :attr:`stats` and are also
+    published as metrics named `<metric_name>.hits`, etc. if a metric manager
+    is provided.
     """
-    def __init__(self, reactor, ttl):
+
+    STATS = ('hits', 'misses', 'evictions', 'expirations')
+
+    def __init__(self, reactor, ttl, max_entries=None, resolution=None,
+                 metric_manager=None, metric_name='model_object_cache'):
         self._reactor = reactor
         self._ttl = ttl
-        self._models = {}
-        self._evictors = {}
+        self._max_entries = max_entries
+        if resolution is None:
+            resolution = ttl / 10.0
+        self._resolution = resolution
+        self._models = OrderedDict()
+        # Timer wheel state: slot -> keys expiring in that slot, key -> slot.
+        self._slots = {}
+        self._expiry_slots = {}
+        self._expirer = None
+        # Pending fetches: key -> list of deferreds waiting for the model.
+        self._pending = {}
+        # Bumped by cleanup() so that fetches started before it aren't cached.
+        self._generation = 0
+        self.stats = dict((name, 0) for name in self.STATS)
+        self._metrics = {}
+        if metric_manager is not None:
+            for name in self.STATS:
+                self._metrics[name] = metric_manager.register(
+                    Count('%s.%s' % (metric_name, name)))
+
+    def _record(self, name):
+        self.stats[name] += 1
+        metric = self._metrics.get(name)
+        if metric is not None:
+            metric.inc()
+
+    def _slot_for_time(self, when):
+        return int(math.ceil(when / self._resolution))
+
+    def _schedule_expirer(self):
+        """
+        Make sure the shared expiry timer fires for the earliest slot.
+        """
+        if not self._slots:
+            if self._expirer is not None and self._expirer.active():
+                self._expirer.cancel()
+            self._expirer = None
+            return
+        when = min(self._slots) * self._resolution
+        if self._expirer is not None and self._expirer.active():
+            if self._expirer.getTime() <= when:
+                return
+            self._expirer.cancel()
+        delay = max(0, when - self._reactor.seconds())
+        self._expirer = self._reactor.callLater(delay, self._expire_models)
+
+    def _expire_models(self):
+        """
+        Evict all models in slots that have expired.
+        """
+        self._expirer = None
+        # The small fudge factor protects against floating point rounding
+        # putting us in the slot before the one we were scheduled for.
+        current_slot = int(math.floor(
+            self._reactor.seconds() / self._resolution + 1e-9))
+        for slot in sorted(self._slots):
+            if slot > current_slot:
+                break
+            for key in self._slots.pop(slot):
+                del self._expiry_slots[key]
+                del self._models[key]
+                self._record('expirations')
+        self._schedule_expirer()
+
+    def _unschedule_eviction(self, key):
+        slot = self._expiry_slots.pop(key, None)
+        if slot is None:
+            return
+        slot_keys = self._slots[slot]
+        slot_keys.discard(key)
+        if not slot_keys:
+            del self._slots[slot]
 
     def evict_model_entry(self, key):
         """
         Remove an model from the cache.
         """
         del self._models[key]
-        del self._evictors[key]
+        self._unschedule_eviction(key)
 
     def schedule_eviction(self, key):
         """
         Schedule the eviction of a cached model.
         """
-        if key in self._evictors:
-            # We already have an evictor for this model, so we don't
-            # need a new one.
+        if key in self._expiry_slots:
+            # We already have an eviction scheduled for this model, so we
+            # don't need a new one.
             return
-        delayed_call = self._reactor.callLater(
-            self._ttl, self.evict_model_entry, key)
-        self._evictors[key] = delayed_call
+        slot = self._slot_for_time(self._reactor.seconds() + self._ttl)
+        self._slots.setdefault(slot, set()).add(key)
+        self._expiry_slots[key] = slot
+        self._schedule_expirer()
+
+    def _store_model(self, key, model):
+        if key in self._models:
+            # Replace the existing model and mark it as recently used.
+            del self._models[key]
+        elif self._max_entries is not None:
+            while len(self._models) >= self._max_entries:
+                lru_key = next(iter(self._models))
+                self.evict_model_entry(lru_key)
+                self._record('evictions')
+        self._models[key] = model
+        self.schedule_eviction(key)
 
     def cleanup(self):
         """
         Clean up all remaining state.
+
+        Gets after this start a fresh fetch even if a fetch for the same key
+        is still in flight.
         """
-        # We use .items() instead of .iteritems() here because we modify
-        # self._evictors in the loop.
-        for key, delayed_call in self._evictors.items():
-            delayed_call.cancel()
-            self.evict_model_entry(key)
+        self._generation += 1
+        self._pending.clear()
+        self._models.clear()
+        self._slots.clear()
+        self._expiry_slots.clear()
+        self._schedule_expirer()
+
+    def _finish_fetch(self, key, waiters):
+        if self._pending.get(key) is waiters:
+            del self._pending[key]
+
+    def _fetch_done(self, model, key, waiters, generation):
+        self._finish_fetch(key, waiters)
+        if generation == self._generation:
+            self._store_model(key, model)
+        for d in waiters:
+            d.callback(model)
+
+    def _fetch_failed(self, failure, key, waiters):
+        self._finish_fetch(key, waiters)
+        for d in waiters:
+            d.errback(failure)
 
-    @inlineCallbacks
     def get_model(self, model_getter, key):
         """
         Return the model using the provided getter function and key.
 
         If the model is not cached, it will be fetched from Riak. If
         caching is not disabled, it will also be added to the cache and
-        eviction scheduled.
+        eviction scheduled. Any gets for the same key while the fetch is in
+        progress will wait for it rather than fetching the model again.
         """
-        if key not in self._models:
-            # Fetching the model returns control to the reactor and
-            # gives other things the opportunity to cache the model
-            # behind our back. If this happens, we replace the cached model
-            # (the one we fetched may be newer) and let schedule_eviction()
-            # worry about the existing evictor.
-            model = yield model_getter(key)
-            if self._ttl <= 0:
-                # Special case for disabled cache.
-                returnValue(model)
+        if self._ttl <= 0 or (
+                self._max_entries is not None and self._max_entries <= 0):
+            # Special case for disabled cache.
+            return maybeDeferred(model_getter, key)
+
+        if key in self._models:
+            self._record('hits')
+            model = self._models.pop(key)
             self._models[key] = model
-            self.schedule_eviction(key)
-        returnValue(self._models[key])
+            return succeed(model)
+
+        self._record('misses')
+        d = Deferred()
+        if key in self._pending:
+            self._pending[key].append(d)
+            return d
+
+        waiters = self._pending[key] = [d]
+        fetch_d = maybeDeferred(model_getter, key)
+        fetch_d.addCallbacks(
+            self._fetch_done, self._fetch_failed,
+            callbackArgs=(key, waiters, self._generation),
+            errbackArgs=(key, waiters))
+        return d
@@ -1,4 +1,4 @@
-from go.vumitools.opt_out.models import OptOut, OptOutStore
+from go.vumitools.opt_out.models import OptOut, OptOutSnapshot, OptOutStore
 
 
-__all__ = ['OptOut', 'OptOutStore']
+__all__ = ['OptOut', 'OptOutSnapshot', 'OptOutStore']
@@ -1,6 +1,7 @@
 # -*- test-case-name: go.apps.opt_out.tests.test_vumi_app -*-
 
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
 from twisted.internet.defer import returnValue
 
@@ -14,10 +15,84 @@ class OptOut(Model):
     """An opt_out"""
     user_account = ForeignKey(UserAccount)
     message = Unicode(null=True)
-    created_at = Timestamp(default=datetime.utcnow)
+    created_at = Timestamp(default=datetime.utcnow, index=True)
+
+
+class OptOutSnapshot(object):
+    """
+    An in-memory copy of the opt-out keys for an account.
+
+    This lets us check a large number of addresses for opt-outs without a
+    Riak lookup for each one. All the keys are loaded the first time they're
+    needed. After that, once the snapshot is more than `max_age` seconds old,
+    only the keys of opt-outs created since the last refresh are loaded, so
+    refreshing is cheap and opt-outs created in the meantime are missed for
+    at most `max_age` seconds. Opt-outs may also be deleted, so any matches
+    are confirmed against Riak.
+
+    Snapshots are intended for use by a single bulk operation at a time and
+    shouldn't be checked concurrently.
+    """
+
+    # Opt-outs are timestamped by whichever process creates them, so we
+    # look back a little further than the last refresh in case its clock is
+    # behind ours.
+    CLOCK_SKEW = timedelta(seconds=60)
+
+    def __init__(self, opt_out_store, max_age):
+        self.opt_out_store = opt_out_store
+        self.max_age = max_age
+        self.keys = None
+        self.taken_at = None
+        self.loaded_since = None
+
+    def is_stale(self):
+        return self.keys is None or (
+            time.time() - self.taken_at >= self.max_age)
+
+    def _encode_keys(self, keys):
+        return [
+            key.encode('utf-8') if isinstance(key, unicode) else key
+            for key in keys]
+
+    @Manager.calls_manager
+    def refresh(self):
+        """
+        Load the opt-out keys a page at a time the first time we're called,
+        and the keys of any opt-outs created since the last refresh after
+        that.
+        """
+        taken_at = time.time()
+        loaded_since = datetime.utcnow()
+        if self.keys is None:
+            keys = set()
+            page = yield self.opt_out_store.list_opt_outs_page(
+                max_results=self.opt_out_store.OPT_OUT_KEYS_PAGE_SIZE)
+            while page is not None:
+                keys.update(self._encode_keys(page))
+                page = yield page.next_page()
+            self.keys = frozenset(keys)
+        else:
+            new_keys = yield self.opt_out_store.list_opt_outs_created_since(
+                self.loaded_since - self.CLOCK_SKEW)
+            self.keys = self.keys.union(self._encode_keys(new_keys))
+        self.taken_at = taken_at
+        self.loaded_since = loaded_since
+
+    @Manager.calls_manager
+    def is_opted_out(self, addr_type, addr_value):
+        if self.is_stale():
+            yield self.refresh()
+        if self.opt_out_store.opt_out_id(addr_type, addr_value) not in (
+                self.keys):
+            returnValue(False)
+        opt_out = yield self.opt_out_store.get_opt_out(addr_type, addr_value)
+        returnValue(opt_out is not None)
 
 
 class OptOutStore(PerAccountStore):
+    OPT_OUT_KEYS_PAGE_SIZE = 1000
+
     def setup_proxies(self):
         self.opt_outs = self.manager.proxy(OptOut)
 
@@ -44,6 +119,11 @@ class OptOutStore(PerAccountStore):
     def get_opt_out(self, addr_type, addr_value):
         return self.opt_outs.load(self.opt_out_id(addr_type, addr_value))
 
+    @Manager.calls_manager
+    def is_opted_out(self, addr_type, addr_value):
+        opt_out = yield self.get_opt_out(addr_type, addr_value)
+        returnValue(opt_out is not None)
+
     @Manager.calls_manager
     def delete_opt_out(self, addr_type, addr_value):
         opt_out = yield self.get_opt_out(addr_type, addr_value)
@@ -53,6 +133,24 @@ class OptOutStore(PerAccountStore):
     def list_opt_outs(self):
         return self.list_keys(self.opt_outs)
 
+    def list_opt_outs_page(self, max_results=None, continuation=None):
+        return self.list_keys_page(
+            self.opt_outs, max_results=max_results, continuation=continuation)
+
+    def list_opt_outs_created_since(self, since):
+        """
+        List the keys of opt-outs created at or after `since`, a UTC
+        datetime. Opt-outs created before `created_at` was indexed aren't
+        included.
+        """
+        return self.opt_outs.index_keys('created_at', since, datetime.max)
+
+    def snapshot(self, max_age=5):
+        """
+        Return an :class:`OptOutSnapshot` for checking many addresses.
+        """
+        return OptOutSnapshot(self, max_age)
+
     def count(self):
         return self.opt_outs.index_lookup(
             'user_account', self.user_account_key).get_count()
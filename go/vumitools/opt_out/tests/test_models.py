@@ -8,6 +8,7 @@ from twisted.internet.defer import inlineCallbacks
 
 from vumi.tests.helpers import VumiTestCase
 
+from go.vumitools.opt_out import models as opt_out_models
 from go.vumitools.opt_out.models import OptOutStore
 from go.vumitools.tests.helpers import GoMessageHelper, VumiApiHelper
 
@@ -97,3 +98,111 @@ class TestOptOutStore(VumiTestCase):
         yield store.new_opt_out(
             "msisdn", "+1234", self.msg_helper.make_inbound("inbound"))
         self.assertEqual((yield store.count()), 1)
+
+    @inlineCallbacks
+    def test_is_opted_out(self):
+        store = self.opt_out_store
+        self.assertEqual((yield store.is_opted_out("msisdn", "+1234")), False)
+        yield store.new_opt_out(
+            "msisdn", "+1234", self.msg_helper.make_inbound("inbound"))
+        self.assertEqual((yield store.is_opted_out("msisdn", "+1234")), True)
+
+    @inlineCallbacks
+    def test_list_opt_outs_created_since(self):
+        store = self.opt_out_store
+        yield store.new_opt_out(
+            "msisdn", "+1234", self.msg_helper.make_inbound("inbound"))
+        since = datetime.utcnow()
+        yield store.new_opt_out(
+            "msisdn", "+5678", self.msg_helper.make_inbound("inbound"))
+        keys = yield store.list_opt_outs_created_since(since)
+        self.assertEqual(keys, [u"msisdn:+5678"])
+
+
+class TestOptOutSnapshot(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.vumi_helper = yield self.add_helper(VumiApiHelper())
+        self.user_helper = yield self.vumi_helper.make_user(u'user')
+        user_account = yield self.user_helper.get_user_account()
+        self.opt_out_store = OptOutStore.from_user_account(user_account)
+        self.msg_helper = self.add_helper(GoMessageHelper())
+        self.now = 1000.0
+        self.patch(opt_out_models.time, 'time', lambda: self.now)
+
+    def new_opt_out(self, addr):
+        return self.opt_out_store.new_opt_out(
+            "msisdn", addr, self.msg_helper.make_inbound("inbound"))
+
+    @inlineCallbacks
+    def test_is_opted_out(self):
+        yield self.new_opt_out("+1234")
+        snapshot = self.opt_out_store.snapshot(max_age=60)
+        self.assertTrue(snapshot.is_stale())
+        self.assertEqual(
+            (yield snapshot.is_opted_out("msisdn", "+1234")), True)
+        self.assertEqual(
+            (yield snapshot.is_opted_out("msisdn", "+5678")), False)
+        self.assertFalse(snapshot.is_stale())
+        self.assertEqual(snapshot.keys, frozenset(["msisdn:+1234"]))
+
+    @inlineCallbacks
+    def test_refresh_pages(self):
+        """
+        Opt-out keys are loaded a page at a time.
+        """
+        self.patch(self.opt_out_store, 'OPT_OUT_KEYS_PAGE_SIZE', 2)
+        for i in range(5):
+            yield self.new_opt_out("+%s" % (i,))
+        snapshot = self.opt_out_store.snapshot()
+        yield snapshot.refresh()
+        self.assertEqual(
+            snapshot.keys, frozenset("msisdn:+%s" % (i,) for i in range(5)))
+
+    @inlineCallbacks
+    def test_is_opted_out_deleted(self):
+        """
+        Opt-outs that have been deleted since the snapshot was taken aren't
+        reported.
+        """
+        yield self.new_opt_out("+1234")
+        snapshot = self.opt_out_store.snapshot(max_age=60)
+        yield snapshot.refresh()
+        yield self.opt_out_store.delete_opt_out("msisdn", "+1234")
+        self.assertEqual(
+            (yield snapshot.is_opted_out("msisdn", "+1234")), False)
+
+    @inlineCallbacks
+    def test_is_opted_out_refreshes_stale_snapshot(self):
+        snapshot = self.opt_out_store.snapshot(max_age=60)
+        yield snapshot.refresh()
+        yield self.new_opt_out("+1234")
+        self.assertEqual(
+            (yield snapshot.is_opted_out("msisdn", "+1234")), False)
+
+        self.now += 60
+        self.assertTrue(snapshot.is_stale())
+        self.assertEqual(
+            (yield snapshot.is_opted_out("msisdn", "+1234")), True)
+
+    @inlineCallbacks
+    def test_refresh_loads_new_opt_outs_only(self):
+        """
+        Once a snapshot has been loaded, refreshing it only loads opt-outs
+        created since.
+        """
+        yield self.new_opt_out("+1234")
+        snapshot = self.opt_out_store.snapshot(max_age=5)
+        yield snapshot.refresh()
+        self.assertEqual(snapshot.keys, frozenset(["msisdn:+1234"]))
+
+        def list_opt_outs_page(*args, **kw):
+            self.fail("Opt-outs listed again.")
+        self.patch(
+            self.opt_out_store, 'list_opt_outs_page', list_opt_outs_page)
+
+        yield self.new_opt_out("+5678")
+        yield snapshot.refresh()
+        self.assertEqual(
+            snapshot.keys, frozenset(["msisdn:+1234", "msisdn:+5678"]))
@@ -1,15 +1,16 @@
 # -*- test-case-name: go.vumitools.tests.test_routing -*-
 
+import json
+
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.internet import reactor
 
 from vumi.dispatchers.endpoint_dispatchers import RoutingTableDispatcher
-from vumi.config import ConfigDict, ConfigText, ConfigFloat, ConfigBool
+from vumi.config import (
+    ConfigDict, ConfigText, ConfigFloat, ConfigBool, ConfigInt)
 from vumi.message import TransportEvent
 from vumi import log
 
 from go.vumitools.app_worker import GoWorkerMixin, GoWorkerConfigMixin
-from go.vumitools.model_object_cache import ModelObjectCache
 from go.vumitools.routing_table import GoConnector
 from go.vumitools.opt_out.utils import OptOutHelper
 
@@ -41,6 +42,52 @@ class NoTargetError(RoutingError):
 REPLYABLE_ERRORS = (UnownedTagError, NoTargetError)
 
 
+class CompiledRoutingTable(object):
+    """A precompiled snapshot of an account's routing table.
+
+    Holds everything the dispatcher needs to route a message for an account
+    that can be computed once per routing table rather than once per
+    message:
+
+    * the dispatcher config for the account (including the raw routing
+      table),
+    * the parsed :class:`GoConnector` for every target in the routing table,
+    * the metadata for every tagpool referenced by a transport tag target.
+
+    Connectors that aren't targets in the routing table (e.g. the sources
+    replies to unroutable messages are sent back to) are parsed on demand
+    and remembered.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._connectors = {}
+        self._tagpool_metadata = {}
+
+    def get_connector(self, conn_str):
+        """Return the parsed :class:`GoConnector` for `conn_str`."""
+        conn = self._connectors.get(conn_str)
+        if conn is None:
+            conn = GoConnector.parse(conn_str)
+            self._connectors[conn_str] = conn
+        return conn
+
+    def add_connector(self, conn):
+        self._connectors[str(conn)] = conn
+
+    def connectors(self):
+        return self._connectors.values()
+
+    def get_tagpool_metadata(self, tagpool):
+        """Return the compiled metadata for `tagpool` or `None` if the
+        tagpool isn't referenced by the routing table.
+        """
+        return self._tagpool_metadata.get(tagpool)
+
+    def set_tagpool_metadata(self, tagpool, metadata):
+        self._tagpool_metadata[tagpool] = metadata
+
+
 class RoutingMetadata(object):
     """Helps manage Vumi Go routing metadata on a message.
 
@@ -192,6 +239,80 @@ class RoutingMetadata(object):
         return (dst == outbound_dst and src == outbound_src)
 
 
+class OutboundHops(object):
+    """
+    The routing metadata from an outbound message that is needed to route
+    its events.
+
+    :param list hops: The hops the outbound message took.
+    :param tag: The tag the outbound message was sent with, or ``None``.
+    :param user_account:
+        The key of the account that sent the outbound message, or ``None``.
+    :param bool unroutable:
+        Whether the outbound message is a reply to an unroutable inbound
+        message.
+    :param msg:
+        The outbound message, if we have it. This is only used for error
+        messages.
+    """
+
+    def __init__(self, hops, tag, user_account, unroutable, msg=None):
+        self.hops = hops
+        self.tag = tag
+        self.user_account = user_account
+        self.unroutable = unroutable
+        self.msg = msg
+
+    def __repr__(self):
+        if self.msg is not None:
+            return repr(self.msg)
+        return '<OutboundHops %r>' % (self.to_dict(),)
+
+    def to_dict(self):
+        return {
+            'hops': self.hops,
+            'tag': self.tag,
+            'user_account': self.user_account,
+            'unroutable': self.unroutable,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        tag = data['tag']
+        return cls(data['hops'], tuple(tag) if tag is not None else None,
+                   data['user_account'], data['unroutable'])
+
+
+class OutboundHopsIndex(object):
+    """
+    Redis index of :class:`OutboundHops` for outbound messages, keyed by
+    message id.
+
+    This lets us route events without loading the outbound message from the
+    message store. Entries expire after `ttl` seconds, after which we fall
+    back to the message store.
+    """
+
+    def __init__(self, redis, ttl):
+        self.redis = redis
+        self.ttl = ttl
+
+    def add(self, message_id, outbound_hops):
+        return self.redis.setex(
+            message_id, self.ttl, json.dumps(outbound_hops.to_dict()))
+
+    @inlineCallbacks
+    def get(self, message_id):
+        """
+        Return the :class:`OutboundHops` for a message, or ``None`` if the
+        message isn't in the index.
+        """
+        data = yield self.redis.get(message_id)
+        if data is None:
+            returnValue(None)
+        returnValue(OutboundHops.from_dict(json.loads(data)))
+
+
 class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
                                           GoWorkerConfigMixin):
     application_connector_mapping = ConfigDict(
@@ -223,9 +344,31 @@ class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
         default="Vumi Go could not route your message. Please try again soon.",
         static=True, required=False)
     account_cache_ttl = ConfigFloat(
-        "TTL (in seconds) for cached accounts. If less than or equal to"
-        " zero, routing tables will not be cached.",
+        "TTL (in seconds) for cached accounts and compiled routing tables."
+        " Compiled routing tables are built from a fresh account load, so"
+        " routing table changes are seen within this time. If less than or"
+        " equal to zero, routing tables will not be cached.",
         static=True, default=5)
+    account_cache_max_entries = ConfigInt(
+        "Maximum number of accounts (and compiled routing tables) to cache."
+        " The least recently used accounts are evicted when the cache is"
+        " full.",
+        static=True, default=10000)
+    tag_cache_ttl = ConfigFloat(
+        "TTL (in seconds) for cached tag owners and tagpool metadata. Cached"
+        " tag owners are also discarded whenever a tag is acquired or"
+        " released. If less than or equal to zero, tag owners and tagpool"
+        " metadata will not be cached.",
+        static=True, default=5)
+    tag_cache_max_entries = ConfigInt(
+        "Maximum number of tag owners to cache.",
+        static=True, default=100000)
+    outbound_hops_ttl = ConfigInt(
+        "TTL (in seconds) for the routing metadata of outbound messages to"
+        " transports, which is kept in Redis so that events can be routed"
+        " without loading the outbound message from the message store. If"
+        " less than or equal to zero, the metadata is not kept.",
+        static=True, default=86400)
     store_messages_to_transports = ConfigBool(
         "If true (the default), outbound messages to transports will be"
         " written to the message store.",
@@ -234,6 +377,10 @@ class AccountRoutingTableDispatcherConfig(RoutingTableDispatcher.CONFIG_CLASS,
         "Configuration options for the opt out helper",
         static=True, default={})
 
+    # Set by the dispatcher on the per-account configs it builds. This is a
+    # plain attribute rather than a config field.
+    compiled_routing = None
+
 
 class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
     """
@@ -310,8 +457,19 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         yield super(AccountRoutingTableDispatcher, self).setup_dispatcher()
         yield self._go_setup_worker()
         config = self.get_static_config()
-        self.account_cache = ModelObjectCache(
-            reactor, config.account_cache_ttl)
+        self.account_cache = self.make_model_cache(
+            'account_cache', config.account_cache_ttl,
+            config.account_cache_max_entries)
+        self.routing_cache = self.make_model_cache(
+            'routing_cache', config.account_cache_ttl,
+            config.account_cache_max_entries)
+        self.tag_owner_cache = self.make_model_cache(
+            'tag_owner_cache', config.tag_cache_ttl,
+            config.tag_cache_max_entries)
+        self.tagpool_metadata_cache = self.make_model_cache(
+            'tagpool_metadata_cache', config.tag_cache_ttl, None)
+        self._tag_ownership_version = None
+        self._event_config = None
 
         # Opt out and billing connectors
         self.opt_out_connector = config.opt_out_connector
@@ -345,8 +503,17 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         self.optouts = OptOutHelper(self.vumi_api, config.optouts)
 
+        self.outbound_hops_index = None
+        if config.outbound_hops_ttl > 0:
+            self.outbound_hops_index = OutboundHopsIndex(
+                self.redis.sub_manager('outbound_hops'),
+                config.outbound_hops_ttl)
+
     @inlineCallbacks
     def teardown_dispatcher(self):
+        yield self.tagpool_metadata_cache.cleanup()
+        yield self.tag_owner_cache.cleanup()
+        yield self.routing_cache.cleanup()
         yield self.account_cache.cleanup()
         yield self._go_teardown_worker()
         yield super(AccountRoutingTableDispatcher, self).teardown_dispatcher()
@@ -358,6 +525,89 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         return self.account_cache.get_model(
             user_api.api.get_user_account, user_api.user_account_key)
 
+    @inlineCallbacks
+    def get_tag_owner(self, tag):
+        """
+        Get the key of the account that owns a tag through the cache.
+
+        The whole cache is discarded if any tag has been acquired or released
+        since we last looked.
+        """
+        version = yield self.vumi_api.get_tag_ownership_version()
+        if version != self._tag_ownership_version:
+            yield self.tag_owner_cache.cleanup()
+            self._tag_ownership_version = version
+        owner = yield self.tag_owner_cache.get_model(
+            self._fetch_tag_owner, tuple(tag))
+        returnValue(owner)
+
+    @inlineCallbacks
+    def _fetch_tag_owner(self, tag):
+        tag_info = yield self.vumi_api.mdb.get_tag_info(tag)
+        returnValue(tag_info.metadata['user_account'])
+
+    def get_tagpool_metadata(self, tagpool):
+        """
+        Get the metadata for a tagpool through the cache.
+        """
+        return self.tagpool_metadata_cache.get_model(
+            self.vumi_api.tpm.get_metadata, tagpool)
+
+    def get_compiled_routing(self, user_account_key):
+        """
+        Get the compiled routing table for an account through the cache.
+        """
+        return self.routing_cache.get_model(
+            self.compile_routing, user_account_key)
+
+    @inlineCallbacks
+    def compile_routing(self, user_account_key):
+        """Build a :class:`CompiledRoutingTable` for the given account.
+
+        This does all the per-account work that would otherwise be repeated
+        for every message: building the config, parsing the target
+        connectors and fetching the tagpool metadata for transport tags.
+
+        The account is loaded directly rather than through the account
+        cache, so a cached compiled routing table is never more than
+        `account_cache_ttl` seconds older than the account it came from.
+        """
+        user_api = self.get_user_api(user_account_key)
+        routing_table = yield user_api.get_routing_table()
+
+        config_dict = self.config.copy()
+        config_dict['user_account_key'] = user_account_key
+        config_dict['routing_table'] = routing_table._routing_table
+        config = self.CONFIG_CLASS(config_dict)
+
+        compiled = CompiledRoutingTable(config)
+        config.compiled_routing = compiled
+
+        tagpools = set()
+        for _src_conn, _src_ep, dst_conn, _dst_ep in routing_table.entries():
+            compiled.add_connector(dst_conn)
+            if dst_conn.ctype == GoConnector.TRANSPORT_TAG:
+                tagpools.add(dst_conn.tagpool)
+
+        for tagpool in tagpools:
+            metadata = yield self.get_tagpool_metadata(tagpool)
+            compiled.set_tagpool_metadata(tagpool, metadata)
+
+        returnValue(compiled)
+
+    def get_event_config(self):
+        """Return the config used for all events.
+
+        Events largely ignore the routing table, so they all share a single
+        config that is built once.
+        """
+        if self._event_config is None:
+            config_dict = self.config.copy()
+            config_dict['user_account_key'] = None
+            config_dict['routing_table'] = {}
+            self._event_config = self.CONFIG_CLASS(config_dict)
+        return self._event_config
+
     @inlineCallbacks
     def get_config(self, msg):
         """Determine the config (primarily the routing table) for the given
@@ -371,18 +621,14 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         a transport and has a tag.
         """
         if isinstance(msg, TransportEvent):
-            config_dict = self.config.copy()
-            config_dict['user_account_key'] = None
-            config_dict['routing_table'] = {}
-            returnValue(self.CONFIG_CLASS(config_dict))
+            returnValue(self.get_event_config())
 
         msg_mdh = self.get_metadata_helper(msg)
 
         if msg_mdh.has_user_account():
             user_account_key = msg_mdh.get_account_key()
         elif msg_mdh.tag is not None:
-            tag_info = yield self.vumi_api.mdb.get_tag_info(msg_mdh.tag)
-            user_account_key = tag_info.metadata['user_account']
+            user_account_key = yield self.get_tag_owner(msg_mdh.tag)
             if user_account_key is None:
                 raise UnownedTagError(
                     "Message received for unowned tag.", msg)
@@ -390,15 +636,8 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             raise UnroutableMessageError(
                 "No user account key or tag on message", msg)
 
-        user_api = self.get_user_api(user_account_key)
-        account = yield self.get_user_account(user_api)
-        routing_table = yield user_api.get_routing_table(account)
-
-        config_dict = self.config.copy()
-        config_dict['user_account_key'] = user_account_key
-        config_dict['routing_table'] = routing_table._routing_table
-
-        returnValue(self.CONFIG_CLASS(config_dict))
+        compiled = yield self.get_compiled_routing(user_account_key)
+        returnValue(compiled.config)
 
     def connector_type(self, connector_name):
         if connector_name in self.billing_connectors:
@@ -437,18 +676,25 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         return router_direction
 
     @inlineCallbacks
-    def set_destination(self, msg, target, direction, push_hops=True):
+    def set_destination(self, msg, target, direction, push_hops=True,
+                        routing=None):
         """Parse a target `(str(go_connector), endpoint)` pair and determine
         the corresponding dispatcher connector to publish on. Set any
         appropriate Go helper_metadata required by the destination.
 
+        If a :class:`CompiledRoutingTable` is given as `routing`, the parsed
+        connector and tagpool metadata are taken from it where possible.
+
         Raises `UnroutableMessageError` if the parsed `GoConnector` has a
         connector type not approriate to the message direction.
 
         Note: `str(go_connector)` is what is stored in Go routing tables.
         """
         msg_mdh = self.get_metadata_helper(msg)
-        conn = GoConnector.parse(target[0])
+        if routing is not None:
+            conn = routing.get_connector(target[0])
+        else:
+            conn = GoConnector.parse(target[0])
 
         if direction == self.INBOUND:
             allowed_types = (
@@ -472,7 +718,12 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
 
         elif conn.ctype == conn.TRANSPORT_TAG:
             msg_mdh.set_tag([conn.tagpool, conn.tagname])
-            tagpool_metadata = yield msg_mdh.get_tagpool_metadata()
+            tagpool_metadata = None
+            if routing is not None:
+                tagpool_metadata = routing.get_tagpool_metadata(conn.tagpool)
+            if tagpool_metadata is None:
+                tagpool_metadata = yield self.get_tagpool_metadata(
+                    conn.tagpool)
             transport_name = tagpool_metadata.get('transport_name')
             if transport_name is None:
                 raise UnroutableMessageError(
@@ -578,7 +829,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         """Publish an inbound opt-out request to the opt-out worker."""
         target = [str(GoConnector.for_opt_out()), 'default']
         dst_connector_name, dst_endpoint = yield self.set_destination(
-            msg, target, self.INBOUND)
+            msg, target, self.INBOUND, routing=config.compiled_routing)
         yield self.publish_inbound(msg, dst_connector_name, dst_endpoint)
 
     @inlineCallbacks
@@ -613,7 +864,8 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         tag = yield self.tag_for_reply(msg)
         dst_conn = GoConnector.for_transport_tag(*tag)
         dst_connector_name, dst_endpoint = yield self.set_destination(
-            msg, [str(dst_conn), 'default'], self.OUTBOUND)
+            msg, [str(dst_conn), 'default'], self.OUTBOUND,
+            routing=config.compiled_routing)
         yield self.publish_outbound(msg, dst_connector_name, dst_endpoint)
 
     @inlineCallbacks
@@ -621,7 +873,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         """Publish an inbound message to the billing worker."""
         target = (str(GoConnector.for_billing(self.INBOUND)), 'default')
         dst_connector_name, dst_endpoint = yield self.set_destination(
-            msg, target, self.INBOUND)
+            msg, target, self.INBOUND, routing=config.compiled_routing)
 
         yield self.publish_inbound(msg, dst_connector_name, dst_endpoint)
 
@@ -632,7 +884,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         msg_mdh.set_tag(tag)
         target = (str(GoConnector.for_billing(self.OUTBOUND)), 'default')
         dst_connector_name, dst_endpoint = yield self.set_destination(
-            msg, target, self.OUTBOUND)
+            msg, target, self.OUTBOUND, routing=config.compiled_routing)
 
         yield self.publish_outbound(msg, dst_connector_name, dst_endpoint)
 
@@ -644,7 +896,8 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         msg_mdh = self.get_metadata_helper(msg)
         dst_conn = GoConnector.for_transport_tag(*msg_mdh.tag)
         dst_connector_name, dst_endpoint = yield self.set_destination(
-            msg, [str(dst_conn), 'default'], self.OUTBOUND)
+            msg, [str(dst_conn), 'default'], self.OUTBOUND,
+            routing=config.compiled_routing)
 
         yield self.publish_outbound(msg, dst_connector_name, dst_endpoint)
 
@@ -659,6 +912,9 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
         if connector_name in self.transport_connectors:
             if self.get_static_config().store_messages_to_transports:
                 yield self.vumi_api.mdb.add_outbound_message(msg)
+            if self.outbound_hops_index is not None:
+                yield self.outbound_hops_index.add(
+                    msg['message_id'], self.get_outbound_hops(msg))
 
         yield super(RoutingTableDispatcher, self).publish_outbound(
             msg, connector_name, endpoint)
@@ -676,7 +932,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
             # but this is an error path)
             f.raiseException()
 
-        tagpool_metadata = yield msg_mdh.get_tagpool_metadata()
+        tagpool_metadata = yield self.get_tagpool_metadata(msg_mdh.tag[0])
         if not tagpool_metadata.get('reply_to_unroutable_inbound'):
             f.raiseException()
 
@@ -754,7 +1010,7 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
                 % (connector_name,), msg)
 
         dst_connector_name, dst_endpoint = yield self.set_destination(
-            msg, target, self.INBOUND)
+            msg, target, self.INBOUND, routing=config.compiled_routing)
 
         yield self.publish_inbound(msg, dst_connector_name, dst_endpoint)
 
@@ -804,17 +1060,47 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
                     connector_name, msg), msg)
 
         if self.billing_outbound_connector:
-            target_conn = GoConnector.parse(target[0])
+            target_conn = config.compiled_routing.get_connector(target[0])
             if target_conn.ctype == target_conn.TRANSPORT_TAG:
                 tag = [target_conn.tagpool, target_conn.tagname]
                 yield self.publish_outbound_to_billing(config, msg, tag)
                 return
 
         dst_connector_name, dst_endpoint = yield self.set_destination(
-            msg, target, self.OUTBOUND)
+            msg, target, self.OUTBOUND, routing=config.compiled_routing)
 
         yield self.publish_outbound(msg, dst_connector_name, dst_endpoint)
 
+    def get_outbound_hops(self, msg):
+        """Build the :class:`OutboundHops` for an outbound message."""
+        msg_mdh = self.get_metadata_helper(msg)
+        msg_rmeta = RoutingMetadata(msg)
+        user_account = (
+            msg_mdh.get_account_key() if msg_mdh.has_user_account() else None)
+        return OutboundHops(
+            msg_rmeta.get_hops(), msg_mdh.tag, user_account,
+            msg_rmeta.get_unroutable_reply(), msg=msg)
+
+    @inlineCallbacks
+    def find_outbound_hops_for_event(self, event):
+        """Find the :class:`OutboundHops` for the outbound message an event
+        is for.
+
+        We look in the outbound hops index first and fall back to loading
+        the outbound message from the message store. Returns ``None`` if the
+        outbound message can't be found.
+        """
+        message_id = event.get('user_message_id')
+        if self.outbound_hops_index is not None and message_id is not None:
+            outbound_hops = yield self.outbound_hops_index.get(message_id)
+            if outbound_hops is not None:
+                returnValue(outbound_hops)
+
+        msg = yield self.find_message_for_event(event)
+        if msg is None:
+            returnValue(None)
+        returnValue(self.get_outbound_hops(msg))
+
     @inlineCallbacks
     def _set_event_metadata(self, event):
         """Sets the user account, tag and outbound hops metadata on an event
@@ -831,40 +1117,36 @@ class AccountRoutingTableDispatcher(RoutingTableDispatcher, GoWorkerMixin):
                 and event_mdh.tag is not None):
             return
 
-        # some metadata is missing, grab the associated outbound message
-        # and look for it there:
+        # some metadata is missing, look up the associated outbound message's
+        # routing metadata and look for it there:
 
-        msg = yield self.find_message_for_event(event)
-        if msg is None:
+        outbound = yield self.find_outbound_hops_for_event(event)
+        if outbound is None:
             raise UnroutableMessageError(
                 "Could not find transport user message for event", event)
-        msg_mdh = self.get_metadata_helper(msg)
-        msg_rmeta = RoutingMetadata(msg)
-        msg_unroutable = msg_rmeta.get_unroutable_reply()
 
-        msg_hops = msg_rmeta.get_hops()
-        event_rmeta.set_outbound_hops(msg_hops)
+        event_rmeta.set_outbound_hops(outbound.hops)
 
-        if msg_unroutable:
+        if outbound.unroutable:
             event_rmeta.set_unroutable_reply()
 
-        if msg_mdh.tag is None:
+        if outbound.tag is None:
             raise UnroutableMessageError(
-                "Outbound message for event has no tag set: %r" % (msg,),
+                "Outbound message for event has no tag set: %r" % (outbound,),
                 event)
         # set the tag on the event so that if it is from a transport
         # we can set the source of the message correctly in acquire_source.
-        event_mdh.set_tag(msg_mdh.tag)
+        event_mdh.set_tag(outbound.tag)
 
-        if not msg_unroutable or msg_hops:
+        if not outbound.unroutable or outbound.hops:
             # unroutable replies without hops were never associated with a
             # user account and so aren't required to have one. All other
             # messages must.
-            if not msg_mdh.has_user_account():
+            if outbound.user_account is None:
                 raise UnroutableMessageError(
                     "Outbound message for event has no associated"
-                    " user account: %r" % (msg,), event)
-            event_mdh.set_user_account(msg_mdh.get_account_key())
+                    " user account: %r" % (outbound,), event)
+            event_mdh.set_user_account(outbound.user_account)
 
     @inlineCallbacks
     def process_event(self, config, event, connector_name):
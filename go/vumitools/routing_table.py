@@ -154,12 +154,6 @@ class GoConnector(object):
             "Unknown object type for connector: %s" % (model_obj,))
 
 
-def _to_conn(conn):
-    if not isinstance(conn, GoConnector):
-        conn = GoConnector.parse(conn)
-    return conn
-
-
 class RoutingTable(object):
     """Interface to routing table dictionaries.
 
@@ -180,6 +174,15 @@ class RoutingTable(object):
         if routing_table is None:
             routing_table = {}
         self._routing_table = routing_table
+        # Parsed connectors, keyed by connector string. Connector strings
+        # always parse to the same connector, so this never needs to be
+        # invalidated.
+        self._connectors = {}
+        # Reverse index of destination connector string to a dict mapping
+        # (source connector string, source endpoint) to destination
+        # endpoint. Built lazily and kept up to date by the methods that
+        # modify the routing table.
+        self._sources = None
 
     def __eq__(self, other):
         if not isinstance(other, RoutingTable):
@@ -189,33 +192,74 @@ class RoutingTable(object):
     def __nonzero__(self):
         return bool(self._routing_table)
 
+    def _to_conn(self, conn):
+        """Parse a connector string, reusing previously parsed connectors.
+        """
+        if isinstance(conn, GoConnector):
+            return conn
+        parsed = self._connectors.get(conn)
+        if parsed is None:
+            parsed = GoConnector.parse(conn)
+            self._connectors[conn] = parsed
+        return parsed
+
+    def _get_sources_index(self):
+        """Return the reverse (destination -> sources) index, building it if
+        necessary.
+        """
+        if self._sources is None:
+            sources = {}
+            for src_str, endpoints in self._routing_table.iteritems():
+                for src_endp, (dst_str, dst_endp) in endpoints.iteritems():
+                    sources.setdefault(dst_str, {})[
+                        (src_str, src_endp)] = dst_endp
+            self._sources = sources
+        return self._sources
+
+    def _index_add(self, src_str, src_endpoint, dst_str, dst_endpoint):
+        if self._sources is not None:
+            self._sources.setdefault(dst_str, {})[
+                (src_str, src_endpoint)] = dst_endpoint
+
+    def _index_remove(self, src_str, src_endpoint, dst_str):
+        if self._sources is None:
+            return
+        dst_sources = self._sources.get(dst_str)
+        if dst_sources is None:
+            return
+        dst_sources.pop((src_str, src_endpoint), None)
+        if not dst_sources:
+            del self._sources[dst_str]
+
     def lookup_target(self, src_conn, src_endpoint):
         target = self._routing_table.get(str(src_conn), {}).get(src_endpoint)
         if target is not None:
             conn, ep = target
-            target = [_to_conn(conn), ep]
+            target = [self._to_conn(conn), ep]
         return target
 
     def lookup_targets(self, src_conn):
         targets = []
         for ep, dst in self._routing_table.get(str(src_conn), {}).iteritems():
             dst_str, dst_ep = dst
-            targets.append((ep, [_to_conn(dst_str), dst_ep]))
+            targets.append((ep, [self._to_conn(dst_str), dst_ep]))
         return targets
 
     def lookup_source(self, target_conn, target_endpoint):
-        target_conn = _to_conn(target_conn)
-        for src_conn, src_endpoint, dst_conn, dst_endpoint in self.entries():
-            if dst_conn == target_conn and dst_endpoint == target_endpoint:
-                return [src_conn, src_endpoint]
+        target_sources = self._get_sources_index().get(str(target_conn), {})
+        for (src_str, src_endpoint), dst_endpoint in (
+                target_sources.iteritems()):
+            if dst_endpoint == target_endpoint:
+                return [self._to_conn(src_str), src_endpoint]
         return None
 
     def lookup_sources(self, target_conn):
-        target_conn = _to_conn(target_conn)
+        target_sources = self._get_sources_index().get(str(target_conn), {})
         sources = []
-        for src_conn, src_endpoint, dst_conn, dst_endpoint in self.entries():
-            if dst_conn == target_conn:
-                sources.append((dst_endpoint, [src_conn, src_endpoint]))
+        for (src_str, src_endpoint), dst_endpoint in (
+                target_sources.iteritems()):
+            sources.append(
+                (dst_endpoint, [self._to_conn(src_str), src_endpoint]))
         return sources
 
     def entries(self):
@@ -225,24 +269,28 @@ class RoutingTable(object):
         """
         for src_conn, endpoints in self._routing_table.iteritems():
             for src_endp, (dst_conn, dst_endp) in endpoints.iteritems():
-                yield (
-                    _to_conn(src_conn), src_endp, _to_conn(dst_conn), dst_endp)
+                yield (self._to_conn(src_conn), src_endp,
+                       self._to_conn(dst_conn), dst_endp)
 
     def add_entry(self, src_conn, src_endpoint, dst_conn, dst_endpoint):
-        src_conn = _to_conn(src_conn)
-        dst_conn = _to_conn(dst_conn)
+        src_conn = self._to_conn(src_conn)
+        dst_conn = self._to_conn(dst_conn)
         self.validate_entry(src_conn, src_endpoint, dst_conn, dst_endpoint)
-        connector_dict = self._routing_table.setdefault(str(src_conn), {})
+        src_str = str(src_conn)
+        dst_str = str(dst_conn)
+        connector_dict = self._routing_table.setdefault(src_str, {})
         if src_endpoint in connector_dict:
             log.info(
                 "Replacing routing entry for (%r, %r): was %r, now %r" % (
-                    str(src_conn), src_endpoint, connector_dict[src_endpoint],
-                    [str(dst_conn), dst_endpoint]))
-        connector_dict[src_endpoint] = [str(dst_conn), dst_endpoint]
+                    src_str, src_endpoint, connector_dict[src_endpoint],
+                    [dst_str, dst_endpoint]))
+            old_dst_str, _old_dst_endpoint = connector_dict[src_endpoint]
+            self._index_remove(src_str, src_endpoint, old_dst_str)
+        connector_dict[src_endpoint] = [dst_str, dst_endpoint]
+        self._index_add(src_str, src_endpoint, dst_str, dst_endpoint)
 
     def remove_entry(self, src_conn, src_endpoint):
-        src_conn = _to_conn(src_conn)
-        src_str = str(src_conn)
+        src_str = str(self._to_conn(src_conn))
         connector_dict = self._routing_table.get(src_str)
         if connector_dict is None or src_endpoint not in connector_dict:
             log.warning(
@@ -251,6 +299,7 @@ class RoutingTable(object):
             return None
 
         old_dest = connector_dict.pop(src_endpoint)
+        self._index_remove(src_str, src_endpoint, old_dest[0])
 
         if not connector_dict:
             # This is the last entry for this connector
@@ -271,22 +320,20 @@ class RoutingTable(object):
 
         Useful when the connector is going away for some reason.
         """
-        conn = _to_conn(conn)
+        conn_str = str(self._to_conn(conn))
+        sources = self._get_sources_index()
+
         # remove entries with connector as source
-        self._routing_table.pop(str(conn), None)
-
-        # remove entires with connector as destination
-        to_remove = []
-        for src_str, routes in self._routing_table.iteritems():
-            for src_endpoint, (dst_str, dst_endpoint) in routes.items():
-                if dst_str == str(conn):
-                    del routes[src_endpoint]
+        routes = self._routing_table.pop(conn_str, {})
+        for src_endpoint, (dst_str, _dst_endpoint) in routes.iteritems():
+            self._index_remove(conn_str, src_endpoint, dst_str)
+
+        # remove entries with connector as destination
+        for src_str, src_endpoint in sources.pop(conn_str, {}).keys():
+            routes = self._routing_table[src_str]
+            del routes[src_endpoint]
             if not routes:
-                # We can't modify this dict while iterating over it.
-                to_remove.append(src_str)
-
-        for src_str in to_remove:
-            del self._routing_table[src_str]
+                del self._routing_table[src_str]
 
     def remove_conversation(self, conv):
         """Remove all entries linking to or from a given conversation.
@@ -334,7 +381,7 @@ class RoutingTable(object):
         :param str src_conn: source connector to start search with.
         :rtype: set of destination connector strings.
         """
-        src_conn = _to_conn(src_conn)
+        src_conn = self._to_conn(src_conn)
         sources = [src_conn]
         sources_seen = set(sources)
         results = set()
@@ -371,7 +418,7 @@ class RoutingTable(object):
         :param str dst_conn: destination connector to start search with.
         :rtype: set of source connector strings.
         """
-        dst_conn = _to_conn(dst_conn)
+        dst_conn = self._to_conn(dst_conn)
         destinations = [dst_conn]
         destinations_seen = set(destinations)
         results = set()
@@ -394,8 +441,8 @@ class RoutingTable(object):
         This method currently only validates that the source and destination
         have opposite directionality (IN->OUT or OUT->IN).
         """
-        src_conn = _to_conn(src_conn)
-        dst_conn = _to_conn(dst_conn)
+        src_conn = self._to_conn(src_conn)
+        dst_conn = self._to_conn(dst_conn)
         if src_conn.direction == dst_conn.direction:
             raise ValueError(
                 "Invalid routing table entry: %s source (%s, %s) maps to %s"
@@ -0,0 +1,21 @@
+# -*- test-case-name: go.vumitools.tests.test_tagpool -*-
+
+from vumi.components.tagpool import TagpoolManager
+
+
+class GoTagpoolManager(TagpoolManager):
+    """
+    A :class:`TagpoolManager` that can count free tags without fetching
+    them.
+    """
+
+    def free_tag_count(self, pool):
+        """
+        Return the number of free tags in `pool`.
+
+        The tagpool manager keeps a set of free tags for each pool up to date
+        as tags are acquired and released, so we count the members of that
+        set.
+        """
+        _free_list, free_set_key, _inuse_set = self._tag_pool_keys(pool)
+        return self.redis.scard(free_set_key)
@@ -66,6 +66,24 @@ class TestTxVumiApi(VumiTestCase):
         pools = yield self.vumi_api.known_tagpools()
         self.assertEqual(sorted(pools.pools()), [u'pool1', u'pool2'])
 
+    @inlineCallbacks
+    def test_free_tag_counts(self):
+        yield self.vumi_helper.setup_tagpool(u'pool1', [u'1.1', u'1.2'])
+        yield self.vumi_helper.setup_tagpool(u'pool2', [u'2.1'])
+        yield self.vumi_api.tpm.acquire_specific_tag((u'pool2', u'2.1'))
+        counts = yield self.vumi_api.free_tag_counts(
+            [u'pool1', u'pool2', u'pool3'])
+        self.assertEqual(counts, {u'pool1': 2, u'pool2': 0, u'pool3': 0})
+
+        yield self.vumi_api.tpm.release_tag((u'pool2', u'2.1'))
+        counts = yield self.vumi_api.free_tag_counts([u'pool2'])
+        self.assertEqual(counts, {u'pool2': 1})
+
+    @inlineCallbacks
+    def test_free_tag_counts_empty(self):
+        counts = yield self.vumi_api.free_tag_counts([])
+        self.assertEqual(counts, {})
+
 
 @djangotest
 class TestVumiApi(TestTxVumiApi):
@@ -153,6 +171,34 @@ class TestTxVumiUserApi(VumiTestCase):
             set(ch.key for ch in channels),
             set(u':'.join(tag) for tag in [tag1, tag2]))
 
+    @inlineCallbacks
+    def test_get_channels(self):
+        tag1, tag2 = yield self.vumi_helper.setup_tagpool(
+            u"pool1", [u"1234", u"5678"], metadata={"display_name": "Pool 1"})
+        [tag3] = yield self.vumi_helper.setup_tagpool(
+            u"pool2", [u"9012"], metadata={"display_name": "Pool 2"})
+        yield self.user_helper.add_tagpool_permission(u"pool1")
+        yield self.user_helper.add_tagpool_permission(u"pool2")
+        yield self.user_api.acquire_specific_tag(tag1)
+        yield self.user_api.acquire_specific_tag(tag3)
+        tag_info = yield self.vumi_api.mdb.get_tag_info(tag1)
+
+        channels = yield self.user_api.get_channels([tag3, tag1, tag2])
+        self.assertEqual(
+            [ch.key for ch in channels], [u'pool2:9012', u'pool1:1234',
+                                          u'pool1:5678'])
+        self.assertEqual(
+            [ch.tagpool_metadata['display_name'] for ch in channels],
+            ['Pool 2', 'Pool 1', 'Pool 1'])
+        self.assertEqual(channels[1].batch.key, tag_info.current_batch.key)
+        # tag2 has never been acquired, so it has no tag info.
+        self.assertEqual(channels[2].batch.key, None)
+
+    @inlineCallbacks
+    def test_get_channels_empty(self):
+        channels = yield self.user_api.get_channels([])
+        self.assertEqual(channels, [])
+
     @inlineCallbacks
     def assert_account_tags(self, expected):
         user_account = yield self.user_api.get_user_account()
@@ -188,6 +234,32 @@ class TestTxVumiUserApi(VumiTestCase):
         self.assertEqual((yield self.user_api.acquire_tag(u"poolA")), None)
         yield self.assert_account_tags([list(tag1), list(tag2)])
 
+    @inlineCallbacks
+    def test_tag_ownership_version(self):
+        [tag] = yield self.vumi_helper.setup_tagpool(u"pool1", [u"1234"])
+        yield self.user_helper.add_tagpool_permission(u"pool1")
+        version0 = yield self.vumi_api.get_tag_ownership_version()
+
+        yield self.user_api.acquire_specific_tag(tag)
+        version1 = yield self.vumi_api.get_tag_ownership_version()
+        self.assertNotEqual(version1, version0)
+
+        yield self.user_api.release_tag(tag)
+        version2 = yield self.vumi_api.get_tag_ownership_version()
+        self.assertNotEqual(version2, version1)
+
+    @inlineCallbacks
+    def test_contact_groups_version(self):
+        version0 = yield self.user_api.get_contact_groups_version()
+
+        yield self.user_api.contact_store.new_group(u'group')
+        version1 = yield self.user_api.get_contact_groups_version()
+        self.assertNotEqual(version1, version0)
+
+        other_api = self.vumi_api.get_user_api(u"other")
+        other_version = yield other_api.get_contact_groups_version()
+        self.assertEqual(other_version, version0)
+
     @inlineCallbacks
     def test_release_tag_without_owner(self):
         [tag] = yield self.vumi_helper.setup_tagpool(u"pool1", [u"1234"])
@@ -482,6 +554,7 @@ class TestTxVumiUserApi(VumiTestCase):
         yield user2_api.acquire_specific_tag((u'pool1', u'1.1'))
         pools = yield self.user_api.tagpools()
         self.assertEqual(sorted(pools.pools()), [u'pool1'])
+        self.assertEqual(pools.free_tag_count(u'pool1'), 1)
 
         yield user2_api.acquire_specific_tag((u'pool1', u'1.2'))
         pools = yield self.user_api.tagpools()
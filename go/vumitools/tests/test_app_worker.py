@@ -83,6 +83,38 @@ class TestGoApplicationWorker(VumiTestCase):
             {"conversation_cache_ttl": 0})
         self.assertEqual(app2._conversation_cache._ttl, 0)
 
+    @inlineCallbacks
+    def test_conversation_cache_max_entries_config(self):
+        """
+        The conversation_cache_max_entries config option is passed to the
+        cache.
+        """
+        self.assertEqual(self.app._conversation_cache._max_entries, 10000)
+
+        app_helper2 = self.add_helper(AppWorkerHelper(DummyApplication))
+        app2 = yield app_helper2.get_app_worker(
+            {"conversation_cache_max_entries": 10})
+        self.assertEqual(app2._conversation_cache._max_entries, 10)
+
+    @inlineCallbacks
+    def test_cache_metrics_prefix_config(self):
+        """
+        Cache metrics are only collected if cache_metrics_prefix is set.
+        """
+        self.assertEqual(self.app._cache_metrics, None)
+        self.assertEqual(self.app._conversation_cache._metrics, {})
+
+        app_helper2 = self.add_helper(AppWorkerHelper(DummyApplication))
+        app2 = yield app_helper2.get_app_worker(
+            {"cache_metrics_prefix": "go.system.dummy."})
+        self.assertEqual(
+            sorted(app2._cache_metrics._metrics_lookup.keys()), [
+                "conversation_cache.evictions",
+                "conversation_cache.expirations",
+                "conversation_cache.hits",
+                "conversation_cache.misses",
+            ])
+
     @inlineCallbacks
     def test_message_not_processed_while_stopped(self):
         self.assertFalse(self.conv.running())
@@ -112,6 +144,18 @@ class TestGoApplicationWorker(VumiTestCase):
         ack = yield self.app_helper.make_dispatch_ack(conv=self.conv)
         self.assertEqual([ack], self.app.events)
 
+    @inlineCallbacks
+    def test_running_conversation_registry(self):
+        registry = self.app.vumi_api.running_conversation_registry
+        yield self.app_helper.start_conversation(self.conv)
+        running = yield registry.list_running()
+        self.assertEqual(running, [
+            (self.conv.user_account.key, self.conv.key,
+             self.conv.worker_name)])
+        yield self.app_helper.stop_conversation(self.conv)
+        running = yield registry.list_running()
+        self.assertEqual(running, [])
+
     @inlineCallbacks
     def test_collect_metrics(self):
         yield self.app_helper.start_conversation(self.conv)
@@ -3,6 +3,7 @@ import decimal
 import logging
 
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
 from twisted.web.client import Agent, Request, Response
 
 from vumi.message import TransportUserMessage
@@ -12,7 +13,8 @@ from vumi.utils import mkheaders, StringProducer
 
 from go.billing.utils import BillingError, JSONEncoder
 from go.vumitools import billing_worker
-from go.vumitools.billing_worker import BillingApi, BillingDispatcher
+from go.vumitools.billing_worker import (
+    BillingApi, BatchingBillingApi, BillingDispatcher)
 from go.vumitools.tests.helpers import VumiApiHelper, GoMessageHelper
 from go.vumitools.utils import MessageMetadataHelper
 
@@ -58,6 +60,9 @@ class BillingApiMock(object):
             "credit_cutoff_reached": self.credit_cutoff
         }
 
+    def flush(self):
+        pass
+
 
 class MockNetworkError(Exception):
     pass
@@ -255,6 +260,154 @@ class TestBillingApi(VumiTestCase):
         yield self.assertFailure(d, MockNetworkError)
 
 
+class TestBatchingBillingApi(VumiTestCase):
+
+    def setUp(self):
+        self.api_url = "http://localhost:9090/"
+        self.clock = Clock()
+        self.requests = []
+        self.patch(billing_worker, 'http_request_full', self.http_request)
+
+    def mk_billing_api(self, batch_size=3, batch_delay=0.1):
+        billing_api = BatchingBillingApi(
+            self.api_url, 0.01, batch_size, batch_delay)
+        billing_api.clock = self.clock
+        return billing_api
+
+    def http_request(self, url, data=None, headers={}, method='POST'):
+        transactions = json.loads(data)['transactions']
+        self.requests.append((url, transactions))
+        results = []
+        for transaction in transactions:
+            if transaction['account_number'] == 'bad-account':
+                results.append({'error': 'Bad account'})
+            else:
+                results.append({
+                    'transaction': {'message_id': transaction['message_id']},
+                    'credit_cutoff_reached': False,
+                })
+        response = Response(('HTTP', 1, 1), 200, 'OK', mkheaders({}), None)
+        response.delivered_body = json.dumps({'results': results})
+        return response
+
+    def create_transaction(self, billing_api, message_id,
+                           account_number="test-account"):
+        return billing_api.create_transaction(
+            account_number=account_number,
+            message_id=message_id,
+            tag_pool_name="pool1",
+            tag_name="1234",
+            provider="mtn",
+            message_direction="Inbound",
+            session_created=False,
+            transaction_type=BillingDispatcher.TRANSACTION_TYPE_MESSAGE,
+            session_length=None)
+
+    def get_message_ids(self):
+        return [[t['message_id'] for t in transactions]
+                for _, transactions in self.requests]
+
+    @inlineCallbacks
+    def test_flush_on_batch_size(self):
+        billing_api = self.mk_billing_api(batch_size=2)
+        d1 = self.create_transaction(billing_api, 'msg-id-1')
+        self.assertEqual(self.requests, [])
+        d2 = self.create_transaction(billing_api, 'msg-id-2')
+        self.assertEqual(
+            self.requests[0][0], "%stransactions/batch" % (self.api_url,))
+        self.assertEqual(self.get_message_ids(), [['msg-id-1', 'msg-id-2']])
+
+        result1 = yield d1
+        result2 = yield d2
+        self.assertEqual(result1['transaction'], {'message_id': 'msg-id-1'})
+        self.assertEqual(result2['transaction'], {'message_id': 'msg-id-2'})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_flush_on_batch_delay(self):
+        billing_api = self.mk_billing_api(batch_delay=0.1)
+        d = self.create_transaction(billing_api, 'msg-id-1')
+        self.clock.advance(0.05)
+        self.assertEqual(self.requests, [])
+        self.clock.advance(0.05)
+        self.assertEqual(self.get_message_ids(), [['msg-id-1']])
+
+        result = yield d
+        self.assertEqual(result['transaction'], {'message_id': 'msg-id-1'})
+
+    @inlineCallbacks
+    def test_flush(self):
+        billing_api = self.mk_billing_api()
+        d = self.create_transaction(billing_api, 'msg-id-1')
+        yield billing_api.flush()
+        self.assertEqual(self.get_message_ids(), [['msg-id-1']])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        result = yield d
+        self.assertEqual(result['transaction'], {'message_id': 'msg-id-1'})
+
+    @inlineCallbacks
+    def test_transaction_error(self):
+        billing_api = self.mk_billing_api(batch_size=2)
+        d1 = self.create_transaction(
+            billing_api, 'msg-id-1', account_number='bad-account')
+        d2 = self.create_transaction(billing_api, 'msg-id-2')
+
+        err = yield self.assertFailure(d1, BillingError)
+        self.assertEqual(str(err), 'Bad account')
+        result = yield d2
+        self.assertEqual(result['transaction'], {'message_id': 'msg-id-2'})
+
+    @inlineCallbacks
+    def test_batch_error(self):
+        billing_api = self.mk_billing_api(batch_size=2)
+        hrm = HttpRequestMock(Response(
+            ('HTTP', 1, 1), 500, 'Internal Server Error', mkheaders({}),
+            None))
+        hrm.response.delivered_body = ""
+        self.patch(billing_worker, 'http_request_full',
+                   hrm.dummy_http_request_full)
+
+        d1 = self.create_transaction(billing_api, 'msg-id-1')
+        d2 = self.create_transaction(billing_api, 'msg-id-2')
+        yield self.assertFailure(d1, BillingError)
+        yield self.assertFailure(d2, BillingError)
+
+    @inlineCallbacks
+    def test_batch_network_error_not_retried(self):
+        billing_api = self.mk_billing_api(batch_size=2)
+        hrm = HttpRequestMock(Response(
+            ('HTTP', 1, 1), 200, 'OK', mkheaders({}), None), fail_times=1)
+        hrm.response.delivered_body = json.dumps({'results': []})
+        self.patch(billing_worker, 'http_request_full',
+                   hrm.dummy_http_request_full)
+
+        d1 = self.create_transaction(billing_api, 'msg-id-1')
+        d2 = self.create_transaction(billing_api, 'msg-id-2')
+        yield self.assertFailure(d1, MockNetworkError)
+        yield self.assertFailure(d2, MockNetworkError)
+        self.assertEqual(hrm.failed_times, 1)
+        self.assertEqual(hrm.request, None)
+
+    @inlineCallbacks
+    def test_batch_missing_results(self):
+        billing_api = self.mk_billing_api(batch_size=2)
+        response = Response(('HTTP', 1, 1), 200, 'OK', mkheaders({}), None)
+        response.delivered_body = json.dumps({'results': [{
+            'transaction': {'message_id': 'msg-id-1'},
+            'credit_cutoff_reached': False,
+        }]})
+        hrm = HttpRequestMock(response)
+        self.patch(billing_worker, 'http_request_full',
+                   hrm.dummy_http_request_full)
+
+        d1 = self.create_transaction(billing_api, 'msg-id-1')
+        d2 = self.create_transaction(billing_api, 'msg-id-2')
+        err = yield self.assertFailure(d1, BillingError)
+        self.assertEqual(str(err), 'Expected 2 results for batch, got 1.')
+        yield self.assertFailure(d2, BillingError)
+
+
 class TestBillingDispatcher(VumiTestCase):
 
     @inlineCallbacks
@@ -329,6 +482,34 @@ class TestBillingDispatcher(VumiTestCase):
     def assert_no_transactions(self):
         self.assertEqual(self.billing_api.transactions, [])
 
+    @inlineCallbacks
+    def test_batching_billing_api(self):
+        config = self.vumi_helper.mk_config({
+            "receive_inbound_connectors": ["billing_dispatcher_ri"],
+            "receive_outbound_connectors": ["billing_dispatcher_ro"],
+            "api_url": "http://127.0.0.1:9090/",
+            "batch_size": 10,
+            "batch_delay": 0.2,
+        })
+        billing_dispatcher = yield self.ri_helper.get_worker(
+            BillingDispatcher, config)
+        billing_api = billing_dispatcher.billing_api
+        self.assertTrue(isinstance(billing_api, BatchingBillingApi))
+        self.assertEqual(billing_api.batch_size, 10)
+        self.assertEqual(billing_api.batch_delay, 0.2)
+
+    @inlineCallbacks
+    def test_no_batching_billing_api_by_default(self):
+        config = self.vumi_helper.mk_config({
+            "receive_inbound_connectors": ["billing_dispatcher_ri"],
+            "receive_outbound_connectors": ["billing_dispatcher_ro"],
+            "api_url": "http://127.0.0.1:9090/",
+        })
+        billing_dispatcher = yield self.ri_helper.get_worker(
+            BillingDispatcher, config)
+        self.assertFalse(isinstance(billing_dispatcher.billing_api,
+                                    BatchingBillingApi))
+
     def test_determine_session_length(self):
         msg = self.msg_helper.make_inbound('roar', helper_metadata={
             'foo': {
@@ -301,3 +301,48 @@ class TestContactStore(VumiTestCase):
                                      msisdn=u'unknown')
         yield check_contact_for_addr('voice', u'+27831234567',
                                      msisdn=u'+27831234567')
+
+    @inlineCallbacks
+    def test_groups_version_without_redis(self):
+        yield self.store.new_group(u'group1')
+        self.assertEqual(self.store.get_groups_version(), None)
+
+    @inlineCallbacks
+    def test_groups_version_bumped_on_group_changes(self):
+        store = self.user_helper.user_api.contact_store
+
+        @inlineCallbacks
+        def assert_bumped(bumped):
+            version = yield store.get_groups_version()
+            if bumped:
+                self.assertNotEqual(version, self._last_version)
+            else:
+                self.assertEqual(version, self._last_version)
+            self._last_version = version
+
+        self._last_version = yield store.get_groups_version()
+        group = yield store.new_group(u'group1')
+        yield assert_bumped(True)
+
+        contact = yield store.new_contact(msisdn=u'27831234567')
+        yield assert_bumped(False)
+
+        contact = yield store.get_contact_by_key(contact.key)
+        contact.add_to_group(group)
+        yield contact.save()
+        yield assert_bumped(True)
+
+        # Changes that don't affect group memberships don't bump the version.
+        contact.extra['foo'] = u'bar'
+        yield contact.save()
+        yield assert_bumped(False)
+
+        contact.msisdn = u'27830000000'
+        yield contact.save()
+        yield assert_bumped(True)
+
+        yield contact.delete()
+        yield assert_bumped(True)
+
+        yield group.delete()
+        yield assert_bumped(True)
@@ -0,0 +1,75 @@
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from vumi.tests.helpers import VumiTestCase
+
+from go.vumitools.contact_send import ContactSendMixin
+from go.vumitools.tests.helpers import VumiApiHelper
+
+
+class DummySender(ContactSendMixin):
+    worker_name = 'dummy_sender'
+
+    def __init__(self, redis):
+        self.redis = redis
+
+
+class TestContactSendMixin(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.vumi_helper = yield self.add_helper(VumiApiHelper())
+        self.user_helper = yield self.vumi_helper.make_user(u'user')
+        self.contact_store = self.user_helper.user_api.contact_store
+        self.sender = DummySender(self.vumi_helper.get_vumi_api().redis)
+
+    @inlineCallbacks
+    def setup_conversation(self, contact_count):
+        group = yield self.contact_store.new_group(u'group')
+        contacts = []
+        for i in range(contact_count):
+            contact = yield self.contact_store.new_contact(
+                msisdn=u'+2783123456%s' % (i,), groups=[group])
+            contacts.append(contact)
+        conv = yield self.user_helper.create_conversation(
+            u'bulk_message', groups=[group])
+        returnValue((conv, sorted(c.key for c in contacts)))
+
+    @inlineCallbacks
+    def collect_bunches(self, conv, cmd_id):
+        bunches = []
+        yield self.sender.for_each_contact_bunch(
+            conv, cmd_id,
+            lambda contacts: bunches.append([c.key for c in contacts]))
+        returnValue(bunches)
+
+    @inlineCallbacks
+    def test_send_progress(self):
+        conv, _ = yield self.setup_conversation(0)
+        progress = yield self.sender.get_send_progress(conv, 'cmd-1')
+        self.assertEqual(progress, None)
+
+        yield self.sender.set_send_progress(conv, 'cmd-1', 'contact-1')
+        progress = yield self.sender.get_send_progress(conv, 'cmd-1')
+        self.assertEqual(progress, 'contact-1')
+        progress = yield self.sender.get_send_progress(conv, 'cmd-2')
+        self.assertEqual(progress, None)
+
+        yield self.sender.clear_send_progress(conv, 'cmd-1')
+        progress = yield self.sender.get_send_progress(conv, 'cmd-1')
+        self.assertEqual(progress, None)
+
+    @inlineCallbacks
+    def test_for_each_contact_bunch(self):
+        conv, contact_keys = yield self.setup_conversation(5)
+        self.sender.contact_keys_page_size = 2
+        bunches = yield self.collect_bunches(conv, 'cmd-1')
+        self.assertTrue(all(bunches))
+        self.assertEqual(sum(bunches, []), contact_keys)
+
+    @inlineCallbacks
+    def test_for_each_contact_bunch_resume(self):
+        conv, contact_keys = yield self.setup_conversation(5)
+        self.sender.contact_keys_page_size = 2
+        yield self.sender.set_send_progress(conv, 'cmd-1', contact_keys[2])
+        bunches = yield self.collect_bunches(conv, 'cmd-1')
+        self.assertEqual(sum(bunches, []), contact_keys[3:])
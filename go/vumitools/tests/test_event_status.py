@@ -0,0 +1,130 @@
+"""Tests for go.vumitools.event_status."""
+
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper, MessageHelper
+
+from go.vumitools.event_status import MessageEventStatusStore
+
+
+class TestMessageEventStatusStore(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.store = MessageEventStatusStore(self.redis)
+
+    def test_summary_for_event(self):
+        msg = self.msg_helper.make_outbound("hi")
+        self.assertEqual(
+            MessageEventStatusStore.summary_for_event(
+                self.msg_helper.make_ack(msg)),
+            u'ack')
+        self.assertEqual(
+            MessageEventStatusStore.summary_for_event(
+                self.msg_helper.make_nack(msg, nack_reason=u'no spoons')),
+            u'nack:no spoons')
+        self.assertEqual(
+            MessageEventStatusStore.summary_for_event(
+                self.msg_helper.make_delivery_report(msg)),
+            None)
+
+    def test_parse_summary(self):
+        self.assertEqual(
+            MessageEventStatusStore.parse_summary(u'sending'),
+            (u'sending', None))
+        self.assertEqual(
+            MessageEventStatusStore.parse_summary(u'nack:no: spoons'),
+            (u'nack', u'no: spoons'))
+
+    @inlineCallbacks
+    def test_get_summaries_missing(self):
+        summaries = yield self.store.get_summaries(
+            u'batch', [u'msg1', u'msg2'])
+        self.assertEqual(summaries, [None, None])
+
+    @inlineCallbacks
+    def test_mark_sending(self):
+        yield self.store.mark_sending(u'batch', u'msg1')
+        summaries = yield self.store.get_summaries(
+            u'batch', [u'msg1', u'msg2'])
+        self.assertEqual(summaries, [u'sending', None])
+        summaries = yield self.store.get_summaries(u'other', [u'msg1'])
+        self.assertEqual(summaries, [None])
+
+    @inlineCallbacks
+    def test_one_key_per_batch(self):
+        yield self.store.mark_sending(u'batch', u'msg1')
+        yield self.store.mark_sending(u'batch', u'msg2')
+        msg = self.msg_helper.make_outbound("hi")
+        yield self.store.record_event(u'batch', self.msg_helper.make_ack(msg))
+        self.assertEqual((yield self.redis.keys()), [u'batch'])
+        ttl = yield self.redis.ttl(u'batch')
+        self.assertTrue(0 < ttl <= MessageEventStatusStore.SUMMARY_TTL)
+
+    @inlineCallbacks
+    def test_record_event(self):
+        msg = self.msg_helper.make_outbound("hi")
+        yield self.store.mark_sending(u'batch', msg['message_id'])
+        yield self.store.record_event(u'batch', self.msg_helper.make_ack(msg))
+        [summary] = yield self.store.get_summaries(
+            u'batch', [msg['message_id']])
+        self.assertEqual(summary, u'ack')
+
+    @inlineCallbacks
+    def test_record_event_first_status_wins(self):
+        msg = self.msg_helper.make_outbound("hi")
+        yield self.store.mark_sending(u'batch', msg['message_id'])
+        yield self.store.record_event(
+            u'batch',
+            self.msg_helper.make_nack(msg, nack_reason=u'n\xf6 spoons'))
+        yield self.store.record_event(u'batch', self.msg_helper.make_ack(msg))
+        [summary] = yield self.store.get_summaries(
+            u'batch', [msg['message_id']])
+        self.assertEqual(summary, u'nack:n\xf6 spoons')
+
+    @inlineCallbacks
+    def test_record_event_ignores_delivery_reports(self):
+        msg = self.msg_helper.make_outbound("hi")
+        yield self.store.mark_sending(u'batch', msg['message_id'])
+        yield self.store.record_event(
+            u'batch', self.msg_helper.make_delivery_report(msg))
+        [summary] = yield self.store.get_summaries(
+            u'batch', [msg['message_id']])
+        self.assertEqual(summary, u'sending')
+
+    @inlineCallbacks
+    def test_mark_sending_after_event(self):
+        msg = self.msg_helper.make_outbound("hi")
+        yield self.store.record_event(u'batch', self.msg_helper.make_ack(msg))
+        yield self.store.mark_sending(u'batch', msg['message_id'])
+        [summary] = yield self.store.get_summaries(
+            u'batch', [msg['message_id']])
+        self.assertEqual(summary, u'ack')
+
+    @inlineCallbacks
+    def test_backfill(self):
+        msg = self.msg_helper.make_outbound("hi")
+        yield self.store.backfill(u'batch', u'msg1', u'ack')
+        yield self.store.record_event(u'batch', self.msg_helper.make_ack(msg))
+        yield self.store.backfill(
+            u'batch', msg['message_id'], u'nack:no spoons')
+        summaries = yield self.store.get_summaries(
+            u'batch', [u'msg1', msg['message_id']])
+        self.assertEqual(summaries, [u'ack', u'ack'])
+
+
+class TestMessageEventStatusStoreSync(VumiTestCase):
+    def setUp(self):
+        self.persistence_helper = self.add_helper(
+            PersistenceHelper(is_sync=True))
+        self.redis = self.persistence_helper.get_redis_manager()
+        self.store = MessageEventStatusStore(self.redis)
+
+    def test_get_summaries(self):
+        self.store.mark_sending(u'batch', u'msg1')
+        self.store.backfill(u'batch', u'msg2', u'ack')
+        self.assertEqual(
+            self.store.get_summaries(u'batch', [u'msg1', u'msg2', u'msg3']),
+            [u'sending', u'ack', None])
@@ -2,6 +2,7 @@
 
 import copy
 import re
+import zlib
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import Clock, LoopingCall
@@ -54,6 +55,15 @@ class TestGoMetricsWorker(VumiTestCase):
     def make_conv(self, user_helper, conv_name, conv_type=u'my_conv', **kw):
         return user_helper.create_conversation(conv_type, name=conv_name, **kw)
 
+    @inlineCallbacks
+    def set_registry(self, worker, running):
+        """Fill the running conversation registry as if it had just been
+           rebuilt.
+           """
+        registry = worker.vumi_api.running_conversation_registry
+        yield registry.start_rebuild()
+        yield registry.finish_rebuild(running, worker.clock.seconds())
+
     @inlineCallbacks
     def test_bucket_for_conversation(self):
         worker = yield self.get_metrics_worker(needs_hash=True)
@@ -61,7 +71,8 @@ class TestGoMetricsWorker(VumiTestCase):
         conv1 = yield self.make_conv(user_helper, u'conv1')
 
         bucket = worker.bucket_for_conversation(conv1.key)
-        self.assertEqual(bucket, hash(conv1.key) % 60)
+        self.assertEqual(bucket, (zlib.crc32(conv1.key) & 0xffffffff) % 60)
+        self.assertEqual(bucket, worker.bucket_for_conversation(conv1.key))
 
     def assert_conversations_bucketed(self, worker, expected):
         expected = expected.copy()
@@ -104,6 +115,86 @@ class TestGoMetricsWorker(VumiTestCase):
         self.assertEqual(log_msg, "Scheduled metrics commands for"
                          " 4 conversations in 1 accounts.")
 
+    @inlineCallbacks
+    def test_populate_conversation_buckets_from_registry(self):
+        worker = yield self.get_metrics_worker()
+        user_helper = yield self.vumi_helper.make_user(u'acc1')
+        conv1 = yield self.make_conv(user_helper, u'conv1', started=True)
+        conv2 = yield self.make_conv(user_helper, u'conv2', started=True)
+        for conv in [conv1, conv2]:
+            self.conversation_names[conv.key] = conv.name
+
+        # Only conv1 is in the registry, so conv2 isn't scheduled.
+        yield self.set_registry(worker, [
+            (user_helper.account_key, conv1.key, u'my_conv_application')])
+        yield worker.populate_conversation_buckets()
+        self.assert_conversations_bucketed(worker, {1: [conv1]})
+
+    @inlineCallbacks
+    def test_populate_conversation_buckets_rebuilds_new_registry(self):
+        worker = yield self.get_metrics_worker()
+        user_helper = yield self.vumi_helper.make_user(u'acc1')
+        conv1 = yield self.make_conv(user_helper, u'conv1', started=True)
+        self.conversation_names[conv1.key] = conv1.name
+
+        yield worker.populate_conversation_buckets()
+        self.assert_conversations_bucketed(worker, {1: [conv1]})
+        registry = worker.vumi_api.running_conversation_registry
+        running = yield registry.list_running()
+        self.assertEqual(running, [
+            (user_helper.account_key, conv1.key, u'my_conv_application')])
+
+    @inlineCallbacks
+    def test_populate_conversation_buckets_empty_registry_not_rebuilt(self):
+        worker = yield self.get_metrics_worker()
+        yield self.set_registry(worker, [])
+        user_helper = yield self.vumi_helper.make_user(u'acc1')
+        conv1 = yield self.make_conv(user_helper, u'conv1', started=True)
+        self.conversation_names[conv1.key] = conv1.name
+
+        yield worker.populate_conversation_buckets()
+        self.assert_conversations_bucketed(worker, {})
+
+    @inlineCallbacks
+    def test_populate_conversation_buckets_rebuilds_after_interval(self):
+        self.patch(metrics_worker.GoMetricsWorker, 'clock', self.clock)
+        worker = yield self.get_metrics_worker({
+            'running_conversations_rebuild_interval': 100,
+        })
+        user_helper = yield self.vumi_helper.make_user(u'acc1')
+        conv1 = yield self.make_conv(user_helper, u'conv1', started=True)
+        conv2 = yield self.make_conv(user_helper, u'conv2', started=True)
+        for conv in [conv1, conv2]:
+            self.conversation_names[conv.key] = conv.name
+        yield self.set_registry(worker, [
+            (user_helper.account_key, conv1.key, u'my_conv_application')])
+
+        yield worker.populate_conversation_buckets()
+        self.assert_conversations_bucketed(worker, {1: [conv1]})
+        yield worker.process_bucket(1)
+
+        self.clock.advance(100)
+        yield worker.populate_conversation_buckets()
+        self.assert_conversations_bucketed(worker, {
+            1: [conv1],
+            2: [conv2],
+        })
+
+    @inlineCallbacks
+    def test_populate_conversation_buckets_disabled_accounts(self):
+        worker = yield self.get_metrics_worker()
+        user1_helper = yield self.vumi_helper.make_user(u'acc1')
+        user2_helper = yield self.vumi_helper.make_user(u'acc2')
+        conv1 = yield self.make_conv(user1_helper, u'conv1', started=True)
+        conv2 = yield self.make_conv(user2_helper, u'conv2', started=True)
+        for conv in [conv1, conv2]:
+            self.conversation_names[conv.key] = conv.name
+        yield worker.redis.sadd(
+            'disabled_metrics_accounts', user2_helper.account_key)
+
+        yield worker.populate_conversation_buckets()
+        self.assert_conversations_bucketed(worker, {1: [conv1]})
+
     @inlineCallbacks
     def test_process_bucket(self):
         worker = yield self.get_metrics_worker()
@@ -124,6 +215,24 @@ class TestGoMetricsWorker(VumiTestCase):
             4: [conv4],
         })
 
+    @inlineCallbacks
+    def test_process_bucket_batches_commands(self):
+        worker = yield self.get_metrics_worker({'command_batch_size': 2})
+        user_helper = yield self.vumi_helper.make_user(u'acc1')
+        convs = []
+        for i in range(5):
+            conv = yield self.make_conv(user_helper, u'conv1%d' % i)
+            convs.append(conv)
+            worker._buckets[1].append(
+                (user_helper.account_key, conv.key, u'my_conv_application'))
+
+        yield worker.process_bucket(1)
+        cmds = self.vumi_helper.get_dispatched_commands()
+        self.assertEqual(
+            [c['kwargs']['conversation_key'] for c in cmds],
+            [c.key for c in convs])
+        self.assert_conversations_bucketed(worker, {})
+
     @inlineCallbacks
     def test_increment_bucket(self):
         worker = yield self.get_metrics_worker()
@@ -151,21 +260,6 @@ class TestGoMetricsWorker(VumiTestCase):
         self.clock.advance(1)
         self.assertEqual(2, len(polls))
 
-    @inlineCallbacks
-    def test_find_accounts(self):
-        worker = yield self.get_metrics_worker()
-        user1_helper = yield self.vumi_helper.make_user(u'acc1')
-        user2_helper = yield self.vumi_helper.make_user(u'acc2')
-        user3_helper = yield self.vumi_helper.make_user(u'acc3')
-        yield worker.redis.sadd(
-            'disabled_metrics_accounts', user3_helper.account_key)
-        yield worker.redis.sadd('metrics_accounts', user2_helper.account_key)
-
-        account_keys = yield worker.find_account_keys()
-        self.assertEqual(
-            sorted([user1_helper.account_key, user2_helper.account_key]),
-            sorted(account_keys))
-
     @inlineCallbacks
     def test_find_conversations_for_account(self):
         worker = yield self.get_metrics_worker()
@@ -1,7 +1,7 @@
 """Tests for go.vumitools.middleware"""
 import time
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, fail
 
 from zope.interface import implements
 
@@ -9,6 +9,7 @@ from vumi.transports.failures import FailureMessage
 from vumi.message import TransportUserMessage
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.tests.helpers import VumiTestCase, generate_proxies, IHelper
+from vumi.errors import ConfigError
 from vumi.worker import BaseWorker
 
 from go.vumitools.app_worker import GoWorkerMixin, GoWorkerConfigMixin
@@ -939,6 +940,80 @@ class TestConversationStoringMiddleware(VumiTestCase):
         yield mw.handle_consume_outbound(msg1, 'default')
         self.assertEqual(cache._models.keys(), [self.conv.key])
 
+    @inlineCallbacks
+    def test_event_status_summaries(self):
+        mw = yield self.mw_helper.create_middleware({'event_statuses': True})
+        statuses = self.mw_helper.get_vumi_api().message_event_statuses
+        batch_id = self.conv.batch.key
+
+        msg = self.mw_helper.make_outbound("outbound", conv=self.conv)
+        yield mw.handle_consume_outbound(msg, 'default')
+        summaries = yield statuses.get_summaries(
+            batch_id, [msg['message_id']])
+        self.assertEqual(summaries, [u'sending'])
+
+        ack = self.mw_helper.make_ack(msg, conv=self.conv)
+        yield mw.handle_consume_event(ack, 'default')
+        summaries = yield statuses.get_summaries(
+            batch_id, [msg['message_id']])
+        self.assertEqual(summaries, [u'ack'])
+
+    @inlineCallbacks
+    def test_event_status_summaries_disabled(self):
+        mw = yield self.mw_helper.create_middleware()
+        statuses = self.mw_helper.get_vumi_api().message_event_statuses
+
+        msg = self.mw_helper.make_outbound("outbound", conv=self.conv)
+        yield mw.handle_consume_outbound(msg, 'default')
+        ack = self.mw_helper.make_ack(msg, conv=self.conv)
+        yield mw.handle_consume_event(ack, 'default')
+        summaries = yield statuses.get_summaries(
+            self.conv.batch.key, [msg['message_id']])
+        self.assertEqual(summaries, [None])
+
+    @inlineCallbacks
+    def test_write_behind_requires_journal_path(self):
+        yield self.assertFailure(
+            self.mw_helper.create_middleware({'write_behind': True}),
+            ConfigError)
+
+    @inlineCallbacks
+    def test_write_behind_messages(self):
+        mw = yield self.mw_helper.create_middleware({
+            'write_behind': True,
+            'write_behind_journal_path': self.mktemp(),
+        })
+
+        msg1 = self.mw_helper.make_inbound("inbound", conv=self.conv)
+        yield mw.handle_consume_inbound(msg1, 'default')
+        msg2 = self.mw_helper.make_outbound("outbound", conv=self.conv)
+        yield mw.handle_consume_outbound(msg2, 'default')
+        yield self.assert_stored_inbound([])
+        yield self.assert_stored_outbound([])
+
+        yield mw.write_behind.flush()
+        yield self.assert_stored_inbound([msg1])
+        yield self.assert_stored_outbound([msg2])
+
+    @inlineCallbacks
+    def test_write_behind_event_waits_for_message(self):
+        mw = yield self.mw_helper.create_middleware({
+            'write_behind': True,
+            'write_behind_journal_path': self.mktemp(),
+        })
+
+        msg = self.mw_helper.make_outbound("outbound", conv=self.conv)
+        yield mw.handle_consume_outbound(msg, 'default')
+        ack = self.mw_helper.make_ack(msg)
+        event_d = mw.handle_consume_event(ack, 'default')
+        self.assertFalse(event_d.called)
+
+        yield mw.write_behind.flush()
+        yield event_d
+        mdb = self.mw_helper.get_vumi_api().mdb
+        event_record = yield mdb.events.load(ack['event_id'])
+        self.assertEqual(event_record.batches.keys(), [self.conv.batch.key])
+
 
 class TestRouterStoringMiddleware(VumiTestCase):
 
@@ -1030,6 +1105,7 @@ class TestConversationMetricsMiddleware(VumiTestCase):
 
     @inlineCallbacks
     def assert_conv_key_stored(self, mw, msg):
+        yield mw.flush_recent_convs()
         value = yield mw.redis.smembers(
             ConversationMetricsMiddleware.RECENT_CONV_KEY)
         conv_details = '{"account_key": "%s","conv_key": "%s"}' % \
@@ -1088,3 +1164,72 @@ class TestConversationMetricsMiddleware(VumiTestCase):
         mw.reset_local_recent_convs()
 
         self.assertEqual(mw.local_recent_convs, set([]))
+
+    @inlineCallbacks
+    def test_flush_recent_convs_only_sends_new_convs(self):
+        mw = yield self.mw_helper.create_middleware()
+        mw.local_recent_convs.update(["conv1", "conv2"])
+        mw.pending_recent_convs.add("conv3")
+        sadd_calls = []
+        orig_sadd = mw.redis.sadd
+
+        def sadd(key, *values):
+            sadd_calls.append(set(values))
+            return orig_sadd(key, *values)
+
+        self.patch(mw.redis, 'sadd', sadd)
+        yield mw.flush_recent_convs()
+        yield mw.flush_recent_convs()
+
+        self.assertEqual(sadd_calls, [set(["conv3"])])
+        self.assertEqual(mw.pending_recent_convs, set())
+        value = yield mw.redis.smembers(
+            ConversationMetricsMiddleware.RECENT_CONV_KEY)
+        self.assertEqual(value, set(["conv3"]))
+
+    @inlineCallbacks
+    def test_flush_batch_size(self):
+        mw = yield self.mw_helper.create_middleware({'flush_batch_size': 2})
+        msg_helper = GoMessageHelper(vumi_helper=self.mw_helper)
+        conv2 = yield self.user_helper.create_conversation(
+            u'bulk_message', name=u'Other Conversation', started=True)
+
+        [msg1] = yield msg_helper.add_inbound_to_conv(self.conv, 1)
+        [msg2] = yield msg_helper.add_inbound_to_conv(conv2, 1)
+        yield mw.handle_inbound(msg1, "conn_1")
+        yield mw.handle_inbound(msg1, "conn_1")
+        value = yield mw.redis.smembers(
+            ConversationMetricsMiddleware.RECENT_CONV_KEY)
+        self.assertEqual(value, set())
+
+        yield mw.handle_inbound(msg2, "conn_1")
+        value = yield mw.redis.smembers(
+            ConversationMetricsMiddleware.RECENT_CONV_KEY)
+        self.assertEqual(len(value), 2)
+        self.assertEqual(mw.pending_recent_convs, set())
+
+    @inlineCallbacks
+    def test_flush_failure_keeps_pending_convs(self):
+        mw = yield self.mw_helper.create_middleware()
+        mw.pending_recent_convs.add("conv1")
+
+        def sadd(key, *values):
+            return fail(Exception("Redis is down"))
+
+        self.patch(mw.redis, 'sadd', sadd)
+        yield mw.flush_recent_convs()
+        self.assertEqual(mw.pending_recent_convs, set(["conv1"]))
+        self.flushLoggedErrors()
+
+    @inlineCallbacks
+    def test_flush_metrics(self):
+        mw = yield self.mw_helper.create_middleware({
+            'metrics_prefix': 'conv_metrics_mw.',
+        })
+        mw.pending_recent_convs.update(["conv1", "conv2"])
+        yield mw.flush_recent_convs()
+
+        [(_, size)] = mw.metric_manager['recent_convs.flush_size'].poll()
+        self.assertEqual(size, 2)
+        [(_, latency)] = mw.metric_manager['recent_convs.flush_time'].poll()
+        self.assertTrue(latency >= 0)
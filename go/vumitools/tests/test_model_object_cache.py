@@ -1,6 +1,7 @@
 from twisted.internet.defer import Deferred, inlineCallbacks
 from twisted.internet.task import Clock
 
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.tests.helpers import VumiTestCase
 
 from go.vumitools.model_object_cache import ModelObjectCache
@@ -43,18 +44,18 @@ class TestModelObjectCache(VumiTestCase):
         """
         cache = ModelObjectCache(self.clock, 5)
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
 
         getter = self.make_object_getter()
         model = yield cache.get_model(getter, "LisaFonssagrives")
         self.assertEqual(model.key, "LisaFonssagrives")
         self.assertEqual(cache._models, {"LisaFonssagrives": model})
-        self.assertEqual(cache._evictors.keys(), ["LisaFonssagrives"])
+        self.assertEqual(cache._expiry_slots.keys(), ["LisaFonssagrives"])
 
         # Clean up remaining state.
         cache.cleanup()
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
 
     @inlineCallbacks
     def test_cache_eviction(self):
@@ -66,15 +67,15 @@ class TestModelObjectCache(VumiTestCase):
         model = yield cache.get_model(getter, "LisaFonssagrives")
         self.assertEqual(model.key, "LisaFonssagrives")
         self.assertEqual(cache._models, {"LisaFonssagrives": model})
-        self.assertEqual(cache._evictors.keys(), ["LisaFonssagrives"])
+        self.assertEqual(cache._expiry_slots.keys(), ["LisaFonssagrives"])
 
         self.clock.advance(4.9)
         self.assertNotEqual(cache._models, {})
-        self.assertNotEqual(cache._evictors, {})
+        self.assertNotEqual(cache._expiry_slots, {})
 
         self.clock.advance(0.5)
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
 
     @inlineCallbacks
     def test_multiple_cache_eviction(self):
@@ -85,7 +86,7 @@ class TestModelObjectCache(VumiTestCase):
         getter = self.make_object_getter()
         model = yield cache.get_model(getter, "LisaFonssagrives")
         self.assertEqual(cache._models, {"LisaFonssagrives": model})
-        self.assertEqual(cache._evictors.keys(), ["LisaFonssagrives"])
+        self.assertEqual(cache._expiry_slots.keys(), ["LisaFonssagrives"])
 
         self.clock.advance(3)
         model2 = yield cache.get_model(getter, "JinxFalkenburg")
@@ -94,18 +95,18 @@ class TestModelObjectCache(VumiTestCase):
             "JinxFalkenburg": model2,
         })
         self.assertEqual(
-            set(cache._evictors.keys()),
+            set(cache._expiry_slots.keys()),
             set(["LisaFonssagrives", "JinxFalkenburg"]))
 
         self.clock.advance(3)
         self.assertEqual(cache._models, {
             "JinxFalkenburg": model2,
         })
-        self.assertEqual(cache._evictors.keys(), ["JinxFalkenburg"])
+        self.assertEqual(cache._expiry_slots.keys(), ["JinxFalkenburg"])
 
         self.clock.advance(3)
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
 
     @inlineCallbacks
     def test_get_model_no_caching(self):
@@ -115,13 +116,27 @@ class TestModelObjectCache(VumiTestCase):
         """
         cache = ModelObjectCache(self.clock, 0)
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
 
         getter = self.make_object_getter()
         model = yield cache.get_model(getter, "LisaFonssagrives")
         self.assertEqual(model.key, "LisaFonssagrives")
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
+
+    @inlineCallbacks
+    def test_get_model_no_entries(self):
+        """
+        When the maximum size is zero, caching is disabled.
+        """
+        cache = ModelObjectCache(self.clock, 5, max_entries=0)
+        getter = self.make_object_getter()
+        model = yield cache.get_model(getter, "LisaFonssagrives")
+        self.assertEqual(model.key, "LisaFonssagrives")
+        model = yield cache.get_model(getter, "LisaFonssagrives")
+        self.assertEqual(model.key, "LisaFonssagrives")
+        self.assertEqual(cache._models, {})
+        self.assertEqual(cache._expiry_slots, {})
 
     @inlineCallbacks
     def test_schedule_duplicate_eviction(self):
@@ -132,26 +147,128 @@ class TestModelObjectCache(VumiTestCase):
         cache = ModelObjectCache(self.clock, 5)
         getter = self.make_object_getter()
         yield cache.get_model(getter, "LisaFonssagrives")
-        self.assertEqual(cache._evictors.keys(), ["LisaFonssagrives"])
+        self.assertEqual(cache._expiry_slots.keys(), ["LisaFonssagrives"])
 
-        delayed_call = cache._evictors["LisaFonssagrives"]
+        slot = cache._expiry_slots["LisaFonssagrives"]
         self.clock.advance(1)
 
         # Calling schedule_eviction() doesn't replace the existing one.
         cache.schedule_eviction("LisaFonssagrives")
         self.assertNotEqual(cache._models, {})
-        self.assertEqual(cache._evictors["LisaFonssagrives"], delayed_call)
+        self.assertEqual(cache._expiry_slots["LisaFonssagrives"], slot)
 
         # The existing eviction happens at the expected time.
         self.clock.advance(4)
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
 
         # Advance to the time the new eviction would have been schduled to make
         # sure nothing breaks.
         self.clock.advance(1)
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
+
+    @inlineCallbacks
+    def test_single_expiry_timer(self):
+        """
+        All cached models share a single delayed call for expiry.
+        """
+        cache = ModelObjectCache(self.clock, 5)
+        getter = self.make_object_getter()
+        for i in range(10):
+            yield cache.get_model(getter, "model%s" % (i,))
+            self.clock.advance(0.1)
+        self.assertEqual(len(cache._models), 10)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(5)
+        self.assertEqual(cache._models, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(cache.stats["expirations"], 10)
+
+    @inlineCallbacks
+    def test_models_never_expire_early(self):
+        """
+        Models are kept for at least the TTL, even if they don't fall on a
+        timer wheel slot boundary.
+        """
+        cache = ModelObjectCache(self.clock, 5, resolution=1)
+        getter = self.make_object_getter()
+        self.clock.advance(0.5)
+        yield cache.get_model(getter, "LisaFonssagrives")
+        self.clock.advance(4.9)
+        self.assertEqual(cache._models.keys(), ["LisaFonssagrives"])
+        self.clock.advance(0.6)
+        self.assertEqual(cache._models, {})
+
+    @inlineCallbacks
+    def test_max_entries_evicts_least_recently_used(self):
+        """
+        When the cache is full, the least recently used model is evicted to
+        make space for a new one.
+        """
+        cache = ModelObjectCache(self.clock, 5, max_entries=2)
+        getter = self.make_object_getter()
+        yield cache.get_model(getter, "LisaFonssagrives")
+        yield cache.get_model(getter, "JinxFalkenburg")
+        # Use the first model again so the second is least recently used.
+        yield cache.get_model(getter, "LisaFonssagrives")
+
+        yield cache.get_model(getter, "TinLizzy")
+        self.assertEqual(
+            cache._models.keys(), ["LisaFonssagrives", "TinLizzy"])
+        self.assertEqual(
+            set(cache._expiry_slots.keys()),
+            set(["LisaFonssagrives", "TinLizzy"]))
+        self.assertEqual(cache.stats["evictions"], 1)
+
+        # Clean up remaining state.
+        cache.cleanup()
+        self.assertEqual(cache._models, {})
+        self.assertEqual(cache._expiry_slots, {})
+
+    @inlineCallbacks
+    def test_hit_and_miss_stats(self):
+        """
+        Cache hits and misses are counted.
+        """
+        cache = ModelObjectCache(self.clock, 5)
+        getter = self.make_object_getter()
+        yield cache.get_model(getter, "LisaFonssagrives")
+        yield cache.get_model(getter, "LisaFonssagrives")
+        yield cache.get_model(getter, "LisaFonssagrives")
+        yield cache.get_model(getter, "JinxFalkenburg")
+        self.assertEqual(cache.stats, {
+            "hits": 2,
+            "misses": 2,
+            "evictions": 0,
+            "expirations": 0,
+        })
+        cache.cleanup()
+
+    @inlineCallbacks
+    def test_metrics(self):
+        """
+        If a metric manager is provided, hits, misses and evictions are
+        counted in metrics.
+        """
+        metric_manager = MetricManager("prefix.")
+        cache = ModelObjectCache(
+            self.clock, 5, max_entries=1, metric_manager=metric_manager,
+            metric_name="accounts")
+        getter = self.make_object_getter()
+        yield cache.get_model(getter, "LisaFonssagrives")
+        yield cache.get_model(getter, "LisaFonssagrives")
+        yield cache.get_model(getter, "JinxFalkenburg")
+
+        def poll(name):
+            return [v for _, v in metric_manager[name].poll()]
+
+        self.assertEqual(poll("accounts.hits"), [1.0])
+        self.assertEqual(poll("accounts.misses"), [1.0, 1.0])
+        self.assertEqual(poll("accounts.evictions"), [1.0])
+        self.assertEqual(poll("accounts.expirations"), [])
+        cache.cleanup()
 
     @inlineCallbacks
     def test_get_missing_model(self):
@@ -160,54 +277,107 @@ class TestModelObjectCache(VumiTestCase):
         """
         cache = ModelObjectCache(self.clock, 5)
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
 
         getter = self.make_object_getter(missing_keys=["TinLizzy"])
         model = yield cache.get_model(getter, "TinLizzy")
         self.assertEqual(model, None)
         self.assertEqual(cache._models, {"TinLizzy": None})
-        self.assertEqual(cache._evictors.keys(), ["TinLizzy"])
+        self.assertEqual(cache._expiry_slots.keys(), ["TinLizzy"])
 
         # Clean up remaining state.
         cache.cleanup()
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
 
     def test_overlapping_gets(self):
         """
-        If there are multiple pending gets for the same uncached key, the
-        cached value will be replaced when each returns.
+        If there are multiple pending gets for the same uncached key, they
+        share a single fetch.
         """
         cache = ModelObjectCache(self.clock, 5)
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
 
+        fetched_keys = []
         getter = self.make_object_getter(delay=3)
-        getter_missing = self.make_object_getter(
-            missing_keys=["LisaFonssagrives"], delay=1)
-        model1_d = cache.get_model(getter, "LisaFonssagrives")
+
+        def counting_getter(key):
+            fetched_keys.append(key)
+            return getter(key)
+
+        model1_d = cache.get_model(counting_getter, "LisaFonssagrives")
         self.clock.advance(1)
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors.keys(), [])
+        self.assertEqual(cache._expiry_slots.keys(), [])
 
-        model2_d = cache.get_model(getter_missing, "LisaFonssagrives")
+        model2_d = cache.get_model(counting_getter, "LisaFonssagrives")
         self.clock.advance(1)
-        model2 = self.successResultOf(model2_d)
         self.assertNoResult(model1_d)
-        self.assertEqual(model2, None)
-        self.assertEqual(cache._models, {"LisaFonssagrives": None})
-        self.assertEqual(cache._evictors.keys(), ["LisaFonssagrives"])
+        self.assertNoResult(model2_d)
 
         self.clock.advance(1)
         model1 = self.successResultOf(model1_d)
+        model2 = self.successResultOf(model2_d)
         self.assertEqual(model1.key, "LisaFonssagrives")
+        self.assertTrue(model1 is model2)
+        self.assertEqual(fetched_keys, ["LisaFonssagrives"])
         self.assertEqual(cache._models, {"LisaFonssagrives": model1})
-        self.assertEqual(cache._evictors.keys(), ["LisaFonssagrives"])
+        self.assertEqual(cache._expiry_slots.keys(), ["LisaFonssagrives"])
 
         # Clean up remaining state.
         cache.cleanup()
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
+
+    def test_overlapping_gets_failure(self):
+        """
+        If a shared fetch fails, all the pending gets fail and nothing is
+        cached.
+        """
+        cache = ModelObjectCache(self.clock, 5)
+        fetch_d = Deferred()
+        model1_d = cache.get_model(lambda key: fetch_d, "LisaFonssagrives")
+        model2_d = cache.get_model(lambda key: fetch_d, "LisaFonssagrives")
+        fetch_d.errback(ValueError("Riak is sad."))
+        self.failureResultOf(model1_d, ValueError)
+        self.failureResultOf(model2_d, ValueError)
+        self.assertEqual(cache._models, {})
+        self.assertEqual(cache._pending, {})
+
+    def test_cleanup_during_fetch(self):
+        """
+        If the cache is cleaned up while a fetch is in flight, the fetched
+        model is returned to the gets waiting for it but not cached, and
+        later gets start a fresh fetch.
+        """
+        cache = ModelObjectCache(self.clock, 5)
+        fetches = []
+
+        def getter(key):
+            d = Deferred()
+            fetches.append(d)
+            return d
+
+        model1_d = cache.get_model(getter, "LisaFonssagrives")
+        cache.cleanup()
+        model2_d = cache.get_model(getter, "LisaFonssagrives")
+        self.assertEqual(len(fetches), 2)
+
+        stale_model = FakeModelObject("LisaFonssagrives")
+        fetches[0].callback(stale_model)
+        self.assertTrue(self.successResultOf(model1_d) is stale_model)
+        self.assertNoResult(model2_d)
+        self.assertEqual(cache._models, {})
+        self.assertEqual(cache._expiry_slots, {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        fresh_model = FakeModelObject("LisaFonssagrives")
+        fetches[1].callback(fresh_model)
+        self.assertTrue(self.successResultOf(model2_d) is fresh_model)
+        self.assertEqual(cache._models, {"LisaFonssagrives": fresh_model})
+        self.assertEqual(cache._pending, {})
+        cache.cleanup()
 
     @inlineCallbacks
     def test_get_account_object(self):
@@ -220,15 +390,15 @@ class TestModelObjectCache(VumiTestCase):
 
         cache = ModelObjectCache(self.clock, 5)
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
 
         getter = vumi_helper.get_vumi_api().get_user_account
         model = yield cache.get_model(getter, account_key)
         self.assertEqual(model.key, account_key)
         self.assertEqual(cache._models, {account_key: model})
-        self.assertEqual(cache._evictors.keys(), [account_key])
+        self.assertEqual(cache._expiry_slots.keys(), [account_key])
 
         # Clean up remaining state.
         cache.cleanup()
         self.assertEqual(cache._models, {})
-        self.assertEqual(cache._evictors, {})
+        self.assertEqual(cache._expiry_slots, {})
@@ -1,12 +1,13 @@
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
 
-from vumi.tests.helpers import VumiTestCase, MessageHelper
+from vumi.tests.helpers import VumiTestCase, MessageHelper, PersistenceHelper
 from vumi.tests.utils import LogCatcher
 
 from go.vumitools.routing import (
-    AccountRoutingTableDispatcher, RoutingMetadata,
-    RoutingError, UnroutableMessageError, NoTargetError)
-from go.vumitools.routing_table import RoutingTable
+    AccountRoutingTableDispatcher, CompiledRoutingTable, RoutingMetadata,
+    RoutingError, UnroutableMessageError, NoTargetError, OutboundHops,
+    OutboundHopsIndex)
+from go.vumitools.routing_table import GoConnector, RoutingTable
 from go.vumitools.tests.helpers import VumiApiHelper
 from go.vumitools.utils import MessageMetadataHelper
 
@@ -277,6 +278,66 @@ class TestRoutingMetadata(VumiTestCase):
         self.assertEqual(rmeta.unroutable_event_done(), True)
 
 
+class TestCompiledRoutingTable(VumiTestCase):
+    def test_get_connector_parses_once(self):
+        compiled = CompiledRoutingTable(config=None)
+        conn = compiled.get_connector("CONVERSATION:app1:conv1")
+        self.assertEqual(conn, GoConnector.for_conversation("app1", "conv1"))
+        self.assertTrue(
+            compiled.get_connector("CONVERSATION:app1:conv1") is conn)
+
+    def test_add_connector(self):
+        compiled = CompiledRoutingTable(config=None)
+        conn = GoConnector.for_transport_tag("pool1", "1234")
+        compiled.add_connector(conn)
+        self.assertEqual(compiled.connectors(), [conn])
+        self.assertTrue(
+            compiled.get_connector("TRANSPORT_TAG:pool1:1234") is conn)
+
+    def test_tagpool_metadata(self):
+        compiled = CompiledRoutingTable(config=None)
+        self.assertEqual(compiled.get_tagpool_metadata("pool1"), None)
+        compiled.set_tagpool_metadata("pool1", {"transport_name": "sphex"})
+        self.assertEqual(
+            compiled.get_tagpool_metadata("pool1"),
+            {"transport_name": "sphex"})
+
+
+class TestOutboundHopsIndex(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.index = OutboundHopsIndex(self.redis, 60)
+
+    @inlineCallbacks
+    def test_add_and_get(self):
+        hops = [[["CONVERSATION:app1:conv1", "default"],
+                 ["TRANSPORT_TAG:pool1:1234", "default"]]]
+        yield self.index.add(
+            "msg-1", OutboundHops(hops, ("pool1", "1234"), "acc-1", False))
+        outbound_hops = yield self.index.get("msg-1")
+        self.assertEqual(outbound_hops.hops, hops)
+        self.assertEqual(outbound_hops.tag, ("pool1", "1234"))
+        self.assertEqual(outbound_hops.user_account, "acc-1")
+        self.assertEqual(outbound_hops.unroutable, False)
+        ttl = yield self.redis.ttl("msg-1")
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_get_missing(self):
+        outbound_hops = yield self.index.get("msg-1")
+        self.assertEqual(outbound_hops, None)
+
+    @inlineCallbacks
+    def test_no_tag_or_account(self):
+        yield self.index.add("msg-1", OutboundHops([], None, None, True))
+        outbound_hops = yield self.index.get("msg-1")
+        self.assertEqual(outbound_hops.tag, None)
+        self.assertEqual(outbound_hops.user_account, None)
+        self.assertEqual(outbound_hops.unroutable, True)
+
+
 class RoutingTableDispatcherTestCase(VumiTestCase):
     """Base class for ``AccountRoutingTableDispatcher`` test cases"""
 
@@ -862,6 +923,210 @@ class TestRoutingTableDispatcher(RoutingTableDispatcherTestCase):
         stored_msg = yield mdb.get_outbound_message(msg["message_id"])
         self.assertEqual(stored_msg, None)
 
+    @inlineCallbacks
+    def test_compile_routing(self):
+        dispatcher = yield self.get_dispatcher()
+        compiled = yield dispatcher.compile_routing(self.user_account_key)
+        self.assertEqual(compiled.config.user_account_key,
+                         self.user_account_key)
+        self.assertEqual(compiled.config.routing_table,
+                         self.get_routing_table()._routing_table)
+        self.assertTrue(compiled.config.compiled_routing is compiled)
+        self.assertEqual(sorted(str(c) for c in compiled.connectors()), [
+            "CONVERSATION:app1:conv1",
+            "CONVERSATION:app2:conv2",
+            "ROUTER:router:router1:OUTBOUND",
+            "TRANSPORT_TAG:pool1:1234",
+            "TRANSPORT_TAG:pool1:5678",
+            "TRANSPORT_TAG:pool1:9012",
+        ])
+        self.assertEqual(compiled.get_tagpool_metadata("pool1"), {
+            "transport_name": "sphex",
+        })
+
+    @inlineCallbacks
+    def test_compile_routing_ignores_cached_account(self):
+        """
+        Compiled routing tables are built from a fresh account load, so they
+        aren't made staler by the account cache.
+        """
+        dispatcher = yield self.get_dispatcher()
+        user_api = dispatcher.get_user_api(self.user_account_key)
+        yield dispatcher.get_user_account(user_api)
+
+        user_account = yield self.user_helper.get_user_account()
+        user_account.routing_table = RoutingTable()
+        yield user_account.save()
+
+        compiled = yield dispatcher.compile_routing(self.user_account_key)
+        self.assertEqual(compiled.config.routing_table, {})
+        self.assertEqual(list(compiled.connectors()), [])
+
+    @inlineCallbacks
+    def test_compiled_routing_reused_between_messages(self):
+        dispatcher = yield self.get_dispatcher()
+        compiled_accounts = []
+        orig_compile_routing = dispatcher.compile_routing
+
+        def compile_routing(user_account_key):
+            compiled_accounts.append(user_account_key)
+            return orig_compile_routing(user_account_key)
+
+        self.patch(dispatcher, 'compile_routing', compile_routing)
+
+        msg1 = self.with_md(
+            self.msg_helper.make_inbound("foo"), tag=("pool1", "1234"))
+        yield self.dispatch_inbound(msg1, 'sphex')
+        msg2 = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg2, 'app1')
+
+        self.assertEqual(compiled_accounts, [self.user_account_key])
+        self.assertEqual(len(self.get_dispatched_inbound('app1')), 1)
+        self.assertEqual(len(self.get_dispatched_outbound('sphex')), 1)
+
+    @inlineCallbacks
+    def test_tag_owner_cached(self):
+        dispatcher = yield self.get_dispatcher()
+        mdb = self.vumi_helper.get_vumi_api().mdb
+        fetched_tags = []
+        orig_get_tag_info = mdb.get_tag_info
+
+        def get_tag_info(tag):
+            fetched_tags.append(tag)
+            return orig_get_tag_info(tag)
+
+        self.patch(mdb, 'get_tag_info', get_tag_info)
+
+        owner = yield dispatcher.get_tag_owner(("pool1", "1234"))
+        self.assertEqual(owner, self.user_account_key)
+        owner = yield dispatcher.get_tag_owner(("pool1", "1234"))
+        self.assertEqual(owner, self.user_account_key)
+        self.assertEqual(fetched_tags, [("pool1", "1234")])
+
+    @inlineCallbacks
+    def test_tag_owner_cache_cleared_on_release(self):
+        dispatcher = yield self.get_dispatcher()
+        owner = yield dispatcher.get_tag_owner(("pool1", "1234"))
+        self.assertEqual(owner, self.user_account_key)
+
+        yield self.user_helper.user_api.release_tag(("pool1", "1234"))
+        owner = yield dispatcher.get_tag_owner(("pool1", "1234"))
+        self.assertEqual(owner, None)
+
+    @inlineCallbacks
+    def test_tag_owner_cache_release_during_lookup(self):
+        """
+        If a tag is released while a lookup of its owner is in flight, the
+        old owner isn't put back in the cache.
+        """
+        dispatcher = yield self.get_dispatcher()
+        orig_fetch_tag_owner = dispatcher._fetch_tag_owner
+        stale_fetch = Deferred()
+        fetches = []
+
+        def fetch_tag_owner(tag):
+            fetches.append(tag)
+            if len(fetches) == 1:
+                return stale_fetch
+            return orig_fetch_tag_owner(tag)
+
+        self.patch(dispatcher, '_fetch_tag_owner', fetch_tag_owner)
+
+        stale_d = dispatcher.get_tag_owner(("pool1", "1234"))
+        yield self.user_helper.user_api.release_tag(("pool1", "1234"))
+        owner = yield dispatcher.get_tag_owner(("pool1", "1234"))
+        self.assertEqual(owner, None)
+
+        stale_fetch.callback(self.user_account_key)
+        self.assertEqual((yield stale_d), self.user_account_key)
+        owner = yield dispatcher.get_tag_owner(("pool1", "1234"))
+        self.assertEqual(owner, None)
+
+    @inlineCallbacks
+    def test_tagpool_metadata_cached(self):
+        dispatcher = yield self.get_dispatcher()
+        tpm = self.vumi_helper.get_vumi_api().tpm
+        metadata = yield dispatcher.get_tagpool_metadata("pool1")
+        self.assertEqual(metadata, {"transport_name": "sphex"})
+
+        yield tpm.set_metadata("pool1", {"transport_name": "other"})
+        metadata = yield dispatcher.get_tagpool_metadata("pool1")
+        self.assertEqual(metadata, {"transport_name": "sphex"})
+
+    @inlineCallbacks
+    def test_event_config_built_once(self):
+        dispatcher = yield self.get_dispatcher()
+        msg = self.msg_helper.make_outbound("foo")
+        ack1 = self.msg_helper.make_ack(msg)
+        ack2 = self.msg_helper.make_ack(msg)
+        config1 = yield dispatcher.get_config(ack1)
+        config2 = yield dispatcher.get_config(ack2)
+        self.assertTrue(config1 is config2)
+        self.assertEqual(config1.user_account_key, None)
+        self.assertEqual(config1.routing_table, {})
+        self.assertEqual(config1.compiled_routing, None)
+
+    @inlineCallbacks
+    def test_outbound_hops_index(self):
+        """
+        Outbound messages to transports have their routing metadata written
+        to the outbound hops index.
+        """
+        dispatcher = yield self.get_dispatcher()
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+
+        outbound_hops = yield dispatcher.outbound_hops_index.get(
+            msg['message_id'])
+        self.assertEqual(outbound_hops.hops, [
+            [['CONVERSATION:app1:conv1', 'default'],
+             ['TRANSPORT_TAG:pool1:1234', 'default']],
+        ])
+        self.assertEqual(outbound_hops.tag, ('pool1', '1234'))
+        self.assertEqual(outbound_hops.user_account, self.user_account_key)
+        self.assertEqual(outbound_hops.unroutable, False)
+
+    @inlineCallbacks
+    def test_event_routing_from_outbound_hops_index(self):
+        """
+        Events can be routed using the outbound hops index even if the
+        outbound message isn't in the message store.
+        """
+        yield self.get_dispatcher(store_messages_to_transports=False)
+        msg = self.with_md(
+            self.msg_helper.make_outbound("foo"), conv=('app1', 'conv1'))
+        yield self.dispatch_outbound(msg, 'app1')
+        [sent_msg] = self.get_dispatched_outbound('sphex')
+
+        ack = self.msg_helper.make_ack(msg)
+        yield self.dispatch_event(ack, 'sphex')
+        self.assert_rkeys_used('app1.outbound', 'sphex.outbound',
+                               'sphex.event', 'app1.event')
+        self.with_md(ack, tag=('pool1', '1234'), conv=('app1', 'conv1'),
+                     hops=[
+                         ['TRANSPORT_TAG:pool1:1234', 'default'],
+                         ['CONVERSATION:app1:conv1', 'default'],
+                     ], outbound_hops_from=sent_msg)
+        self.assert_events_equal([ack], self.get_dispatched_events('app1'))
+
+    @inlineCallbacks
+    def test_outbound_hops_index_disabled(self):
+        """
+        If the outbound hops TTL is zero, we don't use the index.
+        """
+        dispatcher = yield self.get_dispatcher(outbound_hops_ttl=0)
+        self.assertEqual(dispatcher.outbound_hops_index, None)
+        msg, ack = yield self.mk_msg_ack(
+            tag=('pool1', '1234'), user_account=self.user_account_key,
+            hops=[
+                ['CONVERSATION:app1:conv1', 'default'],
+                ['TRANSPORT_TAG:pool1:1234', 'default'],
+            ])
+        yield self.dispatch_event(ack, 'sphex')
+        self.assert_rkeys_used('sphex.event', 'app1.event')
+
 
 class TestRoutingTableDispatcherWithBilling(RoutingTableDispatcherTestCase):
 
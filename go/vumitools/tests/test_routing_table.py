@@ -264,6 +264,65 @@ class TestRoutingTable(VumiTestCase):
         rt.remove_transport_tag(tag)
         self.assert_routing_entries(rt, [])
 
+    def test_lookup_sources_after_add_entry(self):
+        rt = self.make_rt()
+        # Build the reverse index before modifying the routing table.
+        self.assertEqual(rt.lookup_sources(self.CONV_2), [])
+        rt.add_entry(self.CHANNEL_2, "default", self.CONV_2, "default")
+        self.assertEqual(rt.lookup_sources(self.CONV_2), [
+            ("default", [GoConnector.parse(self.CHANNEL_2), "default"]),
+        ])
+        self.assertEqual(rt.lookup_source(self.CONV_2, "default"),
+                         [GoConnector.parse(self.CHANNEL_2), "default"])
+
+    def test_lookup_sources_after_replacing_entry(self):
+        rt = self.make_rt()
+        self.assertEqual(len(rt.lookup_sources(self.CHANNEL_3)), 1)
+        rt.add_entry(self.CONV_1, "default1.2", self.CHANNEL_2, "default4")
+        self.assertEqual(rt.lookup_sources(self.CHANNEL_3), [])
+        self.assertEqual(sorted(rt.lookup_sources(self.CHANNEL_2)), [
+            ("default2", [GoConnector.parse(self.CONV_1), "default1.1"]),
+            ("default4", [GoConnector.parse(self.CONV_1), "default1.2"]),
+        ])
+
+    def test_lookup_sources_after_remove_entry(self):
+        rt = self.make_rt()
+        self.assertEqual(len(rt.lookup_sources(self.CHANNEL_2)), 1)
+        rt.remove_entry(self.CONV_1, "default1.1")
+        self.assertEqual(rt.lookup_sources(self.CHANNEL_2), [])
+        self.assertEqual(rt.lookup_source(self.CHANNEL_2, "default2"), None)
+
+    def test_lookup_sources_after_remove_connector(self):
+        rt = self.make_rt(copy.deepcopy(self.COMPLEX_ROUTING))
+        self.assertEqual(len(rt.lookup_sources(self.CONV_1)), 1)
+        rt.remove_connector(self.ROUTER_1_OUTBOUND)
+        self.assertEqual(rt.lookup_sources(self.CONV_1), [])
+        self.assertEqual(rt.lookup_sources(self.ROUTER_1_OUTBOUND), [])
+        self.assert_routing_entries(rt, [
+            (self.CHANNEL_2, "default", self.ROUTER_1_INBOUND, "default"),
+            (self.ROUTER_1_INBOUND, "default", self.CHANNEL_2, "default"),
+            (self.CONV_2, "sms", self.CHANNEL_3, "default"),
+        ])
+
+    def test_remove_connector_source_and_destination(self):
+        rt = self.make_rt({
+            self.CHANNEL_2: {"default": [self.CONV_1, "default"]},
+            self.CONV_1: {
+                "default": [self.CHANNEL_2, "default"],
+                "other": [self.CHANNEL_3, "default"],
+            },
+        })
+        rt.remove_connector(self.CONV_1)
+        self.assert_routing_entries(rt, [])
+        self.assertEqual(rt._routing_table, {})
+
+    def test_entries_reuse_parsed_connectors(self):
+        rt = self.make_rt()
+        [entry1, entry2] = sorted(rt.entries())
+        self.assertTrue(entry1[0] is entry2[0])
+        [entry3, entry4] = sorted(rt.entries())
+        self.assertTrue(entry1[0] is entry3[0])
+
     def test_transitive_targets_simple_case(self):
         rt = self.make_rt()
         self.assert_connectors(rt.transitive_targets(self.CONV_1), [
@@ -0,0 +1,23 @@
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.vumitools.tagpool import GoTagpoolManager
+
+
+class TestGoTagpoolManager(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield self.persistence_helper.get_redis_manager()
+        self.tpm = GoTagpoolManager(redis)
+
+    @inlineCallbacks
+    def test_free_tag_count(self):
+        self.assertEqual((yield self.tpm.free_tag_count(u'pool')), 0)
+        yield self.tpm.declare_tags([(u'pool', u'tag1'), (u'pool', u'tag2')])
+        self.assertEqual((yield self.tpm.free_tag_count(u'pool')), 2)
+        yield self.tpm.acquire_tag(u'pool')
+        self.assertEqual((yield self.tpm.free_tag_count(u'pool')), 1)
+        self.assertEqual((yield self.tpm.free_tag_count(u'other')), 0)
@@ -1,11 +1,12 @@
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
 
 from vumi.tests.helpers import VumiTestCase, MessageHelper
 
 from go.vumitools.model_object_cache import ModelObjectCache
 from go.vumitools.utils import (
-    extract_auth_from_url, MessageMetadataDictHelper, MessageMetadataHelper)
+    extract_auth_from_url, gather_in_order, MessageMetadataDictHelper,
+    MessageMetadataHelper)
 from go.vumitools.tests.helpers import VumiApiHelper
 
 
@@ -27,6 +28,28 @@ class TestExtractAuthFromUrl(VumiTestCase):
         self.assertEqual(url, 'http://go.vumi.org')
 
 
+class TestGatherInOrder(VumiTestCase):
+
+    def test_values(self):
+        self.assertEqual(gather_in_order(iter([1, None, 3])), [1, None, 3])
+
+    def test_deferreds(self):
+        d1, d2 = Deferred(), Deferred()
+        d = gather_in_order([d1, succeed(2), d2, 4])
+        self.assertNoResult(d)
+        d2.callback(3)
+        self.assertNoResult(d)
+        d1.callback(1)
+        self.assertEqual(self.successResultOf(d), [1, 2, 3, 4])
+
+    def test_failure(self):
+        d1, d2 = Deferred(), Deferred()
+        d = gather_in_order([d1, d2])
+        d2.errback(ValueError("Nope"))
+        self.failureResultOf(d, ValueError)
+        d1.callback(1)
+
+
 class TestMessageMetadataDictHelper(VumiTestCase):
 
     def setUp(self):
@@ -0,0 +1,51 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+
+from vumi.components.window_manager import WindowManager
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+
+from go.vumitools.window_manager import BatchingWindowManager
+
+
+class TestBatchingWindowManager(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        redis = yield self.persistence_helper.get_redis_manager()
+        self.window_id = 'window_id'
+
+        self.clock = Clock()
+        self.patch(WindowManager, 'get_clock', lambda _: self.clock)
+
+        self.wm = BatchingWindowManager(
+            redis, window_size=10, flight_lifetime=10)
+        self.add_cleanup(self.wm.stop)
+        yield self.wm.create_window(self.window_id)
+
+    @inlineCallbacks
+    def test_add_many(self):
+        keys = yield self.wm.add_many(self.window_id, ['a', 'b', 'c'])
+        self.assertEqual(len(set(keys)), 3)
+        self.assertEqual((yield self.wm.count_waiting(self.window_id)), 3)
+        for key, data in zip(keys, ['a', 'b', 'c']):
+            self.assertEqual(
+                (yield self.wm.get_data(self.window_id, key)), data)
+
+    @inlineCallbacks
+    def test_add_many_order(self):
+        """
+        Flights added in a batch leave the window in the order they were
+        given.
+        """
+        keys = yield self.wm.add_many(self.window_id, range(5))
+        next_keys = []
+        for _ in range(5):
+            next_keys.append((yield self.wm.get_next_key(self.window_id)))
+        self.assertEqual(next_keys, keys)
+
+    @inlineCallbacks
+    def test_add_many_empty(self):
+        keys = yield self.wm.add_many(self.window_id, [])
+        self.assertEqual(keys, [])
+        self.assertEqual((yield self.wm.count_waiting(self.window_id)), 0)
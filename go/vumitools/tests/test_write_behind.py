@@ -0,0 +1,236 @@
+import json
+import os
+
+from twisted.internet.defer import Deferred, fail, inlineCallbacks, succeed
+from twisted.internet.task import Clock
+
+from vumi.tests.helpers import VumiTestCase
+
+from go.vumitools.write_behind import WriteBehindJournal, WriteBehindQueue
+
+
+def mkrecord(key, batch_id='batch-1'):
+    return {'key': key, 'batch_id': batch_id}
+
+
+class TestWriteBehindJournal(VumiTestCase):
+
+    def setUp(self):
+        self.path = os.path.join(self.mktemp(), 'journal')
+
+    def mkjournal(self, **kw):
+        journal = WriteBehindJournal(self.path, **kw)
+        self.add_cleanup(journal.close)
+        return journal
+
+    def segment_files(self):
+        return sorted(os.listdir(self.path))
+
+    def test_open_empty(self):
+        journal = self.mkjournal()
+        self.assertEqual(journal.open(), [])
+        self.assertEqual(self.segment_files(), ['journal-0.log'])
+
+    def test_append_and_complete(self):
+        journal = self.mkjournal()
+        journal.open()
+        segment = journal.append(mkrecord('a'))
+        self.assertEqual(segment, 0)
+        journal.complete(segment)
+        # The current segment is kept until the journal is closed.
+        self.assertEqual(self.segment_files(), ['journal-0.log'])
+        journal.close()
+        self.assertEqual(self.segment_files(), [])
+
+    def test_segment_rotation(self):
+        journal = self.mkjournal(segment_size=2)
+        journal.open()
+        segments = [journal.append(mkrecord(k)) for k in 'abc']
+        self.assertEqual(segments, [0, 0, 1])
+        self.assertEqual(
+            self.segment_files(), ['journal-0.log', 'journal-1.log'])
+        journal.complete(0)
+        journal.complete(0)
+        self.assertEqual(self.segment_files(), ['journal-1.log'])
+
+    def test_replay(self):
+        journal = WriteBehindJournal(self.path, segment_size=2)
+        journal.open()
+        for k in 'abc':
+            journal.append(mkrecord(k))
+        journal.complete(0)
+        journal.close()
+
+        journal = self.mkjournal()
+        self.assertEqual(journal.open(), [
+            (0, mkrecord('a')),
+            (0, mkrecord('b')),
+            (1, mkrecord('c')),
+        ])
+        journal.complete(0)
+        journal.complete(0)
+        journal.complete(1)
+        self.assertEqual(self.segment_files(), ['journal-2.log'])
+
+    def test_dead_letter(self):
+        journal = self.mkjournal()
+        journal.open()
+        segment = journal.append(mkrecord('a'))
+        journal.dead_letter(segment, mkrecord('a'))
+        journal.close()
+        self.assertEqual(self.segment_files(), ['dead-letter.log'])
+        with open(os.path.join(self.path, 'dead-letter.log')) as f:
+            self.assertEqual(
+                [json.loads(line) for line in f], [mkrecord('a')])
+
+        # Dead letters aren't replayed.
+        self.assertEqual(self.mkjournal().open(), [])
+
+    def test_replay_ignores_partial_record(self):
+        os.makedirs(self.path)
+        with open(os.path.join(self.path, 'journal-3.log'), 'w') as f:
+            f.write('{"key": "a", "batch_id": "b1"}\n{"key": ')
+        journal = self.mkjournal()
+        self.assertEqual(journal.open(), [
+            (3, {'key': 'a', 'batch_id': 'b1'})])
+
+
+class TestWriteBehindQueue(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(WriteBehindQueue, 'clock', self.clock)
+        self.path = os.path.join(self.mktemp(), 'journal')
+        self.written = []
+
+    def write(self, record):
+        self.written.append(record)
+        return succeed(None)
+
+    def mkqueue(self, write_func=None, **kw):
+        journal = WriteBehindJournal(self.path)
+        queue = WriteBehindQueue(write_func or self.write, journal, **kw)
+        queue.start()
+        self.add_cleanup(queue.stop)
+        return queue
+
+    def test_flush_on_interval(self):
+        queue = self.mkqueue(flush_interval=1)
+        queue.add(mkrecord('a'))
+        queue.add(mkrecord('b', batch_id='batch-2'))
+        self.assertEqual(self.written, [])
+        self.clock.advance(1)
+        self.assertEqual(
+            sorted(r['key'] for r in self.written), ['a', 'b'])
+
+    def test_flush_on_batch_size(self):
+        queue = self.mkqueue(batch_size=2)
+        queue.add(mkrecord('a'))
+        self.assertEqual(self.written, [])
+        queue.add(mkrecord('b'))
+        self.assertEqual([r['key'] for r in self.written], ['a', 'b'])
+
+    def test_concurrency(self):
+        writes = []
+
+        def write(record):
+            d = Deferred()
+            writes.append((record, d))
+            return d
+
+        queue = self.mkqueue(write_func=write, concurrency=1)
+        queue.add(mkrecord('a', batch_id='batch-1'))
+        queue.add(mkrecord('b', batch_id='batch-2'))
+        queue.flush()
+        self.assertEqual(len(writes), 1)
+        writes[0][1].callback(None)
+        self.assertEqual(len(writes), 2)
+        writes[1][1].callback(None)
+
+    def test_concurrency_within_batch(self):
+        writes = []
+
+        def write(record):
+            d = Deferred()
+            writes.append((record, d))
+            return d
+
+        queue = self.mkqueue(write_func=write, concurrency=2)
+        for key in ['a', 'b', 'c']:
+            queue.add(mkrecord(key))
+        d = queue.flush()
+        self.assertEqual([r['key'] for r, _ in writes], ['a', 'b'])
+        writes[0][1].callback(None)
+        self.assertEqual([r['key'] for r, _ in writes], ['a', 'b', 'c'])
+        writes[1][1].callback(None)
+        writes[2][1].callback(None)
+        self.assertTrue(d.called)
+
+    def test_failed_writes_retried(self):
+        failures = [Exception("Nope")]
+
+        def write(record):
+            if failures:
+                return fail(failures.pop())
+            return self.write(record)
+
+        queue = self.mkqueue(write_func=write)
+        queue.add(mkrecord('a'))
+        queue.flush()
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
+        self.assertEqual(self.written, [])
+        queue.flush()
+        self.assertEqual(self.written, [mkrecord('a')])
+
+    def test_failed_writes_dead_lettered(self):
+        def write(record):
+            return fail(Exception("Nope"))
+
+        queue = self.mkqueue(write_func=write, max_attempts=3)
+        queue.add(mkrecord('a'))
+        d = queue.wait_for('a')
+        queue.flush()
+        queue.flush()
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
+        self.assertFalse(d.called)
+        queue.flush()
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
+        self.assertTrue(d.called)
+        queue.flush()
+        self.assertEqual(self.flushLoggedErrors(Exception), [])
+        with open(os.path.join(self.path, 'dead-letter.log')) as f:
+            self.assertEqual(
+                [json.loads(line) for line in f], [mkrecord('a')])
+
+    def test_wait_for(self):
+        queue = self.mkqueue()
+        self.assertTrue(queue.wait_for('a').called)
+        queue.add(mkrecord('a'))
+        d = queue.wait_for('a')
+        self.assertFalse(d.called)
+        queue.flush()
+        self.assertTrue(d.called)
+        self.assertTrue(queue.wait_for('a').called)
+
+    @inlineCallbacks
+    def test_stop_writes_pending(self):
+        journal = WriteBehindJournal(self.path)
+        queue = WriteBehindQueue(self.write, journal)
+        queue.start()
+        queue.add(mkrecord('a'))
+        yield queue.stop()
+        self.assertEqual(self.written, [mkrecord('a')])
+        self.assertEqual(os.listdir(self.path), [])
+
+    @inlineCallbacks
+    def test_replay_on_start(self):
+        journal = WriteBehindJournal(self.path)
+        journal.open()
+        journal.append(mkrecord('a'))
+        journal.close()
+
+        queue = WriteBehindQueue(self.write, WriteBehindJournal(self.path))
+        queue.start()
+        self.assertEqual(self.written, [mkrecord('a')])
+        yield queue.stop()
+        self.assertEqual(os.listdir(self.path), [])
@@ -1,7 +1,7 @@
 # -*- test-case-name: go.vumitools.tests.test_utils -*-
 from urlparse import urlparse, urlunparse
 
-from twisted.internet.defer import succeed
+from twisted.internet.defer import Deferred, FirstError, gatherResults, succeed
 from vumi.middleware.tagger import TaggingMiddleware
 
 
@@ -22,6 +22,36 @@ def extract_auth_from_url(url):
     return None, url
 
 
+def _unwrap_first_error(failure):
+    failure.trap(FirstError)
+    return failure.value.subFailure
+
+
+def gather_in_order(results):
+    """
+    Collect the results of manager calls that have all been started, in
+    order.
+
+    Under an async manager, `results` are deferreds and this returns a
+    deferred that fires with a list of their values, so the calls are all in
+    flight at once (and Redis commands are pipelined). If any of them fail,
+    it fails with the first failure. Under a sync manager, the calls have
+    already been made one after the other and their values are returned as
+    a list.
+
+    This is intended for use in methods decorated with
+    `Manager.calls_manager`, which can yield the result either way.
+    """
+    results = list(results)
+    if not any(isinstance(result, Deferred) for result in results):
+        return results
+    d = gatherResults([
+        result if isinstance(result, Deferred) else succeed(result)
+        for result in results], consumeErrors=True)
+    d.addErrback(_unwrap_first_error)
+    return d
+
+
 class MessageMetadataDictHelper(object):
     """Manage various bits of metadata for a Vumi Go message.
 
@@ -0,0 +1,37 @@
+# -*- test-case-name: go.vumitools.tests.test_window_manager -*-
+
+import json
+import uuid
+
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+
+from vumi.components.window_manager import WindowManager
+
+
+class BatchingWindowManager(WindowManager):
+    """
+    A :class:`WindowManager` that can add many flights to a window at once.
+    """
+
+    @inlineCallbacks
+    def add_many(self, window_id, data_items):
+        """
+        Add a flight to a window for each item in `data_items`, in order.
+
+        The Redis commands for all the flights are issued without waiting for
+        the earlier ones to complete, so a batch of flights takes two round
+        trips instead of two per flight.
+
+        :returns: A list of the new flight keys.
+        """
+        keys = [uuid.uuid4().get_hex() for _ in data_items]
+        # All the data has to be stored before any keys are pushed,
+        # otherwise a key can be popped from the window before its data is
+        # available.
+        yield gatherResults([
+            self.redis.set(self.window_key(window_id, key), json.dumps(data))
+            for key, data in zip(keys, data_items)])
+        yield gatherResults([
+            self.redis.lpush(self.window_key(window_id), key)
+            for key in keys])
+        returnValue(keys)
@@ -0,0 +1,279 @@
+# -*- test-case-name: go.vumitools.tests.test_write_behind -*-
+
+import json
+import os
+import re
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredSemaphore, Deferred, gatherResults, succeed)
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+
+
+class WriteBehindJournal(object):
+    """
+    Append-only, on-disk journal of writes that haven't been completed yet.
+
+    Records are appended to numbered segment files in `path` as lines of
+    JSON. A new segment is started every `segment_size` records and a
+    segment's file is deleted once all the records in it have been
+    completed and it is no longer the current segment. Any segments left
+    behind by a previous process are replayed by :meth:`open`.
+
+    Records are flushed to the OS as they are appended, so they survive the
+    process crashing. If `fsync` is set, they are also synced to disk, which
+    protects against the machine crashing at the cost of a blocking sync for
+    every record.
+
+    Records that can't be completed are moved to a dead-letter file in
+    `path` by :meth:`dead_letter`. It is never replayed, so they can be
+    inspected and written by hand.
+    """
+
+    SEGMENT_RE = re.compile(r'^journal-(\d+)\.log$')
+    DEAD_LETTER_FILENAME = 'dead-letter.log'
+
+    def __init__(self, path, segment_size=1000, fsync=False):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self._segment = None
+        self._segment_file = None
+        self._segment_records = 0
+        # Segment -> number of records in it that haven't been completed.
+        self._outstanding = {}
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, 'journal-%d.log' % (segment,))
+
+    def _existing_segments(self):
+        segments = []
+        for filename in os.listdir(self.path):
+            match = self.SEGMENT_RE.match(filename)
+            if match is not None:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def open(self):
+        """
+        Open the journal and return a list of `(segment, record)` pairs for
+        the records left over from previous processes, oldest first.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        replayed = []
+        segments = self._existing_segments()
+        for segment in segments:
+            with open(self._segment_path(segment)) as segment_file:
+                records = [json.loads(line) for line in segment_file
+                           if line.endswith('\n')]
+            if not records:
+                os.remove(self._segment_path(segment))
+                continue
+            self._outstanding[segment] = len(records)
+            replayed.extend((segment, record) for record in records)
+        self._start_segment(segments[-1] + 1 if segments else 0)
+        return replayed
+
+    def close(self):
+        if self._segment_file is not None:
+            self._segment_file.close()
+            self._segment_file = None
+        self._cleanup_segment(self._segment)
+
+    def _start_segment(self, segment):
+        old_segment, old_file = self._segment, self._segment_file
+        self._segment = segment
+        self._segment_records = 0
+        self._outstanding.setdefault(segment, 0)
+        self._segment_file = open(self._segment_path(segment), 'a')
+        if old_file is not None:
+            old_file.close()
+            self._cleanup_segment(old_segment)
+
+    def _cleanup_segment(self, segment):
+        if self._outstanding.get(segment) == 0 and (
+                self._segment_file is None or segment != self._segment):
+            del self._outstanding[segment]
+            os.remove(self._segment_path(segment))
+
+    def append(self, record):
+        """
+        Append a record to the journal and return the segment it was
+        written to, which must be passed to :meth:`complete` later.
+        """
+        if self._segment_records >= self.segment_size:
+            self._start_segment(self._segment + 1)
+        self._segment_file.write(json.dumps(record) + '\n')
+        self._segment_file.flush()
+        if self.fsync:
+            os.fsync(self._segment_file.fileno())
+        self._segment_records += 1
+        self._outstanding[self._segment] += 1
+        return self._segment
+
+    def complete(self, segment):
+        """
+        Mark a record in `segment` as completed.
+        """
+        self._outstanding[segment] -= 1
+        self._cleanup_segment(segment)
+
+    def dead_letter(self, segment, record):
+        """
+        Append a record from `segment` to the dead-letter file and mark it
+        as completed.
+        """
+        dead_letter_path = os.path.join(self.path, self.DEAD_LETTER_FILENAME)
+        with open(dead_letter_path, 'a') as dead_letter_file:
+            dead_letter_file.write(json.dumps(record) + '\n')
+            dead_letter_file.flush()
+            if self.fsync:
+                os.fsync(dead_letter_file.fileno())
+        self.complete(segment)
+
+
+class WriteBehindQueue(object):
+    """
+    Queue of writes that are performed in the background.
+
+    Writes are grouped by batch and flushed every `flush_interval` seconds,
+    or sooner if `batch_size` writes are waiting. At most `concurrency`
+    writes are in flight at once. Each write is journalled before it is
+    queued and marked completed in the journal once `write_func` succeeds.
+    Failed writes are queued again for the next flush, up to a total of
+    `max_attempts` attempts, after which the record is moved to the
+    journal's dead-letter file.
+
+    Records are dicts with at least a `batch_id` and a `key` that
+    :meth:`wait_for` can be used with.
+    """
+
+    clock = reactor
+
+    def __init__(self, write_func, journal, batch_size=100,
+                 flush_interval=1, concurrency=5, max_attempts=5):
+        self.write_func = write_func
+        self.journal = journal
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self._semaphore = DeferredSemaphore(concurrency)
+        self._pending = {}
+        self._pending_count = 0
+        self._in_flight = set()
+        # Record key -> deferreds waiting for the record to be written.
+        self._waiters = {}
+        self._outstanding_keys = {}
+        self._looper = None
+
+    def start(self):
+        replayed = self.journal.open()
+        if replayed:
+            log.info("Replaying %d journalled writes." % (len(replayed),))
+        for segment, record in replayed:
+            self._track_key(record)
+            self._queue(segment, record)
+        self._looper = LoopingCall(self.flush)
+        self._looper.clock = self.clock
+        self._looper.start(self.flush_interval, now=bool(replayed))
+
+    def stop(self):
+        """
+        Stop flushing periodically, write everything that's waiting and then
+        close the journal.
+        """
+        if self._looper is not None and self._looper.running:
+            self._looper.stop()
+        d = self.flush()
+        d.addCallback(lambda _: self._wait_for_in_flight())
+        d.addCallback(lambda _: self.journal.close())
+        return d
+
+    def _wait_for_in_flight(self):
+        return gatherResults(list(self._in_flight))
+
+    def _queue(self, segment, record, attempts=0):
+        self._pending.setdefault(record['batch_id'], []).append(
+            (segment, record, attempts))
+        self._pending_count += 1
+
+    def _track_key(self, record):
+        key = record['key']
+        self._outstanding_keys[key] = self._outstanding_keys.get(key, 0) + 1
+
+    def _release_key(self, record):
+        key = record['key']
+        self._outstanding_keys[key] -= 1
+        if not self._outstanding_keys[key]:
+            del self._outstanding_keys[key]
+            for d in self._waiters.pop(key, []):
+                d.callback(None)
+
+    def add(self, record):
+        """
+        Journal a record and queue it for writing.
+        """
+        self._track_key(record)
+        self._queue(self.journal.append(record), record)
+        if self._pending_count >= self.batch_size:
+            self.flush()
+
+    def wait_for(self, key):
+        """
+        Return a deferred that fires once there are no queued or in-flight
+        writes for records with `key`.
+        """
+        if key not in self._outstanding_keys:
+            return succeed(None)
+        d = Deferred()
+        self._waiters.setdefault(key, []).append(d)
+        return d
+
+    def flush(self):
+        """
+        Start writing all the queued records and return a deferred that
+        fires when they have been written (or have failed and been queued
+        again or dead-lettered).
+        """
+        pending, self._pending = self._pending, {}
+        self._pending_count = 0
+        ds = []
+        for batch_id, entries in pending.iteritems():
+            for segment, record, attempts in entries:
+                ds.append(self._write(segment, record, attempts))
+        return gatherResults(ds)
+
+    def _write(self, segment, record, attempts):
+        d = self._semaphore.run(self.write_func, record)
+        d.addCallbacks(
+            self._write_done, self._write_failed,
+            callbackArgs=(segment, record),
+            errbackArgs=(segment, record, attempts + 1))
+        self._in_flight.add(d)
+        d.addBoth(self._write_finished, d)
+        return d
+
+    def _write_finished(self, result, d):
+        self._in_flight.discard(d)
+        return result
+
+    def _write_done(self, _, segment, record):
+        self.journal.complete(segment)
+        self._release_key(record)
+
+    def _write_failed(self, failure, segment, record, attempts):
+        if attempts >= self.max_attempts:
+            log.err(failure, (
+                "Write-behind write for %r failed %d times, moving it to the"
+                " dead-letter file." % (record['key'], attempts)))
+            self.journal.dead_letter(segment, record)
+            self._release_key(record)
+            return
+        if attempts == 1:
+            # Only the first failure is logged, so a write that keeps failing
+            # doesn't log on every flush.
+            log.err(failure, "Write-behind write failed, retrying later.")
+        self._queue(segment, record, attempts)
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark for RoutingTable lookups on large routing tables.
+
+Builds a synthetic routing table with one conversation routed to and from
+many transport tags (the shape of routing tables for accounts with thousands
+of channels) and times the source lookups used by routing-screen saves and
+routing table validation.
+
+Usage: python utils/bench_routing_table.py [--entries=10000] [--repeat=3]
+"""
+
+import copy
+import sys
+import time
+from optparse import OptionParser
+
+from go.vumitools.routing_table import GoConnector, RoutingTable
+
+
+def make_routing_table(entries):
+    """Build a raw routing table with `entries` entries."""
+    conv = str(GoConnector.for_conversation("bulk_message", "conv1"))
+    routing_table = {conv: {}}
+    for i in range(entries // 2):
+        tag = str(GoConnector.for_transport_tag("pool1", "tag%d" % (i,)))
+        endpoint = "ep%d" % (i,)
+        routing_table[conv][endpoint] = [tag, "default"]
+        routing_table[tag] = {"default": [conv, endpoint]}
+    return routing_table
+
+
+def timed(name, func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print "%-40s %10.4fs" % (name, best)
+
+
+def main(args):
+    parser = OptionParser()
+    parser.add_option("--entries", type="int", default=10000)
+    parser.add_option("--repeat", type="int", default=3)
+    opts, _ = parser.parse_args(args)
+
+    raw = make_routing_table(opts.entries)
+    tags = [str(GoConnector.for_transport_tag("pool1", "tag%d" % (i,)))
+            for i in range(opts.entries // 2)]
+    conv = str(GoConnector.for_conversation("bulk_message", "conv1"))
+
+    print "Routing table with %d entries:" % (opts.entries,)
+
+    def entries():
+        list(RoutingTable(raw).entries())
+
+    def lookup_source_all_tags():
+        rt = RoutingTable(raw)
+        for tag in tags:
+            rt.lookup_source(tag, "default")
+
+    def lookup_sources_all_tags():
+        rt = RoutingTable(raw)
+        for tag in tags:
+            rt.lookup_sources(tag)
+
+    def transitive_sources():
+        RoutingTable(raw).transitive_sources(conv)
+
+    def remove_connectors():
+        rt = RoutingTable(copy.deepcopy(raw))
+        for tag in tags[:100]:
+            rt.remove_connector(tag)
+
+    timed("entries()", entries, opts.repeat)
+    timed("lookup_source() for every tag", lookup_source_all_tags,
+          opts.repeat)
+    timed("lookup_sources() for every tag", lookup_sources_all_tags,
+          opts.repeat)
+    timed("transitive_sources()", transitive_sources, opts.repeat)
+    timed("remove_connector() for 100 tags", remove_connectors, opts.repeat)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])